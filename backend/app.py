@@ -1,20 +1,37 @@
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import json
+import hmac
+import atexit
+import functools
 import time
 import os
 import sys
 import logging
 from threading import Lock
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 from service.pdf_service import PDFService
-from service.chat_stream_service import ChatStreamService
 from service.config_manager import ConfigManager
+from service.metrics import metrics
+from service.stream_control import close_upstream
+from service.sse import SSEEncoder, TokenCoalescer, coalesce
+from service.stream_registry import StreamRegistry, StreamSpool
+from service.admission import AdmissionRejected
+from service.priority_scheduler import INTERACTIVE
+from service.upload_store import UploadStore, UploadError, IndexedHashRegistry, INDEXED_HASHES_FILE
+from service.snapshot import SnapshotManager, SnapshotError
+from service.batch_answer import BatchAnswerer
+from service.summarizer import DocumentSummarizer, SummaryCache
+from service.context_packer import context_usage
+from service.query_filters import parse_query_filter, QueryFilterError, DOC_ID_KEY, PAGE_NUMBER_KEY
+from service.ingestion_worker import IngestionQueue, start_worker_process, start_worker_thread
+from service.status_events import StatusBroadcaster
 
 # 初始化服務
 config_manager = ConfigManager("config.ini")
 pdf_service = PDFService("config.ini")
-chat_stream_service = ChatStreamService("config.ini")
+chat_stream_service = pdf_service.chat_stream_service
 
 # 載入配置
 app_config, app_config_sections = pdf_service.config_manager.get_complete_config()
@@ -30,17 +47,47 @@ cors_origins = config_manager.get_cors_origins()
 CORS(app, 
      origins=cors_origins,
      supports_credentials=True,
-     allow_headers=['Content-Type', 'Authorization', 'Cache-Control'],
-     methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'])  # 使用動態生成的允許來源
+     allow_headers=['Content-Type', 'Authorization', 'Cache-Control', 'Last-Event-ID', 'If-None-Match',
+                    'Upload-Offset', 'X-Filename'],
+     expose_headers=['X-Stream-Id', 'ETag', 'Upload-Offset', 'Upload-Length', 'Location'],
+     methods=['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'])  # 使用動態生成的允許來源
 
 # 文件上傳配置
 UPLOAD_FOLDER = app_config['input_dir']
 ALLOWED_EXTENSIONS = app_config['allowed_extensions']
 MAX_FILE_SIZE = app_config['max_file_size']
+STREAM_MAX_SIZE = app_config['stream_max_size']
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
+# 純檢索 API 配置
+search_config = config_manager.get_search_config()
+
+# 整份文件摘要配置；中間摘要快取在行程之間共用
+summarize_config = config_manager.get_summarize_config()
+summary_cache = SummaryCache(summarize_config['cache_dir'])
+
+# SSE 串流輸出配置
+stream_config = config_manager.get_stream_config()
+sse_encoder = SSEEncoder()
+stream_spool_dir = config_manager.get_stream_spool_dir()
+stream_registry = StreamRegistry(
+    max_streams=stream_config['resume_max_streams'],
+    max_events=stream_config['resume_buffer_events'],
+    ttl_seconds=stream_config['resume_ttl_seconds'],
+    grace_seconds=stream_config['resume_grace_seconds'],
+    spool=StreamSpool(stream_spool_dir) if stream_spool_dir else None
+)
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'X-Accel-Buffering': 'no'  # 關閉 nginx 緩衝
+}
+
 # 確保上傳目錄存在
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.chmod(UPLOAD_FOLDER, 0o777) 
@@ -50,27 +97,272 @@ llama_service = None
 uploaded_files = []
 initialization_lock = Lock()
 
+# 索引工作交給獨立的 ingestion worker，web 行程只負責排程與回報進度
+COLLECTION_NAME = "pdf_chat_collection"
+ingestion_config = config_manager.get_ingestion_config()
+ingestion_queue = IngestionQueue(ingestion_config['job_dir'])
+current_job_id = None
+attached_job_id = None
+
+# 上傳檔案邊接收邊寫入磁碟；已索引內容的 SHA-256 用於略過重複上傳
+upload_store = UploadStore(UPLOAD_FOLDER)
+hash_registry = IndexedHashRegistry(os.path.join(ingestion_config['job_dir'], INDEXED_HASHES_FILE))
+
+# 索引快照：匯出 / 匯入同樣交給 ingestion worker，與索引工作依序執行因此內容一致
+snapshot_manager = SnapshotManager(config_manager, UPLOAD_FOLDER)
+
+if ingestion_config['mode'] == 'inline':
+    # 開發模式：worker 在 web 行程的背景執行緒中執行
+    start_worker_thread("config.ini", ingestion_config['job_dir'], ingestion_config['poll_interval'])
+
+# 狀態有變化時才推送給 /api/status/stream 訂閱者；worker 進度由單一背景執行緒讀取
+status_broadcaster = StatusBroadcaster(
+    refresh=lambda: publish_status(),
+    poll_interval=ingestion_config['poll_interval']
+)
+
+def admission_rejected_response(error):
+    """提供者滿載時的快速失敗回應"""
+    response = jsonify({
+        'error': f'服務繁忙（{error.reason}），請稍後再試',
+        'provider': error.provider,
+        'retry_after': error.retry_after,
+        'status': 'error'
+    })
+    response.status_code = error.status_code
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def build_source_text(response):
+    """從 StreamingResponse 的 source_nodes 組出參考來源文字"""
+    if not getattr(response, 'source_nodes', None):
+        return None
+
+    source_text = "\n\n📖 參考來源："
+    for i, node in enumerate(response.source_nodes[:3], 1):
+        if hasattr(node, 'metadata') and 'file_name' in node.metadata:
+            file_name = node.metadata['file_name']
+            # 清理文件名
+            if '_' in file_name and file_name.split('_')[0].isdigit():
+                file_name = '_'.join(file_name.split('_')[1:])
+            source_text += f"\n{i}. {file_name}"
+    return source_text
+
+def build_context_event(response):
+    """回報這次回答實際送進提示詞的上下文 token 數與段落數"""
+    if not getattr(response, 'source_nodes', None):
+        return None
+    return {'status': 'context', **context_usage(response.source_nodes)}
+
 def allowed_file(filename):
     """檢查文件擴展名是否允許"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def enqueue_index_job():
+    """將重建索引排入 ingestion worker 佇列"""
+    global current_job_id
+    # 集合即將重建，重建完成前不再視為已索引
+    hash_registry.clear()
+    current_job_id = ingestion_queue.enqueue('index_folder', {
+        'upload_folder': UPLOAD_FOLDER,
+        'collection_name': COLLECTION_NAME,
+        'files': [{
+            'filename': f['filename'],
+            'original_name': f.get('original_name'),
+            'sha256': f.get('sha256'),
+            'size': f.get('size'),
+            'upload_time': f.get('upload_time')
+        } for f in uploaded_files]
+    })
+    logger.info(f"已排入索引工作: {current_job_id}")
+    return current_job_id
+
+def known_files():
+    """目前文件清單：本 worker 的 uploaded_files 之外，再加上共用的最新索引工作與已索引雜湊登錄
+
+    uploaded_files 只記錄本 worker 經手的上傳；其他 worker 上傳或索引的文件要從共用狀態取得。
+    """
+    files = list(uploaded_files)
+    latest = ingestion_queue.latest_status(INDEX_JOB_TYPES)
+    if latest is not None:
+        files.extend(latest.get('files') or [])
+    files.extend(hash_registry.all())
+    return files
+
+def resolve_file_id(name):
+    """將請求中的檔名（原始檔名或儲存檔名）或文件 ID 轉為文件 ID（SHA-256）；找不到時返回 None"""
+    for file_info in known_files():
+        sha256 = file_info.get('sha256')
+        if sha256 and name in (file_info.get('original_name'), file_info.get('filename'), sha256):
+            return sha256
+    return None
+
+def resolve_filter_file(name):
+    """過濾條件中的檔名必須對應到已知文件；儲存檔名帶有時間戳前綴，改以 file_name 比對只會靜默地查無結果"""
+    doc_id = resolve_file_id(name)
+    if doc_id is None:
+        raise QueryFilterError(f'找不到文件: {name}')
+    return doc_id
+
+def parse_request_filter(data):
+    """解析聊天請求的 filters 欄位；格式錯誤或檔名未知時拋出 QueryFilterError"""
+    return parse_query_filter(data.get('filters'), resolve_filter_file)
+
+# 會重建向量集合、決定目前文件清單的工作類型
+INDEX_JOB_TYPES = ('index_folder', 'import_snapshot')
+JOB_FILE_STATUS = {'queued': 'processing', 'running': 'processing', 'completed': 'completed', 'error': 'error'}
+
+def adopt_shared_job():
+    """其他 worker 排入了較新的索引 / 快照匯入工作時，改以共用的工作狀態為準
+
+    每個 gunicorn worker 各自記錄目前的工作與文件清單；以共用工作目錄中最新的工作為準，
+    所有 worker 回報相同的狀態快照（因此 ETag 相同），新啟動的 worker 也能接上既有的索引。
+    """
+    global current_job_id, attached_job_id, llama_service
+    latest = ingestion_queue.latest_status(INDEX_JOB_TYPES)
+    if latest is None or (current_job_id is not None and latest['job_id'] <= current_job_id):
+        return
+
+    with initialization_lock:
+        if current_job_id is not None and latest['job_id'] <= current_job_id:
+            return
+        current_job_id = latest['job_id']
+        if latest.get('state') != 'completed':
+            # 集合正在重建，已提交的頁面批次可查詢時再連接
+            llama_service = None
+        if latest.get('files') is not None:
+            # 已被刪除的文件不再列出（刪除全部文件不會排入新工作）
+            uploaded_files[:] = [{
+                'filename': f['filename'],
+                'original_name': f.get('original_name') or f['filename'],
+                'filepath': os.path.join(UPLOAD_FOLDER, f['filename']),
+                'upload_time': f.get('upload_time') or latest.get('created_at'),
+                'status': JOB_FILE_STATUS.get(latest.get('state'), 'processing'),
+                'sha256': f.get('sha256'),
+                'size': f.get('size'),
+                'job_id': current_job_id
+            } for f in latest['files'] if os.path.exists(os.path.join(UPLOAD_FOLDER, f['filename']))]
+            if not uploaded_files:
+                # 工作的文件都已刪除，沒有可連接的索引
+                attached_job_id = current_job_id
+    logger.info(f"採用共用的索引工作: {current_job_id}")
+
+def sync_ingestion_state():
+    """讀取 worker 回報的工作進度，完成時連接新建立的索引"""
+    global llama_service, attached_job_id
+    adopt_shared_job()
+    job_id = current_job_id
+    if not job_id or job_id == attached_job_id:
+        return None
+
+    status = ingestion_queue.get_status(job_id)
+    if not status:
+        return None
+
+    for file_info in uploaded_files:
+        if file_info.get('job_id') == job_id:
+            file_info['stage'] = status.get('stage')
+            file_info['indexed_pages'] = status.get('indexed_pages', 0)
+            file_info['total_pages'] = status.get('total_pages')
+            file_info['queryable_through'] = status.get('queryable_through')
+
+    if status['state'] == 'running' and status.get('indexed_pages') and llama_service is None:
+        # 已提交的頁面批次即可查詢，不必等整份文件索引完成
+        with initialization_lock:
+            if llama_service is None and current_job_id == job_id:
+                llama_service = pdf_service.attach_llama_index_service(UPLOAD_FOLDER, COLLECTION_NAME)
+                logger.info(f"已連接部分索引（{status['indexed_pages']}/{status.get('total_pages')} 頁）")
+    elif status['state'] == 'completed':
+        if status.get('type') == 'import_snapshot':
+            # 匯入的快照取代目前的文件集合
+            uploaded_files[:] = [{
+                'filename': f['filename'],
+                'original_name': f.get('original_name') or f['filename'],
+                'filepath': os.path.join(UPLOAD_FOLDER, f['filename']),
+                'upload_time': status.get('finished_at', time.time()),
+                'status': 'completed',
+                'sha256': f.get('sha256'),
+                'size': f.get('size'),
+                'job_id': job_id
+            } for f in (status.get('result') or {}).get('files', [])]
+        with initialization_lock:
+            if attached_job_id != job_id:
+                llama_service = pdf_service.attach_llama_index_service(UPLOAD_FOLDER, COLLECTION_NAME)
+                attached_job_id = job_id
+        for file_info in uploaded_files:
+            if file_info.get('job_id') == job_id:
+                file_info['status'] = 'completed'
+    elif status['state'] == 'error':
+        attached_job_id = job_id
+        for file_info in uploaded_files:
+            if file_info.get('job_id') == job_id:
+                file_info['status'] = 'error'
+                file_info['error'] = status.get('error')
+    return status
+
+def build_status_snapshot():
+    """組出系統狀態快照（不含時間戳，內容相同即代表狀態未變）"""
+    counts = {'processing': 0, 'completed': 0, 'error': 0}
+    files_detail = []
+    for f in uploaded_files:
+        status = f.get('status', 'unknown')
+        if status in counts:
+            counts[status] += 1
+        files_detail.append({
+            'filename': f.get('original_name', f['filename']),
+            'status': status,
+            'stage': f.get('stage'),
+            'job_id': f.get('job_id'),
+            'indexed_pages': f.get('indexed_pages'),
+            'total_pages': f.get('total_pages'),
+            'queryable_through': f.get('queryable_through'),
+            'upload_time': f['upload_time'],
+            'error': f.get('error', None)
+        })
+
+    return {
+        'query_engine_ready': llama_service is not None,
+        'total_files': len(uploaded_files),
+        'processing_files': counts['processing'],
+        'completed_files': counts['completed'],
+        'error_files': counts['error'],
+        'files_detail': files_detail,
+        'status': 'ready' if llama_service is not None else 'initializing'
+    }
+
+def notify_status_change():
+    """web 行程內的狀態變更（上傳、刪除、清空）後立即推送"""
+    return status_broadcaster.publish(build_status_snapshot())
+
+def publish_status():
+    """同步 worker 回報的進度並發布狀態快照，返回 (snapshot, etag)"""
+    sync_ingestion_state()
+    snapshot = build_status_snapshot()
+    return snapshot, status_broadcaster.publish(snapshot)
+
 def get_query_engine(upload_folder=None):
-    """獲取查詢引擎，如果未初始化則初始化"""
+    """獲取查詢引擎；索引已存在時直接連接，否則排入索引工作"""
     global llama_service
     
+    sync_ingestion_state()
     if llama_service is None:
         with initialization_lock:
             if llama_service is None:
                 logger.info("初始化 PDF 服務...")
                 try:
-                    # 使用 PDFService 創建 llama_index 服務
                     if upload_folder and os.path.exists(upload_folder):
                         pdf_files = [os.path.join(upload_folder, f) for f in os.listdir(upload_folder) 
                                    if f.lower().endswith('.pdf')]
-                        if pdf_files:
-                            llama_service = pdf_service.create_llama_index_service(upload_folder)
+                        if not pdf_files:
+                            llama_service = None
+                        elif current_job_id and current_job_id != attached_job_id:
+                            # 索引工作仍在進行中
+                            llama_service = None
+                        elif pdf_service.collection_exists(COLLECTION_NAME):
+                            llama_service = pdf_service.attach_llama_index_service(upload_folder, COLLECTION_NAME)
                         else:
+                            enqueue_index_job()
                             llama_service = None
                     else:
                         llama_service = None
@@ -81,6 +373,113 @@ def get_query_engine(upload_folder=None):
     
     return llama_service
 
+def register_upload(original_name, temp_path, sha256, size):
+    """上傳完成後的共同流程：相同內容已索引時直接沿用，否則取代現有文件並排入索引"""
+    global llama_service, uploaded_files
+
+    indexed = hash_registry.get(sha256)
+    if indexed and pdf_service.collection_exists(COLLECTION_NAME):
+        # 相同內容已在向量集合中，不重新解析或嵌入
+        upload_store.discard(temp_path)
+        metrics.incr('upload_deduplicated_total')
+        logger.info(f"文件內容已索引過，略過處理: {original_name} ({sha256[:12]})")
+        with initialization_lock:
+            if not any(f.get('sha256') == sha256 for f in uploaded_files):
+                # 由其他 worker 上傳的相同文件，補上本行程的文件紀錄
+                uploaded_files[:] = [{
+                    'filename': indexed['filename'],
+                    'original_name': indexed.get('original_name') or original_name,
+                    'filepath': os.path.join(UPLOAD_FOLDER, indexed['filename']),
+                    'upload_time': indexed.get('indexed_at', time.time()),
+                    'status': 'completed',
+                    'sha256': sha256,
+                    'size': size
+                }]
+            notify_status_change()
+        return {
+            'message': 'PDF 文件內容與已索引的文件相同，無需重新處理',
+            'filename': original_name,
+            'status': 'success',
+            'processing': False,
+            'deduplicated': True,
+            'sha256': sha256,
+            'timestamp': time.time()
+        }
+
+    with initialization_lock:
+        logger.info("清空現有上傳文件和資料集...")
+        
+        # 使用新的清理函數
+        clear_success = pdf_service.clear_uploaded_data()
+        
+        if not clear_success:
+            logger.warning("資料清空過程中發生警告，但繼續處理新文件")
+        
+        # 重置應用程式狀態
+        uploaded_files.clear()
+        llama_service = None
+        
+        logger.info("資料清空完成")
+        
+        # 將已寫入磁碟的暫存檔移入上傳目錄
+        filename = f"{int(time.time())}_{secure_filename(original_name)}"
+        os.chmod(UPLOAD_FOLDER, 0o777)
+        filepath = upload_store.promote(temp_path, filename)
+        logger.info(f"新文件保存成功: {filepath} ({size} bytes, sha256={sha256[:12]})")
+        
+        # 添加新文件到列表
+        uploaded_files.append({
+            'filename': filename,
+            'original_name': original_name,
+            'filepath': filepath,
+            'upload_time': time.time(),
+            'status': 'processing',
+            'sha256': sha256,
+            'size': size
+        })
+        
+        # 在 ingestion worker 中處理索引
+        job_id = enqueue_index_job()
+        uploaded_files[-1]['job_id'] = job_id
+        notify_status_change()
+    
+    # 立即返回成功響應，在背景處理索引
+    return {
+        'message': 'PDF 文件上傳成功，正在處理中...',
+        'filename': original_name,
+        'status': 'uploading',
+        'processing': True,
+        'job_id': job_id,
+        'sha256': sha256,
+        'timestamp': time.time()
+    }
+
+def upload_error_response(error):
+    response = jsonify({
+        'error': error.message,
+        'offset': error.offset,
+        'status': 'error'
+    })
+    response.status_code = error.status_code
+    if error.offset is not None:
+        response.headers['Upload-Offset'] = str(error.offset)
+    return response
+
+def too_large_response():
+    """請求本體超過大小上限（RequestEntityTooLarge）時回應 413，而不是落入一般錯誤處理成為 500"""
+    metrics.incr('upload_too_large_total')
+    return jsonify({
+        'error': '文件超過大小上限',
+        'status': 'error'
+    }), 413
+
+def allow_stream_body():
+    """串流 / 續傳上傳改用 STREAM_MAX_SIZE（0 為不限制），不受 multipart 的 MAX_CONTENT_LENGTH 限制
+
+    逐請求設定 request.max_content_length 需要 Flask 3.1 以上（requirements.txt 已限定版本）。
+    """
+    request.max_content_length = STREAM_MAX_SIZE or sys.maxsize
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
     """處理文件上傳 - 改進版本，支援異步處理"""
@@ -108,91 +507,28 @@ def upload_file():
                 'status': 'error'
             }), 400
         
-            # 處理上傳的PDF
+        # 處理上傳的PDF
+        temp_path = None
         try:
-            global llama_service, uploaded_files
-            
-            # 先清空現有資料
-            with initialization_lock:
-                logger.info("清空現有上傳文件和資料集...")
-                
-                # 使用新的清理函數
-                clear_success = pdf_service.clear_uploaded_data()
-                
-                if not clear_success:
-                    logger.warning("資料清空過程中發生警告，但繼續處理新文件")
-                
-                # 重置應用程式狀態
-                uploaded_files.clear()
-                llama_service = None
-                
-                logger.info("資料清空完成")
-                
-                # 現在保存新文件
-                filename = secure_filename(file.filename)
-                timestamp = str(int(time.time()))
-                filename = f"{timestamp}_{filename}"
-                filepath = os.path.join(UPLOAD_FOLDER, filename)
-                
-                # 確保上傳目錄存在
-                os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-                os.chmod(UPLOAD_FOLDER, 0o777) 
-                file.save(filepath)
-                
-                logger.info(f"新文件保存成功: {filepath}")
-                
-                # 添加新文件到列表
-                uploaded_files.append({
-                    'filename': filename,
-                    'original_name': file.filename,
-                    'filepath': filepath,
-                    'upload_time': time.time(),
-                    'status': 'processing'
-                })
-                
-                # 立即返回成功響應，在背景處理索引
-                response_data = {
-                    'message': 'PDF 文件上傳成功，正在處理中...',
-                    'filename': file.filename,
-                    'status': 'uploading',
-                    'processing': True,
-                    'timestamp': time.time()
-                }
-                
-                # 在背景線程中處理索引
-                import threading
-                def process_in_background():
-                    try:
-                        logger.info("背景處理：重新初始化 PDF 服務以包含新上傳的文件...")
-                        global llama_service
-                        # 修正：傳入目錄路徑
-                        llama_service = pdf_service.create_llama_index_service(UPLOAD_FOLDER)
-                        # 更新文件狀態
-                        if uploaded_files:
-                            uploaded_files[-1]['status'] = 'completed'
-                        logger.info("背景處理：PDF 服務重新初始化完成")
-                    except Exception as e:
-                        logger.error(f"背景處理錯誤: {e}")
-                        if uploaded_files:
-                            uploaded_files[-1]['status'] = 'error'
-                            uploaded_files[-1]['error'] = str(e)
-                
-                thread = threading.Thread(target=process_in_background)
-                thread.daemon = True
-                thread.start()
-                
-                return jsonify(response_data)
+            # 分塊寫入並同時計算 SHA-256
+            temp_path, sha256, size = upload_store.save_stream(file.stream)
+            return jsonify(register_upload(file.filename, temp_path, sha256, size))
             
+        except RequestEntityTooLarge:
+            return too_large_response()
         except Exception as e:
             logger.error(f"處理上傳文件錯誤: {e}")
             # 如果處理失敗，刪除上傳的文件
-            if 'filepath' in locals() and os.path.exists(filepath):
-                os.remove(filepath)
+            if temp_path:
+                upload_store.discard(temp_path)
             return jsonify({
                 'error': f'處理上傳的PDF文件時發生錯誤: {str(e)}',
                 'status': 'error'
             }), 500
         
+    except RequestEntityTooLarge:
+        # multipart 本體超過 MAX_CONTENT_LENGTH，在讀取 request.files 時拋出
+        return too_large_response()
     except Exception as e:
         logger.error(f"文件上傳錯誤: {e}")
         return jsonify({
@@ -200,16 +536,147 @@ def upload_file():
             'status': 'error'
         }), 500
 
+@app.route('/api/upload/stream', methods=['PUT'])
+def upload_file_stream():
+    """串流上傳：請求本體即為 PDF 內容，邊接收邊寫入磁碟並計算 SHA-256"""
+    filename = request.args.get('filename') or request.headers.get('X-Filename', '')
+    if not filename or not allowed_file(filename):
+        return jsonify({
+            'error': '只支援 PDF 文件',
+            'status': 'error'
+        }), 400
+
+    temp_path = None
+    try:
+        allow_stream_body()
+        temp_path, sha256, size = upload_store.save_stream(request.stream)
+        if size == 0:
+            upload_store.discard(temp_path)
+            return jsonify({
+                'error': '上傳內容為空',
+                'status': 'error'
+            }), 400
+        return jsonify(register_upload(filename, temp_path, sha256, size))
+    except UploadError as e:
+        return upload_error_response(e)
+    except RequestEntityTooLarge:
+        return too_large_response()
+    except Exception as e:
+        logger.error(f"串流上傳錯誤: {e}")
+        if temp_path:
+            upload_store.discard(temp_path)
+        return jsonify({
+            'error': f'文件上傳失敗: {str(e)}',
+            'status': 'error'
+        }), 500
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload_session():
+    """建立可續傳的上傳工作，之後以 PATCH /api/uploads/<upload_id> 分段送出"""
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename', '')
+    if not filename or not allowed_file(filename):
+        return jsonify({
+            'error': '只支援 PDF 文件',
+            'status': 'error'
+        }), 400
+    if STREAM_MAX_SIZE and int(data.get('size') or 0) > STREAM_MAX_SIZE:
+        return jsonify({
+            'error': '文件超過大小上限',
+            'status': 'error'
+        }), 413
+
+    try:
+        session = upload_store.create_session(filename, int(data.get('size') or 0))
+    except (UploadError, ValueError) as e:
+        return upload_error_response(e if isinstance(e, UploadError) else UploadError('無效的檔案大小'))
+
+    response = jsonify({**session, 'status': 'success'})
+    response.status_code = 201
+    response.headers['Location'] = f"/api/uploads/{session['upload_id']}"
+    response.headers['Upload-Offset'] = '0'
+    response.headers['Upload-Length'] = str(session['size'])
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['HEAD', 'GET'])
+def get_upload_session(upload_id):
+    """查詢續傳工作目前已接收的位移量"""
+    try:
+        session = upload_store.get_session(upload_id)
+    except UploadError as e:
+        return upload_error_response(e)
+    if session is None:
+        return jsonify({
+            'error': '上傳工作不存在或已過期',
+            'status': 'error'
+        }), 404
+
+    response = jsonify({**session, 'status': 'success'})
+    response.headers['Upload-Offset'] = str(session['offset'])
+    response.headers['Upload-Length'] = str(session['size'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+def append_upload_session(upload_id):
+    """從 Upload-Offset 繼續寫入；收到全部位元組後開始索引"""
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({
+            'error': '缺少或無效的 Upload-Offset',
+            'status': 'error'
+        }), 400
+
+    try:
+        allow_stream_body()
+        session = upload_store.append(upload_id, offset, request.stream)
+        result = {**session, 'complete': session['offset'] == session['size'], 'status': 'success'}
+        if result['complete']:
+            session, temp_path, sha256 = upload_store.complete(upload_id)
+            result.update(register_upload(session['filename'], temp_path, sha256, session['size']))
+        response = jsonify(result)
+        response.headers['Upload-Offset'] = str(result['offset'])
+        return response
+    except UploadError as e:
+        return upload_error_response(e)
+    except RequestEntityTooLarge:
+        return too_large_response()
+    except Exception as e:
+        logger.error(f"續傳上傳錯誤: {e}")
+        return jsonify({
+            'error': f'文件上傳失敗: {str(e)}',
+            'status': 'error'
+        }), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload_session(upload_id):
+    """取消續傳工作並刪除已接收的內容"""
+    try:
+        upload_store.cancel(upload_id)
+    except UploadError as e:
+        return upload_error_response(e)
+    return jsonify({
+        'message': '上傳工作已取消',
+        'status': 'success'
+    })
+
 @app.route('/api/files', methods=['GET'])
 def list_files():
     """列出所有上傳的文件"""
     try:
+        sync_ingestion_state()
         files_info = []
         for file_info in uploaded_files:
             files_info.append({
                 'filename': file_info.get('original_name', file_info['filename']),
+                'file_id': file_info.get('sha256'),
                 'upload_time': file_info['upload_time'],
                 'status': file_info.get('status', 'completed'),
+                'stage': file_info.get('stage'),
+                'job_id': file_info.get('job_id'),
+                'indexed_pages': file_info.get('indexed_pages'),
+                'total_pages': file_info.get('total_pages'),
                 'error': file_info.get('error', None)
             })
         
@@ -229,26 +696,17 @@ def list_files():
 def get_status():
     """獲取系統狀態和處理進度"""
     try:
-        # 檢查是否有文件正在處理
-        processing_files = [f for f in uploaded_files if f.get('status') == 'processing']
-        completed_files = [f for f in uploaded_files if f.get('status') == 'completed']
-        error_files = [f for f in uploaded_files if f.get('status') == 'error']
-        
-        return jsonify({
-            'query_engine_ready': llama_service is not None,
-            'total_files': len(uploaded_files),
-            'processing_files': len(processing_files),
-            'completed_files': len(completed_files),
-            'error_files': len(error_files),
-            'files_detail': [{
-                'filename': f.get('original_name', f['filename']),
-                'status': f.get('status', 'unknown'),
-                'upload_time': f['upload_time'],
-                'error': f.get('error', None)
-            } for f in uploaded_files],
-            'status': 'ready' if llama_service is not None else 'initializing',
-            'timestamp': time.time()
-        })
+        snapshot, etag = publish_status()
+        
+        # 狀態未變時回傳 304，不重新序列化文件詳情
+        if etag in request.if_none_match:
+            metrics.incr('status_not_modified_total')
+            return Response(status=304, headers={'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'})
+        
+        response = jsonify({**snapshot, 'timestamp': time.time()})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         logger.error(f"獲取狀態錯誤: {e}")
         return jsonify({
@@ -256,6 +714,19 @@ def get_status():
             'status': 'error'
         }), 500
 
+@app.route('/api/status/stream', methods=['GET'])
+def stream_status():
+    """以 SSE 推送系統狀態，只在狀態變化時送出事件"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id', '')
+    last_version = status_broadcaster.resume_version(last_event_id)
+
+    publish_status()
+    return Response(
+        status_broadcaster.subscribe(last_version),
+        mimetype='text/event-stream',
+        headers=SSE_HEADERS
+    )
+
 @app.route('/api/files/<filename>', methods=['DELETE'])
 def delete_file(filename):
     """刪除上傳的文件"""
@@ -288,9 +759,13 @@ def delete_file(filename):
             logger.info("重新初始化 PDF 服務...")
             llama_service = None  # 重置服務
             if uploaded_files:
-                # 如果還有其他文件，重新初始化整個上傳目錄
-                llama_service = pdf_service.create_llama_index_service(UPLOAD_FOLDER)
-            logger.info("PDF 服務重新初始化完成")
+                # 如果還有其他文件，由 ingestion worker 重建整個上傳目錄的索引
+                job_id = enqueue_index_job()
+                for file_info in uploaded_files:
+                    file_info['status'] = 'processing'
+                    file_info['job_id'] = job_id
+            logger.info("PDF 服務重新初始化已排程")
+            notify_status_change()
         
         logger.info(f"文件刪除成功: {filename}")
         
@@ -321,6 +796,8 @@ def clear_all():
             # 重置應用程式狀態
             uploaded_files.clear()
             llama_service = None
+            hash_registry.clear()
+            notify_status_change()
             
             if clear_success:
                 logger.info("所有資料清空成功")
@@ -353,6 +830,226 @@ def status_check():
         'timestamp': time.time()
     })
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """獲取服務指標"""
+    return jsonify({
+        'metrics': metrics.snapshot(),
+        'status': 'success',
+        'timestamp': time.time()
+    })
+
+def parse_search_request(data, batch, field='queries', limit=None):
+    """驗證檢索請求；返回 (queries, top_k, mode, query_filter)，格式錯誤時拋出 ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError('請求內容必須是 JSON 物件')
+    if batch:
+        queries = data.get(field)
+        limit = limit or search_config['max_batch_queries']
+        if not isinstance(queries, list) or not queries:
+            raise ValueError(f'{field} 必須是非空的列表')
+        if len(queries) > limit:
+            raise ValueError(f"{field} 最多 {limit} 個")
+    else:
+        queries = [data.get('query')]
+    if not all(isinstance(q, str) and q.strip() for q in queries):
+        raise ValueError('查詢內容不能為空')
+    queries = [q.strip() for q in queries]
+    if any(len(q) > search_config['max_query_chars'] for q in queries):
+        raise ValueError(f"單一查詢最多 {search_config['max_query_chars']} 個字元")
+
+    top_k = data.get('top_k', search_config['top_k'])
+    if not isinstance(top_k, int) or isinstance(top_k, bool) or not 1 <= top_k <= search_config['max_top_k']:
+        raise ValueError(f"top_k 必須是 1 到 {search_config['max_top_k']} 之間的整數")
+    mode = data.get('mode', search_config['mode'])
+    if mode not in ('hybrid', 'dense'):
+        raise ValueError('mode 必須是 hybrid 或 dense')
+    return queries, top_k, mode, parse_request_filter(data)
+
+def serialize_search_hit(hit):
+    node = hit.node
+    return {
+        'id': node.node_id,
+        'score': hit.score,
+        'text': node.get_content(),
+        'file_id': node.metadata.get(DOC_ID_KEY),
+        'file_name': node.metadata.get('file_name'),
+        'page_number': node.metadata.get(PAGE_NUMBER_KEY),
+        'page_label': node.metadata.get('page_label'),
+        'metadata': node.metadata
+    }
+
+def run_search(batch):
+    """/api/search 與 /api/search/batch 共用：只做檢索，不呼叫 LLM"""
+    try:
+        queries, top_k, mode, query_filter = parse_search_request(request.get_json(silent=True), batch)
+    except ValueError as e:
+        return jsonify({
+            'error': str(e),
+            'status': 'error'
+        }), 400
+
+    try:
+        engine = get_query_engine(upload_folder=UPLOAD_FOLDER)
+        if engine is None or engine.get('mode') != 'full':
+            return jsonify({
+                'error': '索引尚未就緒，請先上傳文件',
+                'status': 'error'
+            }), 503
+
+        # 查詢嵌入與 ingestion 的嵌入批次共用配額，取得互動優先權名額
+        start = time.perf_counter()
+        with pdf_service.scheduler.slot(INTERACTIVE):
+            results = engine['processor'].search(queries, top_k, query_filter, mode, search_config['alpha'])
+        took_ms = (time.perf_counter() - start) * 1000
+        metrics.incr('search_requests_total')
+        metrics.incr('search_queries_total', len(queries))
+        metrics.observe('search_latency_ms', took_ms)
+    except AdmissionRejected as e:
+        logger.warning(f"檢索請求被拒絕: {e}")
+        return admission_rejected_response(e)
+    except Exception as e:
+        logger.error(f"檢索失敗: {e}")
+        return jsonify({
+            'error': f'檢索失敗: {str(e)}',
+            'status': 'error'
+        }), 500
+
+    if batch:
+        return jsonify({
+            'results': [{'query': query, 'hits': [serialize_search_hit(hit) for hit in hits]}
+                        for query, hits in zip(queries, results)],
+            'took_ms': round(took_ms, 1),
+            'status': 'success'
+        })
+    return jsonify({
+        'query': queries[0],
+        'hits': [serialize_search_hit(hit) for hit in results[0]],
+        'took_ms': round(took_ms, 1),
+        'status': 'success'
+    })
+
+@app.route('/api/search', methods=['POST'])
+def search():
+    """純檢索：返回前 top_k 個段落與分數、metadata"""
+    return run_search(batch=False)
+
+@app.route('/api/search/batch', methods=['POST'])
+def search_batch():
+    """批次檢索：所有查詢一次批次嵌入，並合併為一次 Qdrant query_batch_points 請求"""
+    return run_search(batch=True)
+
+@app.route('/api/answer/batch', methods=['POST'])
+def answer_batch():
+    """批次問答：共用批次檢索並在提供者並發上限內並行生成，每完成一題輸出一行 NDJSON"""
+    try:
+        questions, top_k, mode, query_filter = parse_search_request(
+            request.get_json(silent=True), True, 'questions', search_config['max_batch_questions'])
+    except ValueError as e:
+        return jsonify({
+            'error': str(e),
+            'status': 'error'
+        }), 400
+
+    engine = get_query_engine(upload_folder=UPLOAD_FOLDER)
+    if engine is None or engine.get('mode') != 'full':
+        return jsonify({
+            'error': '索引尚未就緒，請先上傳文件',
+            'status': 'error'
+        }), 503
+
+    answerer = BatchAnswerer(
+        engine['processor'],
+        pdf_service.admission,
+        search_config['answer_concurrency'],
+        queue_timeout=search_config['answer_queue_timeout'],
+        scheduler=pdf_service.scheduler
+    )
+
+    def generate():
+        logger.info(f"開始批次問答: {len(questions)} 題")
+        try:
+            for event in answerer.run(questions, top_k, query_filter, mode, search_config['alpha']):
+                yield json.dumps(event, ensure_ascii=False) + '\n'
+        except Exception as e:
+            logger.error(f"批次問答失敗: {e}")
+            yield json.dumps({'type': 'error', 'error': str(e)}, ensure_ascii=False) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/api/summarize/stream', methods=['POST'])
+def summarize_stream():
+    """整份文件的 map-reduce 摘要，以 SSE 回報各階段進度並串流最終摘要"""
+    data = request.get_json(silent=True) or {}
+    file_value = data.get('file')
+    if not isinstance(file_value, str) or not file_value.strip():
+        return jsonify({
+            'error': '缺少要摘要的文件（file_id 或檔名）',
+            'status': 'error'
+        }), 400
+    instruction = data.get('instruction') or data.get('question')
+    if instruction is not None and not isinstance(instruction, str):
+        return jsonify({
+            'error': 'instruction 必須是字串',
+            'status': 'error'
+        }), 400
+
+    file_value = file_value.strip()
+    doc_id = resolve_file_id(file_value.lower()) or resolve_file_id(file_value)
+    if doc_id is None:
+        return jsonify({
+            'error': f'找不到文件: {file_value}',
+            'status': 'error'
+        }), 404
+
+    engine = get_query_engine(upload_folder=UPLOAD_FOLDER)
+    if engine is None or engine.get('mode') != 'full':
+        return jsonify({
+            'error': '索引尚未就緒，請先上傳文件',
+            'status': 'error'
+        }), 503
+
+    summarizer = DocumentSummarizer(
+        engine['processor'],
+        pdf_service.admission,
+        summary_cache,
+        summarize_config,
+        scheduler=pdf_service.scheduler
+    )
+
+    def generate():
+        completed = False
+        metrics.incr('summarize_started_total')
+        coalescer = TokenCoalescer(stream_config['flush_interval_ms'], stream_config['flush_max_bytes'])
+        try:
+            logger.info(f"開始文件摘要: {doc_id[:12]}")
+            # 最終回答的分塊依時間窗合併，進度事件會先送出已緩衝的文字
+            for item in coalesce(summarizer.summarize(doc_id, instruction), coalescer,
+                                 lambda event: event.get('chunk')):
+                if isinstance(item, str):
+                    yield sse_encoder.chunk(item)
+                else:
+                    yield sse_encoder.event({'status': 'progress', **item})
+            completed = True
+            yield sse_encoder.complete_event
+        except AdmissionRejected as e:
+            logger.warning(f"文件摘要被拒絕: {e}")
+            yield sse_encoder.error(f'服務繁忙（{e.reason}），請稍後再試')
+        except Exception as e:
+            logger.error(f"文件摘要失敗: {e}")
+            yield sse_encoder.error(f'文件摘要失敗: {str(e)}')
+        finally:
+            if completed:
+                metrics.incr('summarize_completed_total')
+
+    # 摘要可能耗時數分鐘，沿用串流註冊表，斷線後可用 Last-Event-ID 續傳
+    stream = stream_registry.create(generate())
+    return Response(
+        stream_registry.subscribe(stream),
+        mimetype='text/event-stream',
+        headers={**SSE_HEADERS, 'X-Stream-Id': stream.stream_id}
+    )
+
 @app.route('/api/chat/stream', methods=['POST'])
 def chat_stream():
     """處理流式聊天請求"""
@@ -372,7 +1069,28 @@ def chat_stream():
                 'error': '訊息內容不能為空'
             }), 400
         
+        try:
+            query_filter = parse_request_filter(data)
+        except QueryFilterError as e:
+            return jsonify({
+                'error': f'過濾條件錯誤: {e}',
+                'status': 'error'
+            }), 400
+        
+        # RAG 查詢由 LlamaIndex 的 Gemini 生成，先取得提供者並發名額，
+        # 再取得互動優先權名額（與 ingestion 的嵌入批次共用配額）
+        ticket = pdf_service.admission.acquire('gemini')
+        try:
+            priority_ticket = pdf_service.scheduler.acquire(INTERACTIVE)
+        except AdmissionRejected:
+            ticket.release()
+            raise
+
         def generate():
+            response = None
+            completed = False
+            metrics.incr('chat_stream_started_total')
+            metrics.add_gauge('chat_stream_active', 1)
             try:
                 logger.info(f"開始流式聊天處理: {user_message}")
                 
@@ -380,22 +1098,19 @@ def chat_stream():
                 engine = get_query_engine(upload_folder=UPLOAD_FOLDER)
                 if engine is None:
                     logger.warning("PDF 服務未初始化")
-                    error_data = json.dumps({'error': 'PDF 服務未初始化，請先上傳文件', 'status': 'error'}, ensure_ascii=False)
-                    yield f"data: {error_data}\n\n"
-                    sys.stdout.flush()
+                    yield sse_encoder.error('PDF 服務未初始化，請先上傳文件')
                     return
                 
                 # 執行查詢
                 logger.info(f"處理流式查詢: {user_message}")
-                response = pdf_service.query_with_llama_index(engine, user_message)
+                response = pdf_service.query_with_llama_index(engine, user_message, query_filter=query_filter,
+                                                            admission_ticket=ticket)
                 logger.info(f"查詢響應類型: {type(response)}")
                 
                 # 檢查是否有回應
                 if response is None:
                     logger.warning("查詢返回 None")
-                    error_data = json.dumps({'error': '查詢失敗，沒有收到回應', 'status': 'error'}, ensure_ascii=False)
-                    yield f"data: {error_data}\n\n"
-                    sys.stdout.flush()
+                    yield sse_encoder.error('查詢失敗，沒有收到回應')
                     return
                 
                 # 處理不同類型的響應格式
@@ -407,32 +1122,23 @@ def chat_stream():
                     # 處理 LlamaIndex StreamingResponse
                     logger.info("檢測到 StreamingResponse，使用流式回應生成器")
                     try:
-                        for chunk in response.response_gen:
-                            if chunk and str(chunk).strip():
-                                chunk_data = json.dumps({'chunk': str(chunk), 'status': 'streaming'}, ensure_ascii=False)
-                                logger.debug(f"流式發送分塊: {str(chunk)[:50]}...")
-                                yield f"data: {chunk_data}\n\n"
-                                sys.stdout.flush()
+                        # 依時間窗 / 位元組上限合併小分塊，第一個分塊立即送出；上游暫停時緩衝文字仍依時間窗送出
+                        coalescer = TokenCoalescer(stream_config['flush_interval_ms'], stream_config['flush_max_bytes'])
+                        for text in coalesce(response.response_gen, coalescer):
+                            yield sse_encoder.chunk(text)
                         
                         # 嘗試獲取來源資訊
-                        if hasattr(response, 'source_nodes') and response.source_nodes:
-                            source_text = "\n\n📖 參考來源："
-                            for i, node in enumerate(response.source_nodes[:3], 1):
-                                if hasattr(node, 'metadata') and 'file_name' in node.metadata:
-                                    file_name = node.metadata['file_name']
-                                    # 清理文件名
-                                    if '_' in file_name and file_name.split('_')[0].isdigit():
-                                        file_name = '_'.join(file_name.split('_')[1:])
-                                    source_text += f"\n{i}. {file_name}"
-                            
-                            source_data = json.dumps({'chunk': source_text, 'status': 'sources'}, ensure_ascii=False)
-                            yield f"data: {source_data}\n\n"
-                            sys.stdout.flush()
+                        source_text = build_source_text(response)
+                        if source_text:
+                            yield sse_encoder.chunk(source_text, 'sources')
+                        context_event = build_context_event(response)
+                        if context_event:
+                            yield sse_encoder.event(context_event)
                         
                         # 流式響應完成後，發送完成信號
                         logger.info("流式響應完成，發送完成信號")
-                        yield f"data: {json.dumps({'status': 'complete'}, ensure_ascii=False)}\n\n"
-                        sys.stdout.flush()
+                        completed = True
+                        yield sse_encoder.complete_event
                         return
                     except Exception as gen_error:
                         logger.error(f"流式生成器錯誤: {gen_error}")
@@ -442,6 +1148,9 @@ def chat_stream():
                     # 處理對象格式的響應
                     response_obj = response.response
                     if response_obj and str(response_obj) != 'None' and str(response_obj).strip():
+                        # RAG 生成已結束；聊天服務會取得所選提供者的名額，先歸還這裡的 gemini 名額，
+                        # 避免同一請求巢狀持有兩個名額，並發滿載時互相等待到逾時
+                        ticket.release()
                         response_text = chat_stream_service.chat(user_message, model)
                     else:
                         response_text = "抱歉，無法在 PDF 文件中找到相關資訊。請嘗試使用不同的關鍵字或問題。"
@@ -462,10 +1171,7 @@ def chat_stream():
                 for i in range(0, len(words), chunk_size):
                     chunk = ' '.join(words[i:i+chunk_size])
                     if chunk.strip():
-                        chunk_data = json.dumps({'chunk': chunk + ' ', 'status': 'streaming'}, ensure_ascii=False)
-                        logger.debug(f"發送分塊 {i//chunk_size + 1}: {chunk[:50]}...")
-                        yield f"data: {chunk_data}\n\n"
-                        sys.stdout.flush()
+                        yield sse_encoder.chunk(chunk + ' ')
                         time.sleep(0.05)  # 小延遲模擬打字效果
                 
                 # 發送來源資訊
@@ -478,9 +1184,7 @@ def chat_stream():
                             clean_name = '_'.join(source_file.split('_')[1:])
                         source_text += f"\n{i}. {clean_name}"
                     
-                    source_data = json.dumps({'chunk': source_text, 'sources': source_files, 'status': 'sources'}, ensure_ascii=False)
-                    yield f"data: {source_data}\n\n"
-                    sys.stdout.flush()
+                    yield sse_encoder.event({'chunk': source_text, 'sources': source_files, 'status': 'sources'})
                 elif hasattr(response, 'source_info') and response.source_info:
                     sources = response.source_info[:1]  # 只顯示前1個來源
                     source_text = "\n\n📖 參考來源："
@@ -490,33 +1194,48 @@ def chat_stream():
                         score = source.get('score', 0.0)
                         source_text += f"\n{i}. {file_name} - 第 {page} 頁 (相關度: {score:.2f})"
                     
-                    source_data = json.dumps({'chunk': source_text, 'sources': sources, 'status': 'sources'}, ensure_ascii=False)
-                    yield f"data: {source_data}\n\n"
-                    sys.stdout.flush()
+                    yield sse_encoder.event({'chunk': source_text, 'sources': sources, 'status': 'sources'})
                 
                 # 發送完成信號
                 logger.info("發送流式響應完成信號")
-                yield f"data: {json.dumps({'status': 'complete'}, ensure_ascii=False)}\n\n"
-                sys.stdout.flush()
+                completed = True
+                yield sse_encoder.complete_event
                 
+            except GeneratorExit:
+                # 客戶端關閉分頁或寫入失敗時，WSGI 伺服器會關閉此生成器
+                if not completed:
+                    logger.info("客戶端已斷線，取消上游 LLM 生成")
+                    metrics.incr('chat_stream_cancelled_total')
+                raise
             except Exception as e:
                 logger.error(f"流式聊天處理錯誤: {e}")
-                error_data = json.dumps({'error': f'處理請求時發生錯誤: {str(e)}', 'status': 'error'}, ensure_ascii=False)
-                yield f"data: {error_data}\n\n"
-                sys.stdout.flush()
+                metrics.incr('chat_stream_error_total')
+                yield sse_encoder.error(f'處理請求時發生錯誤: {str(e)}')
+            finally:
+                metrics.add_gauge('chat_stream_active', -1)
+                if completed:
+                    metrics.incr('chat_stream_completed_total')
+                # 釋放上游串流（Gemini 連線與 greenlet）
+                close_upstream(response)
+                priority_ticket.release()
+                ticket.release()
         
+        # 生成在背景進行並寫入重播緩衝，客戶端斷線後可用 Last-Event-ID 續傳
+        try:
+            stream = stream_registry.create(generate(), on_abort=(priority_ticket.release, ticket.release))
+        except Exception:
+            priority_ticket.release()
+            ticket.release()
+            raise
         return Response(
-            generate(),
+            stream_registry.subscribe(stream),
             mimetype='text/event-stream',
-            headers={
-                'Cache-Control': 'no-cache',
-                'Connection': 'keep-alive',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'X-Accel-Buffering': 'no'  # 關閉 nginx 緩衝
-            }
+            headers={**SSE_HEADERS, 'X-Stream-Id': stream.stream_id}
         )
         
+    except AdmissionRejected as e:
+        logger.warning(f"流式聊天請求被拒絕: {e}")
+        return admission_rejected_response(e)
     except Exception as e:
         logger.error(f"流式聊天初始化錯誤: {e}")
         return jsonify({
@@ -524,6 +1243,150 @@ def chat_stream():
             'status': 'error'
         }), 500
 
+@app.route('/api/chat/stream/<stream_id>', methods=['GET'])
+def resume_chat_stream(stream_id):
+    """以 Last-Event-ID 續傳中斷的流式聊天"""
+    stream = stream_registry.get(stream_id)
+    if stream is None:
+        return jsonify({
+            'error': '串流不存在或已過期，請重新提問',
+            'status': 'error'
+        }), 404
+
+    # Last-Event-ID 格式為 <stream_id>:<seq>
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id', '')
+    try:
+        last_seq = int(last_event_id.rsplit(':', 1)[-1]) if last_event_id else 0
+    except ValueError:
+        return jsonify({
+            'error': '無效的 Last-Event-ID',
+            'status': 'error'
+        }), 400
+
+    logger.info(f"續傳串流 {stream_id}，從事件 {last_seq} 之後開始")
+    metrics.incr('chat_stream_resumed_total')
+    return Response(
+        stream_registry.subscribe(stream, last_seq),
+        mimetype='text/event-stream',
+        headers={**SSE_HEADERS, 'X-Stream-Id': stream.stream_id}
+    )
+
+# 管理 API 會匯出資料、刪除並重建正在使用的集合，需要管理權杖
+admin_config = config_manager.get_admin_config()
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+
+def require_admin(view):
+    """設定 [Admin] TOKEN 時需帶 Authorization: Bearer <TOKEN>；未設定時只接受本機發出的請求"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = admin_config['token']
+        if token:
+            supplied = request.headers.get('Authorization', '')
+            scheme, _, credentials = supplied.partition(' ')
+            if scheme.lower() != 'bearer' or not hmac.compare_digest(credentials.strip().encode('utf-8'),
+                                                                     token.encode('utf-8')):
+                metrics.incr('admin_unauthorized_total')
+                return jsonify({
+                    'error': '需要管理權杖',
+                    'status': 'error'
+                }), 401, {'WWW-Authenticate': 'Bearer'}
+        elif request.remote_addr not in LOOPBACK_ADDRESSES:
+            metrics.incr('admin_unauthorized_total')
+            return jsonify({
+                'error': '未設定管理權杖，管理 API 只接受本機請求',
+                'status': 'error'
+            }), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/api/admin/snapshots', methods=['GET'])
+@require_admin
+def list_snapshots():
+    """列出可匯入的索引快照"""
+    return jsonify({
+        'snapshots': snapshot_manager.list_snapshots(),
+        'status': 'success'
+    })
+
+@app.route('/api/admin/snapshots', methods=['POST'])
+@require_admin
+def export_snapshot():
+    """匯出索引快照（Qdrant 點位、解析節點、文件清單與嵌入模型指紋）"""
+    data = request.get_json(silent=True) or {}
+    name = data.get('name')
+    if name is not None and secure_filename(name) != name:
+        return jsonify({
+            'error': f'無效的快照名稱: {name}',
+            'status': 'error'
+        }), 400
+
+    job_id = ingestion_queue.enqueue('export_snapshot', {
+        'upload_folder': UPLOAD_FOLDER,
+        'collection_name': COLLECTION_NAME,
+        'name': name,
+        'include_uploads': data.get('include_uploads', True)
+    })
+    logger.info(f"已排入快照匯出工作: {job_id}")
+    return jsonify({
+        'message': '快照匯出已排程',
+        'job_id': job_id,
+        'status': 'success'
+    }), 202
+
+@app.route('/api/admin/snapshots/<name>/import', methods=['POST'])
+@require_admin
+def import_snapshot(name):
+    """匯入索引快照，完成後直接連接集合，不需解析或嵌入"""
+    global llama_service, current_job_id
+    try:
+        manifest = snapshot_manager.read_manifest(name)
+    except SnapshotError as e:
+        return jsonify({
+            'error': str(e),
+            'status': 'error'
+        }), 400
+    if manifest is None:
+        return jsonify({
+            'error': f'快照不存在或不完整: {name}',
+            'status': 'error'
+        }), 404
+
+    data = request.get_json(silent=True) or {}
+    with initialization_lock:
+        llama_service = None
+        hash_registry.clear()
+        current_job_id = ingestion_queue.enqueue('import_snapshot', {
+            'upload_folder': UPLOAD_FOLDER,
+            'collection_name': COLLECTION_NAME,
+            'name': name,
+            'force': bool(data.get('force', False))
+        })
+        for file_info in uploaded_files:
+            file_info['status'] = 'processing'
+            file_info['job_id'] = current_job_id
+        notify_status_change()
+
+    logger.info(f"已排入快照匯入工作: {current_job_id}")
+    return jsonify({
+        'message': '快照匯入已排程',
+        'job_id': current_job_id,
+        'points': manifest['points'],
+        'files': len(manifest['files']),
+        'status': 'success'
+    }), 202
+
+@app.route('/api/admin/jobs/<job_id>', methods=['GET'])
+@require_admin
+def get_job_status(job_id):
+    """查詢 ingestion worker 工作（索引、快照匯出 / 匯入）的進度"""
+    status = ingestion_queue.get_status(job_id)
+    if status is None:
+        return jsonify({
+            'error': '工作不存在',
+            'status': 'error'
+        }), 404
+    return jsonify({**status, 'status': 'success'})
+
 @app.route('/api/initialize', methods=['POST'])
 def initialize():
     """手動初始化 PDF 服務"""
@@ -533,9 +1396,14 @@ def initialize():
         with initialization_lock:
             logger.info("手動初始化 PDF 服務...")
             if uploaded_files:
-                # 修正：傳入目錄路徑
-                llama_service = pdf_service.create_llama_index_service(UPLOAD_FOLDER)
-                logger.info("PDF 服務初始化完成")
+                # 由 ingestion worker 重建索引
+                llama_service = None
+                job_id = enqueue_index_job()
+                for file_info in uploaded_files:
+                    file_info['status'] = 'processing'
+                    file_info['job_id'] = job_id
+                logger.info("PDF 服務初始化已排程")
+                notify_status_change()
             else:
                 logger.warning("沒有上傳的文件，無法初始化 PDF 服務")
                 return jsonify({
@@ -544,8 +1412,10 @@ def initialize():
                 }), 400
         
         return jsonify({
-            'message': 'PDF 服務初始化成功',
+            'message': 'PDF 服務初始化中，索引完成後即可查詢',
             'status': 'success',
+            'processing': True,
+            'job_id': job_id,
             'timestamp': time.time()
         })
         
@@ -559,5 +1429,10 @@ def initialize():
 if __name__ == '__main__':
     # 啟動時不自動初始化，等待第一次請求時初始化
     logger.info("啟動 Flask 應用...")
+    if ingestion_config['mode'] == 'process':
+        ingestion_process = start_worker_process("config.ini", ingestion_config['job_dir'],
+                                                 ingestion_config['poll_interval'])
+        # worker 不是 daemon 行程，開發伺服器結束時一併停止
+        atexit.register(ingestion_process.terminate)
     debug_mode = app_config.get('flask_debug', False)  # 預設為 True
     app.run(debug=debug_mode, host='0.0.0.0', port=app_config['port_backend'], threaded=True)
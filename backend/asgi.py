@@ -0,0 +1,264 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from app import (
+    app as flask_app,
+    get_query_engine,
+    parse_request_filter,
+    build_source_text,
+    build_context_event,
+    pdf_service,
+    chat_stream_service,
+    publish_status,
+    status_broadcaster,
+    stream_registry,
+    stream_config,
+    sse_encoder,
+    SSE_HEADERS,
+    UPLOAD_FOLDER
+)
+from service.admission import AdmissionRejected
+from service.priority_scheduler import INTERACTIVE
+from service.metrics import metrics
+from service.query_filters import QueryFilterError
+from service.sse import TokenCoalescer, acoalesce
+
+logger = logging.getLogger(__name__)
+
+# 其餘 /api/* 路由沿用 Flask 實作，每個請求在 a2wsgi 的執行緒池中佔用一個執行緒直到回應結束；
+# 預設只有 10 個執行緒，數個長時間的上傳或摘要串流就會讓所有 Flask 路由排隊，因此明確設定池大小
+wsgi_app = WSGIMiddleware(flask_app, workers=stream_config['wsgi_workers'])
+
+# 准入等待、索引初始化等阻塞呼叫使用專屬執行緒池，不與 asyncio 預設的小型執行緒池（CPU 數 + 4）搶執行緒；
+# 同時阻塞的呼叫最多為准入佇列長度，加上已取得名額後等待排程與執行查詢的請求
+_gate = pdf_service.admission.gate('gemini')
+blocking_executor = ThreadPoolExecutor(
+    max_workers=_gate.max_queue + 2 * _gate.max_concurrency,
+    thread_name_prefix='asgi-blocking'
+)
+
+
+async def run_blocking(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(
+        blocking_executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+def _release_result(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().release()
+
+
+async def acquire_ticket(acquire, *args):
+    """在執行緒中取得名額；等待中的請求被取消時，執行緒之後取得的名額會立即歸還，不會遺失"""
+    future = asyncio.get_running_loop().run_in_executor(blocking_executor, acquire, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(_release_result)
+        raise
+
+
+def parse_last_event_id(request: Request) -> str:
+    return request.headers.get('Last-Event-ID') or request.query_params.get('last_event_id', '')
+
+
+class AsyncChatStream:
+    """ASGI 原生的 /api/chat/stream，以 asyncio 取代 gevent 處理 LLM 串流"""
+
+    async def __call__(self, scope, receive, send):
+        # CORS 預檢等非 POST 請求交給 Flask 處理
+        if scope.get('method') != 'POST':
+            await wsgi_app(scope, receive, send)
+            return
+
+        request = Request(scope, receive)
+        response = await self.handle(request)
+        await response(scope, receive, send)
+
+    async def handle(self, request: Request):
+        try:
+            data = await request.json()
+        except Exception:
+            data = None
+
+        if not data or 'message' not in data:
+            return JSONResponse({'error': '缺少必要的訊息內容'}, status_code=400)
+
+        user_message = data['message'].strip()
+        if not user_message:
+            return JSONResponse({'error': '訊息內容不能為空'}, status_code=400)
+
+        try:
+            query_filter = parse_request_filter(data)
+        except QueryFilterError as e:
+            return JSONResponse({'error': f'過濾條件錯誤: {e}', 'status': 'error'}, status_code=400)
+
+        try:
+            ticket = await acquire_ticket(pdf_service.admission.acquire, 'gemini')
+            try:
+                priority_ticket = await acquire_ticket(pdf_service.scheduler.acquire, INTERACTIVE)
+            except BaseException:
+                ticket.release()
+                raise
+        except AdmissionRejected as e:
+            logger.warning(f"流式聊天請求被拒絕: {e}")
+            return JSONResponse({
+                'error': f'服務繁忙（{e.reason}），請稍後再試',
+                'provider': e.provider,
+                'retry_after': e.retry_after,
+                'status': 'error'
+            }, status_code=e.status_code, headers={'Retry-After': str(e.retry_after)})
+
+        # 生成在背景 Task 中進行並寫入重播緩衝，客戶端斷線後可用 Last-Event-ID 續傳
+        try:
+            stream = stream_registry.create_async(
+                self.generate(user_message, ticket, priority_ticket, query_filter),
+                on_abort=(priority_ticket.release, ticket.release)
+            )
+        except Exception:
+            priority_ticket.release()
+            ticket.release()
+            raise
+        return StreamingResponse(
+            stream_registry.asubscribe(stream),
+            media_type='text/event-stream',
+            headers={**SSE_HEADERS, 'X-Stream-Id': stream.stream_id}
+        )
+
+    async def generate(self, user_message, ticket, priority_ticket, query_filter=None):
+        response_gen = None
+        completed = False
+        metrics.incr('chat_stream_started_total')
+        metrics.add_gauge('chat_stream_active', 1)
+        try:
+            logger.info(f"開始非同步流式聊天處理: {user_message}")
+
+            # 索引初始化為同步且可能耗時，放到 worker thread
+            engine = await run_blocking(get_query_engine, UPLOAD_FOLDER)
+            if engine is None:
+                yield sse_encoder.error('PDF 服務未初始化，請先上傳文件')
+                return
+
+            if engine.get('mode') != 'full':
+                # 純聊天或錯誤模式沿用同步實作的回覆
+                answer = await run_blocking(pdf_service.query_with_llama_index, engine, user_message,
+                                            query_filter=query_filter)
+                yield sse_encoder.chunk(str(answer))
+                completed = True
+                yield sse_encoder.complete_event
+                return
+
+            # 檢索後以非同步串流生成；response 帶有來源節點，供來源與上下文事件使用
+            response = await engine['processor'].aprepare_generation(user_message, query_filter)
+            if chat_stream_service.router is not None:
+                # 啟用路由時主提供者首字前失敗，以相同上下文切換備援提供者
+                response_gen = chat_stream_service.arouted_stream(response.aopen_primary, response.prompt,
+                                                                  primary_ticket=ticket)
+            else:
+                response_gen = response.aopen_primary()
+            coalescer = TokenCoalescer(stream_config['flush_interval_ms'], stream_config['flush_max_bytes'])
+            async for text in acoalesce(response_gen, coalescer):
+                yield sse_encoder.chunk(text)
+
+            source_text = build_source_text(response)
+            if source_text:
+                yield sse_encoder.chunk(source_text, 'sources')
+            context_event = build_context_event(response)
+            if context_event:
+                yield sse_encoder.event(context_event)
+
+            completed = True
+            yield sse_encoder.complete_event
+
+        except (asyncio.CancelledError, GeneratorExit):
+            # 客戶端斷線超過續傳寬限期時 stream_registry 會取消此生成器
+            if not completed:
+                logger.info("客戶端已斷線，取消上游 LLM 生成")
+                metrics.incr('chat_stream_cancelled_total')
+            raise
+        except Exception as e:
+            logger.error(f"非同步流式聊天處理錯誤: {e}")
+            metrics.incr('chat_stream_error_total')
+            yield sse_encoder.error(f'處理請求時發生錯誤: {str(e)}')
+        finally:
+            metrics.add_gauge('chat_stream_active', -1)
+            if completed:
+                metrics.incr('chat_stream_completed_total')
+            if response_gen is not None:
+                await response_gen.aclose()
+            priority_ticket.release()
+            ticket.release()
+
+
+class AsyncChatResume:
+    """ASGI 原生的 /api/chat/stream/<stream_id>，以 Last-Event-ID 續傳中斷的流式聊天"""
+
+    async def __call__(self, scope, receive, send):
+        if scope.get('method') != 'GET':
+            await wsgi_app(scope, receive, send)
+            return
+
+        request = Request(scope, receive)
+        response = self.handle(request)
+        await response(scope, receive, send)
+
+    def handle(self, request: Request):
+        stream = stream_registry.get(request.path_params['stream_id'])
+        if stream is None:
+            return JSONResponse({
+                'error': '串流不存在或已過期，請重新提問',
+                'status': 'error'
+            }, status_code=404)
+
+        # Last-Event-ID 格式為 <stream_id>:<seq>
+        last_event_id = parse_last_event_id(request)
+        try:
+            last_seq = int(last_event_id.rsplit(':', 1)[-1]) if last_event_id else 0
+        except ValueError:
+            return JSONResponse({
+                'error': '無效的 Last-Event-ID',
+                'status': 'error'
+            }, status_code=400)
+
+        logger.info(f"續傳串流 {stream.stream_id}，從事件 {last_seq} 之後開始")
+        metrics.incr('chat_stream_resumed_total')
+        return StreamingResponse(
+            stream_registry.asubscribe(stream, last_seq),
+            media_type='text/event-stream',
+            headers={**SSE_HEADERS, 'X-Stream-Id': stream.stream_id}
+        )
+
+
+class AsyncStatusStream:
+    """ASGI 原生的 /api/status/stream，每個開啟的分頁各有一條，不應佔用 Flask 的執行緒池"""
+
+    async def __call__(self, scope, receive, send):
+        if scope.get('method') != 'GET':
+            await wsgi_app(scope, receive, send)
+            return
+
+        request = Request(scope, receive)
+        last_version = status_broadcaster.resume_version(parse_last_event_id(request))
+
+        await run_blocking(publish_status)
+        response = StreamingResponse(
+            status_broadcaster.asubscribe(last_version),
+            media_type='text/event-stream',
+            headers=SSE_HEADERS
+        )
+        await response(scope, receive, send)
+
+
+app = Starlette(routes=[
+    Route('/api/chat/stream', AsyncChatStream(), methods=['GET', 'POST', 'OPTIONS']),
+    Route('/api/chat/stream/{stream_id}', AsyncChatResume(), methods=['GET', 'OPTIONS']),
+    Route('/api/status/stream', AsyncStatusStream(), methods=['GET', 'OPTIONS']),
+    Mount('/', app=wsgi_app)
+])
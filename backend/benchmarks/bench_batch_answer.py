@@ -0,0 +1,84 @@
+"""批次問答基準測試：逐題呼叫 /api/chat/stream vs 一次 /api/answer/batch
+
+問題檔為每行一題的文字檔；未指定時以 --questions 個合成問題代替。
+用法：
+    python benchmarks/bench_batch_answer.py --url http://localhost:5009 --questions-file eval.txt
+    python benchmarks/bench_batch_answer.py --questions 50 --skip-sequential
+"""
+import argparse
+import json
+import time
+
+import httpx
+
+
+def load_questions(args):
+    if args.questions_file:
+        with open(args.questions_file, 'r', encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()][:args.questions or None]
+    return [f"{args.template} ({i + 1})" for i in range(args.questions or 20)]
+
+
+def run_sequential(client, url, questions):
+    start = time.perf_counter()
+    failed = 0
+    for question in questions:
+        with client.stream('POST', f"{url}/api/chat/stream", json={'message': question, 'model': 'gemini'}) as response:
+            if response.status_code != 200:
+                failed += 1
+                continue
+            for line in response.iter_lines():
+                if '"complete"' in line or '"error"' in line:
+                    failed += '"error"' in line
+                    break
+    return time.perf_counter() - start, failed
+
+
+def run_batch(client, url, questions, top_k):
+    start = time.perf_counter()
+    first_answer = None
+    answers = 0
+    summary = {}
+    with client.stream('POST', f"{url}/api/answer/batch", json={'questions': questions, 'top_k': top_k}) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event['type'] == 'answer':
+                answers += 1
+                if first_answer is None:
+                    first_answer = time.perf_counter() - start
+            elif event['type'] == 'summary':
+                summary = event
+    return time.perf_counter() - start, first_answer, answers, summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:5009')
+    parser.add_argument('--questions-file')
+    parser.add_argument('--questions', type=int, default=0, help='題數（使用問題檔時為上限）')
+    parser.add_argument('--template', default='這份文件中提到的主要步驟是什麼')
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--skip-sequential', action='store_true')
+    args = parser.parse_args()
+
+    questions = load_questions(args)
+    print(f"questions={len(questions)}")
+    with httpx.Client(timeout=httpx.Timeout(3600.0)) as client:
+        sequential = None
+        if not args.skip_sequential:
+            sequential, failed = run_sequential(client, args.url, questions)
+            print(f"{'sequential':<12} wall={sequential:8.2f}s per_question={sequential / len(questions):6.2f}s failed={failed}")
+
+        wall, first_answer, answers, summary = run_batch(client, args.url, questions, args.top_k)
+        print(f"{'batch':<12} wall={wall:8.2f}s first_answer={first_answer or float('nan'):6.2f}s answers={answers} "
+              f"unique_sources={summary.get('unique_sources')} retrieval={summary.get('retrieval_ms')}ms "
+              f"errors={summary.get('errors')}")
+        if sequential:
+            print(f"speedup x{sequential / wall:.1f}")
+
+
+if __name__ == '__main__':
+    main()
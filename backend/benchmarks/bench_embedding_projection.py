@@ -0,0 +1,125 @@
+"""嵌入降維基準測試：截斷 / PCA 投影後的召回率損失，以及全精度重新評分能找回多少
+
+預設使用合成語料：各維度變異數遞減（前段維度承載較多資訊，近似 Matryoshka 嵌入），
+並以高斯群集模擬主題。也可以直接使用索引建立時寫下的全精度向量側檔。
+用法：
+    python benchmarks/bench_embedding_projection.py --points 50000 --dim 768 --target-dims 128 256 384
+    python benchmarks/bench_embedding_projection.py --projection-dir service/projection/pdf_chat_collection
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from service.projection import Projection, META_FILE, VECTORS_FILE  # noqa: E402
+
+
+def synthetic_corpus(points, dim, clusters, seed):
+    rng = np.random.default_rng(seed)
+    scale = (1.0 / np.sqrt(np.arange(1, dim + 1))).astype(np.float32)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32) * scale
+    labels = rng.integers(0, clusters, size=points)
+    corpus = centers[labels] + 0.5 * rng.normal(size=(points, dim)).astype(np.float32) * scale
+    return corpus
+
+
+def load_side_file(directory):
+    with open(os.path.join(directory, META_FILE), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    vectors = np.fromfile(os.path.join(directory, VECTORS_FILE), dtype=np.float32)
+    return vectors.reshape(-1, meta['full_dim'])
+
+
+def make_queries(corpus, count, noise, seed):
+    rng = np.random.default_rng(seed)
+    picked = corpus[rng.integers(0, len(corpus), size=count)]
+    return picked + noise * rng.normal(size=picked.shape).astype(np.float32) * picked.std(axis=0)
+
+
+def normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def top_k(corpus, queries, k):
+    """暴力搜尋；返回每個查詢的前 k 個索引與耗時"""
+    start = time.perf_counter()
+    result = []
+    for offset in range(0, len(queries), 64):
+        scores = queries[offset:offset + 64] @ corpus.T
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(scores, candidates, axis=1).argsort(axis=1)[:, ::-1]
+        result.extend(np.take_along_axis(candidates, order, axis=1))
+    return result, time.perf_counter() - start
+
+
+def rescore(full_corpus, full_queries, candidates, k):
+    start = time.perf_counter()
+    result = []
+    for query, ids in zip(full_queries, candidates):
+        scores = full_corpus[ids] @ query
+        result.append(ids[np.argsort(-scores)[:k]])
+    return result, time.perf_counter() - start
+
+
+def recall(truth, found, k):
+    return sum(len(set(t[:k]) & set(f[:k])) for t, f in zip(truth, found)) / (len(truth) * k)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points', type=int, default=50000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--clusters', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--query-noise', type=float, default=0.5)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--oversampling', type=float, nargs='+', default=[1.0, 2.0, 4.0])
+    parser.add_argument('--target-dims', type=int, nargs='+', default=[64, 128, 256])
+    parser.add_argument('--pca-fit-samples', type=int, default=4096)
+    parser.add_argument('--modes', nargs='+', default=['truncate', 'pca'], choices=['truncate', 'pca'])
+    parser.add_argument('--projection-dir', help='使用索引建立時的全精度向量側檔取代合成語料')
+    args = parser.parse_args()
+
+    if args.projection_dir:
+        corpus = load_side_file(args.projection_dir)
+    else:
+        corpus = synthetic_corpus(args.points, args.dim, args.clusters, seed=1)
+    queries = make_queries(corpus, args.queries, args.query_noise, seed=2)
+    full_corpus, full_queries = normalize(corpus), normalize(queries)
+    k = args.top_k
+
+    truth, full_seconds = top_k(full_corpus, full_queries, k)
+    print(f"points={len(corpus)} dim={corpus.shape[1]} queries={len(queries)} top_k={k}")
+    print(f"{'full':<10} {corpus.shape[1]:>5}d recall@{k}=1.000 search={full_seconds / len(queries) * 1000:7.3f}ms/query "
+          f"storage={full_corpus.nbytes / 2 ** 20:8.1f}MiB")
+
+    for mode in args.modes:
+        for dim in args.target_dims:
+            if dim >= corpus.shape[1]:
+                continue
+            projection = Projection(mode, dim)
+            if mode == 'pca':
+                projection.fit(corpus[:args.pca_fit_samples])
+            projected_corpus = projection.project(corpus)
+            projected_queries = projection.project(queries)
+            for oversampling in args.oversampling:
+                fetch = max(k, int(np.ceil(k * oversampling)))
+                candidates, search_seconds = top_k(projected_corpus, projected_queries, fetch)
+                if oversampling > 1.0:
+                    found, rescore_seconds = rescore(full_corpus, full_queries, candidates, k)
+                    label = f"rescore x{oversampling:g}"
+                else:
+                    found, rescore_seconds = candidates, 0.0
+                    label = 'no rescore'
+                total = (search_seconds + rescore_seconds) / len(queries) * 1000
+                print(f"{mode:<10} {dim:>5}d recall@{k}={recall(truth, found, k):.3f} search={total:7.3f}ms/query "
+                      f"storage={projected_corpus.nbytes / 2 ** 20:8.1f}MiB ({label})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Qdrant 集合設定檔基準測試：量化 / on_disk 相對於全精度的召回率與查詢延遲
+
+以高斯群集產生合成語料（接近真實嵌入的分佈），以暴力搜尋的 top-k 為基準計算 recall@k。
+需要一個本地 Qdrant：
+    docker run --rm -p 6333:6333 qdrant/qdrant
+用法：
+    python benchmarks/bench_qdrant_quantization.py --points 50000 --dim 768 --queries 500 --top-k 10
+    python benchmarks/bench_qdrant_quantization.py --profiles full scalar binary-x4
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from qdrant_client import models  # noqa: E402
+from service.config_manager import ConfigManager  # noqa: E402
+from service.qdrant_factory import get_qdrant_client  # noqa: E402
+from service import collection_profile  # noqa: E402
+
+
+# 名稱 -> 覆寫 [Collection] 預設值的設定
+PROFILES = {
+    'full': {'quantization': 'none'},
+    'full-on-disk': {'quantization': 'none', 'on_disk': True},
+    'scalar': {'quantization': 'scalar', 'oversampling': 1.0},
+    'scalar-no-rescore': {'quantization': 'scalar', 'rescore': False, 'oversampling': 1.0},
+    'scalar-on-disk': {'quantization': 'scalar', 'on_disk': True, 'oversampling': 1.0},
+    'binary-x2': {'quantization': 'binary', 'oversampling': 2.0},
+    'binary-x4': {'quantization': 'binary', 'oversampling': 4.0},
+    'binary-no-rescore': {'quantization': 'binary', 'rescore': False, 'oversampling': 1.0},
+    'product-x16': {'quantization': 'product', 'pq_compression': 'x16', 'oversampling': 2.0},
+}
+
+
+def synthetic_corpus(points, queries, dim, clusters, seed):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=points)
+    corpus = centers[labels] + 0.6 * rng.normal(size=(points, dim)).astype(np.float32)
+    query_labels = rng.integers(0, clusters, size=queries)
+    query_vectors = centers[query_labels] + 0.6 * rng.normal(size=(queries, dim)).astype(np.float32)
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    return corpus, query_vectors
+
+
+def exact_top_k(corpus, queries, top_k):
+    truth = []
+    for start in range(0, len(queries), 64):
+        scores = queries[start:start + 64] @ corpus.T
+        truth.extend(np.argsort(-scores, axis=1)[:, :top_k])
+    return [set(row.tolist()) for row in truth]
+
+
+def wait_until_optimized(client, collection, timeout=600):
+    """量化與 HNSW 由背景 optimizer 建立，完成前的查詢數據沒有意義"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if client.get_collection(collection).status == models.CollectionStatus.GREEN:
+            return
+        time.sleep(0.5)
+    raise TimeoutError(f"集合 {collection} 在 {timeout}s 內未完成建立索引")
+
+
+def bench_profile(client, name, profile, corpus, queries, truth, args):
+    collection = f"bench_quantization_{name.replace('-', '_')}"
+    if client.collection_exists(collection):
+        client.delete_collection(collection)
+    client.create_collection(
+        collection,
+        vectors_config=collection_profile.dense_vector_params(corpus.shape[1], profile),
+        quantization_config=collection_profile.quantization_config(profile)
+    )
+
+    start = time.perf_counter()
+    client.upload_collection(collection_name=collection, vectors=corpus, ids=range(len(corpus)),
+                             batch_size=args.batch_size, wait=True)
+    wait_until_optimized(client, collection)
+    build_seconds = time.perf_counter() - start
+
+    search_params = collection_profile.search_params(profile)
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        result = client.query_points(
+            collection_name=collection,
+            query=query.tolist(),
+            limit=args.top_k,
+            search_params=search_params
+        )
+        latencies.append(time.perf_counter() - start)
+        hits += len(expected & {point.id for point in result.points})
+
+    client.delete_collection(collection)
+    latencies.sort()
+    recall = hits / (len(queries) * args.top_k)
+    print(f"{name:<18} recall@{args.top_k}={recall:6.3f} "
+          f"p50={statistics.median(latencies) * 1000:7.2f}ms "
+          f"p95={latencies[int(len(latencies) * 0.95)] * 1000:7.2f}ms "
+          f"build={build_seconds:6.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:6333')
+    parser.add_argument('--points', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--clusters', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--hnsw-ef', type=int, default=0)
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES), choices=list(PROFILES))
+    args = parser.parse_args()
+
+    base_profile = ConfigManager().get_collection_config()
+    client = get_qdrant_client({'url': args.url})
+    corpus, queries = synthetic_corpus(args.points, args.queries, args.dim, args.clusters, seed=1)
+    truth = exact_top_k(corpus, queries, args.top_k)
+
+    print(f"points={args.points} dim={args.dim} queries={args.queries} clusters={args.clusters} "
+          f"m={base_profile['hnsw_m']} ef_construct={base_profile['hnsw_ef_construct']}")
+    for name in args.profiles:
+        profile = {**base_profile, 'hnsw_ef': args.hnsw_ef, **PROFILES[name]}
+        bench_profile(client, name, profile, corpus, queries, truth, args)
+
+
+if __name__ == '__main__':
+    main()
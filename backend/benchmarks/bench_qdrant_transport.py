@@ -0,0 +1,78 @@
+"""Qdrant REST vs gRPC 寫入與搜尋吞吐量基準測試
+
+需要一個本地 Qdrant（REST 6333 / gRPC 6334）：
+    docker run --rm -p 6333:6333 -p 6334:6334 qdrant/qdrant
+用法：
+    python benchmarks/bench_qdrant_transport.py --points 20000 --dim 768 --batch-size 256 --parallel 4
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from qdrant_client.http.models import Distance, PointStruct, VectorParams  # noqa: E402
+from service.qdrant_factory import get_qdrant_client  # noqa: E402
+from service.client_registry import client_registry  # noqa: E402
+
+
+def random_vectors(count, dim, seed):
+    rng = random.Random(seed)
+    return [[rng.uniform(-1.0, 1.0) for _ in range(dim)] for _ in range(count)]
+
+
+def bench_transport(name, prefer_grpc, args, vectors, queries):
+    client_registry.invalidate()
+    client = get_qdrant_client({
+        'url': args.url,
+        'prefer_grpc': prefer_grpc,
+        'grpc_port': args.grpc_port,
+        'max_connections': args.parallel * 2
+    })
+    collection = f"bench_transport_{name}"
+    if client.collection_exists(collection):
+        client.delete_collection(collection)
+    client.create_collection(collection, vectors_config=VectorParams(size=args.dim, distance=Distance.COSINE))
+
+    start = time.perf_counter()
+    client.upload_points(
+        collection_name=collection,
+        points=(PointStruct(id=i, vector=v, payload={'doc_id': str(i % 50)}) for i, v in enumerate(vectors)),
+        batch_size=args.batch_size,
+        parallel=args.parallel,
+        wait=True
+    )
+    upsert_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for query in queries:
+        client.query_points(collection_name=collection, query=query, limit=5)
+    search_seconds = time.perf_counter() - start
+
+    client.delete_collection(collection)
+    print(f"{name:<5} upsert={len(vectors) / upsert_seconds:>10.0f} points/s "
+          f"search={len(queries) / search_seconds:>8.0f} qps")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:6333')
+    parser.add_argument('--grpc-port', type=int, default=6334)
+    parser.add_argument('--points', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--parallel', type=int, default=4)
+    args = parser.parse_args()
+
+    vectors = random_vectors(args.points, args.dim, seed=1)
+    queries = random_vectors(args.queries, args.dim, seed=2)
+    print(f"points={args.points} dim={args.dim} batch_size={args.batch_size} parallel={args.parallel}")
+    bench_transport('rest', False, args, vectors, queries)
+    bench_transport('grpc', True, args, vectors, queries)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""併發 SSE 串流基準測試：比較 gevent（wsgi:app）與 ASGI（asgi:app）每個 worker 可承載的串流數
+
+分別以單一 worker 啟動後端：
+    GUNICORN_WORKERS=1 gunicorn --config gunicorn.conf.py wsgi:app
+    GUNICORN_WORKERS=1 GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn --config gunicorn.conf.py asgi:app
+用法：
+    python benchmarks/bench_sse_concurrency.py --url http://localhost:5009 --streams 50 100 200
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+async def one_stream(client, url, message):
+    start = time.perf_counter()
+    first_event = None
+    events = 0
+    async with client.stream('POST', f"{url}/api/chat/stream", json={'message': message, 'model': 'gemini'}) as response:
+        if response.status_code != 200:
+            return None, None, response.status_code
+        async for line in response.aiter_lines():
+            if not line.startswith('data: '):
+                continue
+            events += 1
+            if first_event is None:
+                first_event = time.perf_counter() - start
+            if '"complete"' in line or '"error"' in line:
+                break
+    return first_event, time.perf_counter() - start, 200
+
+
+async def run_level(url, streams, message):
+    limits = httpx.Limits(max_connections=streams, max_keepalive_connections=streams)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(600.0), limits=limits) as client:
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(one_stream(client, url, message) for _ in range(streams)),
+            return_exceptions=True
+        )
+        wall = time.perf_counter() - start
+
+    ok = [r for r in results if not isinstance(r, Exception) and r[2] == 200 and r[0] is not None]
+    rejected = [r for r in results if not isinstance(r, Exception) and r[2] in (429, 503)]
+    failed = len(results) - len(ok) - len(rejected)
+    ttft = sorted(r[0] for r in ok)
+    total = [r[1] for r in ok]
+
+    def pct(values, q):
+        return values[min(len(values) - 1, int(len(values) * q))] if values else float('nan')
+
+    print(f"streams={streams:>4} ok={len(ok):>4} rejected={len(rejected):>4} failed={failed:>4} "
+          f"ttft_p50={pct(ttft, 0.5):6.2f}s ttft_p95={pct(ttft, 0.95):6.2f}s "
+          f"mean_total={statistics.mean(total) if total else float('nan'):6.2f}s wall={wall:6.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:5009')
+    parser.add_argument('--streams', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('--message', default='請總結這份文件的重點')
+    args = parser.parse_args()
+
+    for streams in args.streams:
+        asyncio.run(run_level(args.url, streams, args.message))
+
+
+if __name__ == '__main__':
+    main()
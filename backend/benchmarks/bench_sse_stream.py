@@ -0,0 +1,105 @@
+"""SSE 串流輸出基準測試：逐分塊輸出 vs 時間窗合併輸出
+
+用法：
+    python benchmarks/bench_sse_stream.py --tokens 20000 --gap-ms 5
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from service.sse import SSEEncoder, TokenCoalescer  # noqa: E402
+
+logger = logging.getLogger('bench_sse')
+
+
+class FakeClock:
+    """以固定的分塊間隔推進的模擬時鐘"""
+
+    def __init__(self, gap_seconds):
+        self.now = 0.0
+        self.gap = gap_seconds
+
+    def tick(self):
+        self.now += self.gap
+
+    def __call__(self):
+        return self.now
+
+
+def make_tokens(count, seed=7):
+    rng = random.Random(seed)
+    alphabet = '文件內容查詢回答模型向量索引abcdefghij '
+    return [''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))) for _ in range(count)]
+
+
+def per_token_stream(tokens, clock):
+    """原本的做法：每個分塊 json.dumps + f-string + debug 日誌 + stdout flush"""
+    for chunk in tokens:
+        clock.tick()
+        if chunk and str(chunk).strip():
+            chunk_data = json.dumps({'chunk': str(chunk), 'status': 'streaming'}, ensure_ascii=False)
+            logger.debug(f"流式發送分塊: {str(chunk)[:50]}...")
+            yield f"data: {chunk_data}\n\n"
+            sys.stdout.flush()
+
+
+def coalesced_stream(tokens, clock, interval_ms, max_bytes):
+    encoder = SSEEncoder()
+    coalescer = TokenCoalescer(interval_ms, max_bytes, clock=clock)
+    for chunk in tokens:
+        clock.tick()
+        text = coalescer.push(chunk)
+        if text:
+            yield encoder.chunk(text)
+    text = coalescer.flush()
+    if text:
+        yield encoder.chunk(text)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tokens', type=int, default=20000)
+    parser.add_argument('--streams', type=int, default=20)
+    parser.add_argument('--gap-ms', type=float, default=5.0, help='模擬的上游分塊間隔')
+    parser.add_argument('--interval-ms', type=int, default=50)
+    parser.add_argument('--max-bytes', type=int, default=1024)
+    args = parser.parse_args()
+
+    # 與 gunicorn 相同：日誌等級 INFO，stdout 導向非終端
+    logging.basicConfig(level=logging.INFO)
+    report = sys.stdout
+    sys.stdout = io.TextIOWrapper(open(os.devnull, 'wb'), write_through=False)
+
+    tokens = make_tokens(args.tokens)
+    gap = args.gap_ms / 1000.0
+    print(f"tokens/stream={args.tokens} streams={args.streams} gap={args.gap_ms}ms "
+          f"interval={args.interval_ms}ms max_bytes={args.max_bytes}", file=report)
+
+    def before(t):
+        return per_token_stream(t, FakeClock(gap))
+
+    def after(t):
+        return coalesced_stream(t, FakeClock(gap), args.interval_ms, args.max_bytes)
+
+    for name, factory in (('per-token', before), ('coalesced', after)):
+        events = 0
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        for _ in range(args.streams):
+            for _event in factory(tokens):
+                events += 1
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+        print(f"{name:<10} events/stream={events // args.streams:>7} "
+              f"events/s={events / wall:>10.0f} cpu/stream={cpu / args.streams * 1000:>8.2f} ms", file=report)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,8 @@ import os
 # 工作進程數 - 在容器環境中使用較少的進程以節省記憶體
 workers = int(os.getenv('GUNICORN_WORKERS', '2'))
 
-# 使用 gevent worker
-worker_class = 'gevent'
+# 使用 gevent worker；ASGI 模式請設定 GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker 並以 asgi:app 啟動
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
 
 # 綁定地址
 bind = '0.0.0.0:' + os.getenv('PORT_PDF_CHAT_BACKEND', '5009')
@@ -33,3 +33,27 @@ worker_connections = 1000
 # 記憶體優化
 max_requests = 1000
 max_requests_jitter = 100
+
+
+def on_starting(server):
+    """與 gunicorn 一同啟動 ingestion worker 行程，PDF 解析與嵌入不佔用 web worker"""
+    from service.config_manager import ConfigManager
+    from service.ingestion_worker import start_worker_process
+
+    ingestion_config = ConfigManager("config.ini").get_ingestion_config()
+    if ingestion_config['mode'] == 'process':
+        server.ingestion_process = start_worker_process(
+            "config.ini", ingestion_config['job_dir'], ingestion_config['poll_interval']
+        )
+        server.log.info(f"Ingestion worker 已啟動 (pid={server.ingestion_process.pid})")
+
+
+def on_exit(server):
+    """ingestion worker 不是 daemon 行程（才能建立 upsert 行程池），由這裡停止；執行中的工作未在時限內結束時強制終止"""
+    process = getattr(server, 'ingestion_process', None)
+    if process is not None and process.is_alive():
+        process.terminate()
+        process.join(10)
+        if process.is_alive():
+            process.kill()
+            process.join()
@@ -0,0 +1,305 @@
+import os
+import time
+import fcntl
+import socket
+import threading
+from typing import Any, Dict, Optional
+from .metrics import metrics
+
+
+# 聊天類型與上游提供者的對應
+CHAT_TYPE_PROVIDERS = {
+    'gemini': 'gemini',
+    'azure': 'azure',
+    'azure_completions': 'azure',
+    'ollama': 'ollama',
+    'ollama_client': 'ollama',
+}
+
+
+class AdmissionRejected(Exception):
+    """提供者已滿載，請求被拒絕"""
+
+    def __init__(self, provider: str, reason: str, status_code: int, retry_after: int):
+        super().__init__(f"{provider} {reason}")
+        self.provider = provider
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class SharedSlots:
+    """跨行程的並發名額與等待佇列
+
+    - 並發名額：<directory>/<provider>.<i>.lock 上的 flock，同一主機上的所有 gunicorn worker 共用 count 個名額
+    - 佇列位置：<provider>.queue.<i>.lock，共 max_queue 個；取不到表示整台主機的等待佇列已滿
+    - 等待者在佇列位置對應的 <provider>.queue.<i>.sock 上接收通知，釋放名額時通知所有等待者重新搶名額，
+      不需輪詢；gevent 下 socket 的等待會讓出 greenlet，不會阻塞整個 worker
+    行程結束時作業系統自動釋放它持有的鎖，不會遺留名額；釋放者異常結束而沒有送出通知時，
+    等待者最多 recheck_interval 秒後自行重新檢查。
+    """
+
+    def __init__(self, directory: str, provider: str, count: int, max_queue: int = 0,
+                 recheck_interval: float = 1.0, poll_interval: float = 0.05):
+        os.makedirs(directory, exist_ok=True)
+        self._paths = [os.path.join(directory, f"{provider}.{i}.lock") for i in range(max(count, 1))]
+        self._queue_paths = [os.path.join(directory, f"{provider}.queue.{i}.lock") for i in range(max(max_queue, 0))]
+        self._socket_paths = [f"{path[:-5]}.sock" for path in self._queue_paths]
+        self.recheck_interval = recheck_interval
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # fork 後繼承的檔案描述與父行程共用同一把鎖，因此每個行程各自開啟
+        self._pid = os.getpid()
+        self._files = {}
+        self._held = set()
+
+    def _try_lock(self, paths) -> Optional[int]:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            for index, path in enumerate(paths):
+                # 同一行程對同一個檔案描述重複 flock 會直接成功，行程內已持有的名額要先排除
+                if path in self._held:
+                    continue
+                f = self._files.get(path)
+                if f is None:
+                    f = self._files[path] = open(path, 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                self._held.add(path)
+                return index
+        return None
+
+    def _unlock(self, path: str) -> bool:
+        with self._lock:
+            if path not in self._held:
+                return False
+            self._held.discard(path)
+            fcntl.flock(self._files[path], fcntl.LOCK_UN)
+            return True
+
+    def try_acquire(self) -> Optional[int]:
+        return self._try_lock(self._paths)
+
+    def enqueue(self) -> Optional[int]:
+        """取得整台主機的等待佇列位置，佇列已滿時返回 None"""
+        return self._try_lock(self._queue_paths)
+
+    def dequeue(self, position: int):
+        self._unlock(self._queue_paths[position])
+
+    def wait(self, position: int, timeout: float) -> Optional[int]:
+        """持有佇列位置 position 時等待最多 timeout 秒取得名額，逾時返回 None"""
+        deadline = time.monotonic() + timeout
+        listener = self._listen(position)
+        try:
+            while True:
+                # 先綁定通知 socket 再檢查名額，兩者之間的釋放通知會留在 socket 中，不會遺失
+                slot = self.try_acquire()
+                if slot is not None:
+                    return slot
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                if listener is None:
+                    time.sleep(min(self.poll_interval, remaining))
+                    continue
+                listener.settimeout(min(self.recheck_interval, remaining))
+                try:
+                    listener.recv(16)
+                except socket.timeout:
+                    pass
+        finally:
+            if listener is not None:
+                listener.close()
+                self._remove_socket(position)
+
+    def release(self, slot: int):
+        if self._unlock(self._paths[slot]):
+            self._notify()
+
+    def _listen(self, position: int) -> Optional[socket.socket]:
+        # 持有佇列位置的 flock 才會走到這裡，遺留的 socket 檔必定已無人使用
+        self._remove_socket(position)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            listener.bind(self._socket_paths[position])
+        except OSError as e:
+            # 例如路徑超過 AF_UNIX 的長度上限，改為輪詢
+            print(f"⚠️ 無法建立准入通知 socket，改為輪詢: {e}")
+            listener.close()
+            return None
+        return listener
+
+    def _remove_socket(self, position: int):
+        try:
+            os.remove(self._socket_paths[position])
+        except OSError:
+            pass
+
+    def _notify(self):
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        try:
+            for path in self._socket_paths:
+                try:
+                    sender.sendto(b'1', path)
+                except OSError:
+                    # 沒有等待者、等待者已離開，或通知已在其緩衝中
+                    continue
+        finally:
+            sender.close()
+
+
+class AdmissionTicket:
+    """已取得的並發名額，release 可重複呼叫"""
+
+    def __init__(self, gate: 'ProviderGate', shared_slot: Optional[int] = None):
+        self._gate = gate
+        self._shared_slot = shared_slot
+        self._released = False
+        self.acquired_at = time.monotonic()
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._gate.release(time.monotonic() - self.acquired_at, self._shared_slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class ProviderGate:
+    """單一提供者的並發上限與有界等待佇列
+
+    行程內以號誌排隊；有 shared 時另需取得跨行程名額，多個 gunicorn worker 合計也不超過 max_concurrency，
+    等待佇列的上限 max_queue 也是整台主機共用。
+    """
+
+    def __init__(self, provider: str, max_concurrency: int, max_queue: int, queue_timeout: float,
+                 shared: Optional[SharedSlots] = None):
+        self.provider = provider
+        self.max_concurrency = max(max_concurrency, 1)
+        self.max_queue = max(max_queue, 0)
+        self.queue_timeout = queue_timeout
+        self.shared = shared
+        self._semaphore = threading.BoundedSemaphore(self.max_concurrency)
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.active = 0
+        # 以指數移動平均估計每個請求佔用名額的時間，用於 Retry-After
+        self._avg_hold = 5.0
+
+    def acquire(self, timeout: Optional[float] = None) -> AdmissionTicket:
+        start = time.monotonic()
+        wait_limit = self.queue_timeout if timeout is None else timeout
+        shared_slot = None
+        have_local = self._semaphore.acquire(blocking=False)
+        if have_local and self.shared is not None:
+            shared_slot = self.shared.try_acquire()
+        if have_local and (self.shared is None or shared_slot is not None):
+            return self._admit(start, shared_slot)
+
+        # 需要排隊；有 shared 時以整台主機的佇列位置判斷是否已滿，而不是本行程的等待數
+        position = None
+        with self._lock:
+            if self.shared is not None:
+                position = self.shared.enqueue()
+                full = position is None
+            else:
+                full = self.waiting >= self.max_queue
+            if full:
+                if have_local:
+                    self._semaphore.release()
+                metrics.incr(f'admission_{self.provider}_rejected_total')
+                raise AdmissionRejected(self.provider, '等待佇列已滿', 429, self.retry_after())
+            self.waiting += 1
+            self._publish()
+
+        try:
+            if not have_local:
+                have_local = self._semaphore.acquire(timeout=wait_limit)
+            if have_local and self.shared is not None:
+                shared_slot = self.shared.wait(position, max(wait_limit - (time.monotonic() - start), 0.0))
+            acquired = have_local and (self.shared is None or shared_slot is not None)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+                self._publish()
+            if position is not None:
+                self.shared.dequeue(position)
+
+        if not acquired:
+            if have_local:
+                self._semaphore.release()
+            metrics.incr(f'admission_{self.provider}_timeout_total')
+            raise AdmissionRejected(self.provider, '等待逾時', 503, self.retry_after())
+        return self._admit(start, shared_slot)
+
+    def _admit(self, start: float, shared_slot: Optional[int]) -> AdmissionTicket:
+        with self._lock:
+            self.active += 1
+            self._publish()
+        metrics.observe(f'admission_{self.provider}_wait_seconds', time.monotonic() - start)
+        return AdmissionTicket(self, shared_slot)
+
+    def release(self, held_seconds: float, shared_slot: Optional[int] = None):
+        with self._lock:
+            self.active -= 1
+            self._avg_hold = self._avg_hold * 0.8 + held_seconds * 0.2
+            self._publish()
+        if shared_slot is not None:
+            self.shared.release(shared_slot)
+        self._semaphore.release()
+
+    def retry_after(self) -> int:
+        """依佇列長度與平均佔用時間估計建議的重試秒數"""
+        rounds = (self.waiting + 1) / self.max_concurrency
+        return max(1, int(rounds * self._avg_hold + 0.5))
+
+    def _publish(self):
+        metrics.set_gauge(f'admission_{self.provider}_queue_depth', self.waiting)
+        metrics.set_gauge(f'admission_{self.provider}_active', self.active)
+
+
+class AdmissionController:
+    """各 LLM 提供者的准入控制；有 slot_dir 時並發上限由同一主機的所有行程共用"""
+
+    def __init__(self, limits: Dict[str, Dict[str, Any]], slot_dir: Optional[str] = None):
+        self.limits = limits
+        self.slot_dir = slot_dir
+        self._gates: Dict[str, ProviderGate] = {}
+        self._lock = threading.Lock()
+
+    def gate(self, provider: str) -> ProviderGate:
+        with self._lock:
+            gate = self._gates.get(provider)
+            if gate is None:
+                limit = self.limits.get(provider) or self.limits.get('default', {})
+                max_concurrency = limit.get('max_concurrency', 8)
+                max_queue = limit.get('max_queue', 32)
+                shared = SharedSlots(self.slot_dir, provider, max_concurrency, max_queue) if self.slot_dir else None
+                gate = ProviderGate(
+                    provider,
+                    max_concurrency,
+                    max_queue,
+                    limit.get('queue_timeout', 10.0),
+                    shared
+                )
+                self._gates[provider] = gate
+            return gate
+
+    def acquire(self, provider: str, timeout: Optional[float] = None) -> AdmissionTicket:
+        return self.gate(provider).acquire(timeout)
+
+    def slot(self, provider: str, timeout: Optional[float] = None) -> AdmissionTicket:
+        """可用於 with 區塊的名額"""
+        return self.acquire(provider, timeout)
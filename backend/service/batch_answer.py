@@ -0,0 +1,139 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from typing import Any, Dict, Iterator, List, Optional
+
+from llama_index.core.postprocessor import LongContextReorder
+from llama_index.core.prompts.default_prompts import DEFAULT_TEXT_QA_PROMPT
+from llama_index.core.schema import MetadataMode, NodeWithScore
+from .context_packer import context_usage
+from .admission import AdmissionController, AdmissionRejected
+from .metrics import metrics
+from .priority_scheduler import PriorityScheduler, INGESTION
+from .query_filters import QueryFilter, DOC_ID_KEY, PAGE_NUMBER_KEY
+
+
+class BatchAnswerer:
+    """批次問答：共用一次批次檢索，去重上下文，在提供者並發上限內並行生成
+
+    產生的事件（每個一行 NDJSON）：
+    - source：檢索完成後每個不重複的段落輸出一次，答案只以 id 引用
+    - answer：每個問題完成時立即輸出（依完成順序，index 為原始順序）
+    - summary：全部完成後輸出統計
+    """
+
+    def __init__(self, processor, admission: AdmissionController, concurrency: int = 4,
+                 provider: str = 'gemini', queue_timeout: float = 120.0,
+                 scheduler: Optional[PriorityScheduler] = None):
+        self.processor = processor
+        self.admission = admission
+        self.scheduler = scheduler
+        self.concurrency = max(concurrency, 1)
+        self.provider = provider
+        self.queue_timeout = queue_timeout
+        self._reorder = LongContextReorder()
+
+    def run(self, questions: List[str], top_k: int = 5, query_filter: Optional[QueryFilter] = None,
+            mode: str = 'hybrid', alpha: float = 0.5) -> Iterator[Dict[str, Any]]:
+        start = time.perf_counter()
+        # 相同的問題只檢索與生成一次
+        unique = list(dict.fromkeys(questions))
+        positions: Dict[str, List[int]] = {}
+        for index, question in enumerate(questions):
+            positions.setdefault(question, []).append(index)
+
+        # 批次檢索的查詢嵌入與 ingestion 共用配額；批次工作不是互動查詢，以非互動類別排隊，
+        # 不佔用聊天的保留額度，等待上限與生成名額相同
+        with (self.scheduler.slot(INGESTION, timeout=self.queue_timeout) if self.scheduler is not None
+              else nullcontext()):
+            hits = self.processor.search(unique, self.processor.candidate_count(top_k), query_filter, mode, alpha)
+        # 與查詢引擎相同：依 token 預算打包候選段落，只輸出實際送進提示詞的段落
+        packer = self.processor.context_packer
+        if packer is not None:
+            hits = [packer.postprocess_nodes(list(nodes)) for nodes in hits]
+        else:
+            hits = [nodes[:top_k] for nodes in hits]
+        retrieval_ms = (time.perf_counter() - start) * 1000
+
+        # 多個問題常檢索到相同段落：每個段落的 LLM 內容只組一次，來源也只輸出一次
+        contents: Dict[str, str] = {}
+        for nodes in hits:
+            for hit in nodes:
+                if hit.node.node_id not in contents:
+                    contents[hit.node.node_id] = hit.node.get_content(metadata_mode=MetadataMode.LLM)
+                    yield self._source_event(hit)
+
+        errors = 0
+        workers = min(self.concurrency, len(unique))
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch-answer')
+        try:
+            futures = {executor.submit(self._answer, question, nodes, contents): question
+                       for question, nodes in zip(unique, hits)}
+            for future in as_completed(futures):
+                question = futures[future]
+                event = future.result()
+                if 'error' in event:
+                    errors += len(positions[question])
+                for index in positions[question]:
+                    yield {'type': 'answer', 'index': index, 'question': question, **event}
+        finally:
+            # 客戶端斷線時生成器收到 GeneratorExit：取消尚未開始的生成，不等待它們呼叫 LLM
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        took_ms = (time.perf_counter() - start) * 1000
+        metrics.incr('batch_answer_questions_total', len(questions))
+        metrics.observe('batch_answer_latency_ms', took_ms)
+        yield {
+            'type': 'summary',
+            'questions': len(questions),
+            'unique_questions': len(unique),
+            'unique_sources': len(contents),
+            'errors': errors,
+            'retrieval_ms': round(retrieval_ms, 1),
+            'took_ms': round(took_ms, 1)
+        }
+
+    def _answer(self, question: str, nodes: List[NodeWithScore], contents: Dict[str, str]) -> Dict[str, Any]:
+        """與查詢引擎相同的排序與預設 QA 提示詞
+
+        每次生成前先取得非互動類別的排程名額，再取得提供者並發名額：批次生成與 ingestion 共用配額，
+        聊天查詢進來時會被讓出；先排程後准入，排隊等待排程時不佔用提供者名額。
+        """
+        start = time.perf_counter()
+        ordered = self._reorder.postprocess_nodes(list(nodes))
+        prompt = DEFAULT_TEXT_QA_PROMPT.format(
+            context_str='\n\n'.join(contents[hit.node.node_id] for hit in ordered),
+            query_str=question
+        )
+        sources = [{'id': hit.node.node_id, 'score': hit.score} for hit in nodes]
+        try:
+            with (self.scheduler.slot(INGESTION, timeout=self.queue_timeout) if self.scheduler is not None
+                  else nullcontext()):
+                with self.admission.slot(self.provider, timeout=self.queue_timeout):
+                    answer = self.processor.llm.complete(prompt).text
+        except AdmissionRejected as e:
+            metrics.incr('batch_answer_rejected_total')
+            return {'error': f'服務繁忙（{e.reason}）', 'retry_after': e.retry_after, 'sources': sources}
+        except Exception as e:
+            print(f"❌ 批次問答生成失敗: {e}")
+            metrics.incr('batch_answer_error_total')
+            return {'error': str(e), 'sources': sources}
+        return {
+            'answer': answer,
+            'sources': sources,
+            **context_usage(nodes),
+            'took_ms': round((time.perf_counter() - start) * 1000, 1)
+        }
+
+    @staticmethod
+    def _source_event(hit: NodeWithScore) -> Dict[str, Any]:
+        node = hit.node
+        return {
+            'type': 'source',
+            'id': node.node_id,
+            'file_id': node.metadata.get(DOC_ID_KEY),
+            'file_name': node.metadata.get('file_name'),
+            'page_number': node.metadata.get(PAGE_NUMBER_KEY),
+            'page_label': node.metadata.get('page_label'),
+            'text': node.get_content()
+        }
@@ -0,0 +1,94 @@
+import re
+from collections import Counter
+from typing import Dict, List, Sequence
+
+from llama_index.core import Document
+
+
+_DIGITS = re.compile(r'\d+')
+_WHITESPACE = re.compile(r'\s+')
+# 頁碼行除數字外的文字長度上限，例如「第 3 頁 / 共 120 頁」、「Page 3 of 120」、「- 12 -」
+PAGE_NUMBER_MAX_CHARS = 20
+
+
+def _line_keys(line: str, outermost: bool) -> List[tuple]:
+    """行的比對鍵：空白正規化後的原文；頁面最外側的短行另以數字視為相同的形式比對，找出逐頁變動的頁碼"""
+    text = _WHITESPACE.sub(' ', line).strip().lower()
+    keys = [('text', text)]
+    if outermost and _DIGITS.search(text):
+        pattern = _DIGITS.sub('#', text)
+        if len(pattern.replace('#', '').replace(' ', '')) <= PAGE_NUMBER_MAX_CHARS:
+            keys.append(('page_number', pattern))
+    return keys
+
+
+class BoilerplateStripper:
+    """切塊前移除文件逐頁重複的頁首、頁尾與頁碼
+
+    只統計每頁前後 edge_lines 個非空行（且每側不超過該頁非空行數的三分之一，短頁的內文不會被當成邊緣），
+    同一行在同一頁只計一次；出現在至少 min_fraction 比例頁面邊緣的行視為樣板，只從頁面邊緣移除，內文中相同的句子保留。
+    只有數字不同的行（頁碼）僅在頁面最前或最後一行時比對，避免「第 N 章」之類的內文被移除。
+    頁數少於 min_pages 的文件無從判斷，不做處理。只修改頁面文字，page_label 等 metadata 不變。
+    """
+
+    def __init__(self, edge_lines: int = 3, min_fraction: float = 0.6, min_pages: int = 4):
+        self.edge_lines = max(edge_lines, 1)
+        self.min_fraction = min_fraction
+        self.min_pages = max(min_pages, 2)
+
+    @property
+    def fingerprint(self) -> str:
+        return f"boilerplate={self.edge_lines}/{self.min_fraction}/{self.min_pages}/third"
+
+    def strip(self, pages: Sequence[Document]) -> Dict[str, int]:
+        """就地移除同一文件各頁（每頁一個 Document）的樣板行，返回移除的行數與字元數"""
+        stats = {'lines': 0, 'chars': 0}
+        if len(pages) < self.min_pages:
+            return stats
+
+        page_lines = [page.text.split('\n') for page in pages]
+        page_keys = [self._edge_keys(lines) for lines in page_lines]
+        # 太短而沒有邊緣行的頁面不參與統計
+        counted = sum(1 for keys in page_keys if keys)
+        if counted < self.min_pages:
+            return stats
+        counts = Counter()
+        for keys in page_keys:
+            counts.update({key for line_keys in keys.values() for key in line_keys})
+        threshold = max(2, self.min_fraction * counted)
+        boilerplate = {key for key, count in counts.items() if key[1] and count >= threshold}
+        if not boilerplate:
+            return stats
+
+        for page, lines, keys in zip(pages, page_lines, page_keys):
+            removed = {i for i, line_keys in keys.items() if boilerplate.intersection(line_keys)}
+            if not removed:
+                continue
+            stats['lines'] += len(removed)
+            stats['chars'] += sum(len(lines[i]) for i in removed)
+            page.set_content('\n'.join(line for i, line in enumerate(lines) if i not in removed))
+        return stats
+
+    def strip_documents(self, documents: List[Document]) -> Dict[str, int]:
+        """目錄載入的 Document 依來源檔案分組後各自處理"""
+        files: Dict[str, List[Document]] = {}
+        for document in documents:
+            files.setdefault(document.metadata.get('file_path', ''), []).append(document)
+        stats = {'lines': 0, 'chars': 0}
+        for pages in files.values():
+            for key, value in self.strip(pages).items():
+                stats[key] += value
+        return stats
+
+    def _edge_keys(self, lines: List[str]) -> Dict[int, List[tuple]]:
+        """頁面前後各 edge_lines 個非空行（每側最多非空行數的三分之一）的位置與比對鍵
+
+        少於三個非空行的頁面沒有邊緣行；每頁至少保留三分之一的非空行，重複的內文不會把短頁清空。
+        """
+        non_empty = [i for i, line in enumerate(lines) if line.strip()]
+        window = min(self.edge_lines, len(non_empty) // 3)
+        if window == 0:
+            return {}
+        edges = set(non_empty[:window] + non_empty[-window:])
+        outermost = {non_empty[0], non_empty[-1]}
+        return {i: _line_keys(lines[i], i in outermost) for i in sorted(edges)}
@@ -1,61 +1,343 @@
 import time
-from openai import AzureOpenAI
+import asyncio
+from openai import AzureOpenAI, AsyncAzureOpenAI
 from langchain_openai import AzureChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_ollama.llms import OllamaLLM
-from ollama import Client as OllamaClient
+from ollama import Client as OllamaClient, AsyncClient as AsyncOllamaClient
+from .stream_control import close_upstream
+from .client_registry import client_registry, get_http_client
+from .admission import AdmissionRejected, CHAT_TYPE_PROVIDERS
+from .provider_router import HedgedRouter
+
+class ProviderStream:
+    """持有提供者並發名額的串流
+
+    close() 可從任何執行緒呼叫（例如對沖落敗時由路由器呼叫）：立即歸還名額並嘗試關閉上游，
+    不必等到上游產生下一個分塊；串流結束或出錯時也會自行歸還。
+    """
+
+    def __init__(self, stream, ticket=None):
+        self._stream = stream
+        self._ticket = ticket
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._stream)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self._ticket is not None:
+            self._ticket.release()
+        close_upstream(self._stream)
+
 
 class ChatStreamService:
-    def __init__(self, config):
+    def __init__(self, config, admission=None):
         self.config = config
+        self.admission = admission
+
+        routing_config = config.get("Routing") or {}
+        self.router = None
+        if routing_config.get('hedge_enabled'):
+            self.router = HedgedRouter(
+                window=routing_config['stats_window'],
+                min_delay=routing_config['hedge_min_delay'],
+                max_delay=routing_config['hedge_max_delay'],
+                default_delay=routing_config['hedge_default_delay'],
+                error_rate_threshold=routing_config['error_rate_threshold']
+            )
+
+    def chat(self, user_input, type='gemini'):
+        """非流式聊天，合併流式回應為完整字串"""
+        return ''.join(self.chat_stream(user_input, type))
+
+    def _http_client(self):
+        return get_http_client(self.config.get("HTTP"))
+
+    def _get_azure_chat_llm(self):
+        azure_config = self.config["AzureOpenAIChat"]
+        return client_registry.get('azure_chat', azure_config, lambda: AzureChatOpenAI(
+            openai_api_version=azure_config["VERSION"],
+            azure_deployment=azure_config["DEPLOYMENT_NAME"],
+            azure_endpoint=azure_config["END_POINT"],
+            api_key=azure_config["KEY"],
+            http_client=self._http_client(),
+            streaming=True
+        ))
+
+    def _get_azure_client(self):
+        azure_config = self.config["AzureOpenAIChat"]
+        return client_registry.get('azure_openai', azure_config, lambda: AzureOpenAI(
+            api_key=azure_config["KEY"],
+            api_version=azure_config["VERSION"],
+            azure_endpoint=azure_config["END_POINT"],
+            http_client=self._http_client()
+        ))
+
+    def _get_gemini_chat_llm(self):
+        gemini_config = self.config["GeminiChat"]
+        return client_registry.get('gemini_chat', gemini_config, lambda: ChatGoogleGenerativeAI(
+            model=gemini_config["MODEL_NAME"],
+            google_api_key=gemini_config["KEY"],
+            model_kwargs={"streaming": True}
+        ))
+
+    def _get_ollama_llm(self):
+        ollama_config = self.config["OllamaLLM"]
+        return client_registry.get('ollama_llm', ollama_config, lambda: OllamaLLM(
+            model=ollama_config["MODEL_NAME"],
+            base_url=ollama_config["OLLAMA_CLIENT"]
+        ))
+
+    def _get_ollama_client(self):
+        ollama_config = self.config["OllamaLLM"]
+        http_config = self.config.get("HTTP") or {}
+        return client_registry.get('ollama_client', {**ollama_config, **http_config}, lambda: OllamaClient(
+            host=ollama_config["OLLAMA_CLIENT"],
+            timeout=http_config.get('timeout', 600.0)
+        ))
 
     def chat_stream(self, user_input, type='gemini'):
-        """流式聊天方法，產生流式回應"""
-        chat_map = {
+        """流式聊天方法，產生流式回應；主提供者首字過慢或失敗時對沖 / 切換至備援提供者"""
+        if type not in self._chat_map():
+            type = 'gemini'
+        role_description = self.config["Base"]["CHAT_ROLE_DESCRIPTION"]
+
+        def open_stream(chat_type):
+            # 對沖請求不排隊等待名額，備援提供者滿載時直接放棄
+            hedge = chat_type != type
+            return self._provider_stream(chat_type, user_input, role_description, hedge)
+
+        try:
+            if self.router is None:
+                yield from open_stream(type)
+            else:
+                providers = self.router.order(type, self._fallback_types(type))
+                yield from self.router.stream(providers, open_stream)
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            yield 'chat 模型需要升級，暫時無法提供服務'
+
+    def routed_stream(self, open_primary, prompt, type='gemini', primary_ticket=None):
+        """RAG 生成的串流：主提供者由呼叫端開啟（查詢引擎的合成器），首字過慢或失敗時以相同的 QA 提示詞
+        對沖 / 切換至備援提供者；primary_ticket 為呼叫端已取得的主提供者名額，主提供者落敗時立即歸還"""
+        role_description = self.config["Base"]["CHAT_ROLE_DESCRIPTION"]
+
+        def open_stream(chat_type):
+            if chat_type == type:
+                return ProviderStream(open_primary(), primary_ticket)
+            return self._provider_stream(chat_type, prompt, role_description, hedge=True)
+
+        if self.router is None:
+            return open_stream(type)
+        providers = self.router.order(type, self._fallback_types(type))
+        return self.router.stream(providers, open_stream)
+
+    async def achat_stream(self, user_input, type='gemini'):
+        """非同步流式聊天，供 ASGI 模式使用；主提供者在首字前失敗時依序切換備援提供者"""
+        achat_map = self._achat_map()
+        if type not in achat_map:
+            type = 'gemini'
+        role_description = self.config["Base"]["CHAT_ROLE_DESCRIPTION"]
+
+        try:
+            async for chunk in self._afailover(type, lambda chat_type: achat_map[chat_type](user_input, role_description)):
+                yield chunk
+        except AdmissionRejected:
+            raise
+        except Exception:
+            yield 'chat 模型需要升級，暫時無法提供服務'
+
+    async def arouted_stream(self, aopen_primary, prompt, type='gemini', primary_ticket=None):
+        """非同步 RAG 生成：主提供者（查詢引擎的合成器）在首字前失敗時，以相同的 QA 提示詞依序切換備援提供者"""
+        achat_map = self._achat_map()
+        role_description = self.config["Base"]["CHAT_ROLE_DESCRIPTION"]
+
+        def aopen(chat_type):
+            if chat_type == type:
+                return aopen_primary()
+            return achat_map[chat_type](prompt, role_description)
+
+        async for chunk in self._afailover(type, aopen, primary_ticket):
+            yield chunk
+
+    async def _afailover(self, type, aopen, primary_ticket=None):
+        """依路由順序嘗試提供者，首字前失敗時換下一個；全部失敗或出字後失敗時拋出最後的錯誤"""
+        providers = [type]
+        if self.router is not None:
+            providers = self.router.order(type, self._fallback_types(type))
+
+        last_error = None
+        for chat_type in providers:
+            ticket = primary_ticket if chat_type == type else None
+            started = False
+            try:
+                if self.admission is not None and ticket is None:
+                    # 准入控制使用執行緒號誌，在 worker thread 中等待以免阻塞事件迴圈
+                    timeout = 0 if chat_type != type else None
+                    ticket = await asyncio.to_thread(
+                        self.admission.acquire, CHAT_TYPE_PROVIDERS.get(chat_type, 'gemini'), timeout
+                    )
+                async for chunk in aopen(chat_type):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                last_error = e
+                if started:
+                    break
+                print(f"⚠️ {chat_type} 非同步串流失敗，嘗試下一個提供者: {e}")
+            finally:
+                if ticket is not None:
+                    ticket.release()
+
+        raise last_error
+
+    def _achat_map(self):
+        return {
+            'azure': self.azure_chat_astream,
+            'azure_completions': self.azure_completions_chat_astream,
+            'gemini': self.gemini_chat_astream,
+            'ollama': self.ollama_chat_astream,
+            'ollama_client': self.ollama_client_chat_astream,
+        }
+
+    def _get_async_azure_client(self):
+        azure_config = self.config["AzureOpenAIChat"]
+        return client_registry.get('azure_openai_async', azure_config, lambda: AsyncAzureOpenAI(
+            api_key=azure_config["KEY"],
+            api_version=azure_config["VERSION"],
+            azure_endpoint=azure_config["END_POINT"]
+        ))
+
+    def _get_async_ollama_client(self):
+        ollama_config = self.config["OllamaLLM"]
+        http_config = self.config.get("HTTP") or {}
+        return client_registry.get('ollama_client_async', {**ollama_config, **http_config}, lambda: AsyncOllamaClient(
+            host=ollama_config["OLLAMA_CLIENT"],
+            timeout=http_config.get('timeout', 600.0)
+        ))
+
+    async def azure_chat_astream(self, user_input, role_description):
+        """Azure 非同步流式聊天"""
+        messages = [("system", role_description), ("human", user_input)]
+        async for chunk in self._get_azure_chat_llm().astream(messages):
+            if hasattr(chunk, 'content') and chunk.content:
+                yield chunk.content
+
+    async def azure_completions_chat_astream(self, user_input, role_description):
+        """Azure Completions 非同步流式聊天"""
+        stream = await self._get_async_azure_client().chat.completions.create(
+            model=self.config["AzureOpenAIChat"]["DEPLOYMENT_NAME"],
+            messages=[
+                {"role": "system", "content": role_description},
+                {"role": "user", "content": user_input},
+            ],
+            temperature=0.7,
+            max_tokens=800,
+            top_p=0.95,
+            stream=True
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+
+    async def gemini_chat_astream(self, user_input, role_description):
+        """Gemini 非同步流式聊天"""
+        messages = [("system", role_description), ("human", user_input)]
+        async for chunk in self._get_gemini_chat_llm().astream(messages):
+            if hasattr(chunk, 'content') and chunk.content:
+                yield chunk.content
+
+    async def ollama_chat_astream(self, user_input, role_description):
+        """Ollama 非同步聊天（非串流模型，一次輸出）"""
+        messages = [("system", role_description), ("human", user_input)]
+        response = await self._get_ollama_llm().ainvoke(messages)
+        if response:
+            yield response
+
+    async def ollama_client_chat_astream(self, user_input, role_description):
+        """Ollama Client 非同步流式聊天"""
+        stream = await self._get_async_ollama_client().chat(
+            model=self.config["OllamaLLM"]["MODEL_NAME"],
+            messages=[
+                {"role": "system", "content": role_description},
+                {"role": "user", "content": user_input},
+            ],
+            stream=True
+        )
+        async for chunk in stream:
+            if chunk.get("message", {}).get("content"):
+                yield chunk["message"]["content"]
+
+    def _chat_map(self):
+        return {
             'azure': self.azure_chat_stream,
             'azure_completions': self.azure_completions_chat_stream,
             'gemini': self.gemini_chat_stream,
             'ollama': self.ollama_chat_stream,
             'ollama_client': self.ollama_client_chat_stream,
         }
-        
-        func = chat_map.get(type, self.gemini_chat_stream)
-        role_description = self.config["Base"]["CHAT_ROLE_DESCRIPTION"]
-        try:
-            yield from func(user_input, role_description)
-        except Exception as e:
-            yield 'chat 模型需要升級，暫時無法提供服務'
+
+    def _provider_stream(self, chat_type, user_input, role_description, hedge=False):
+        """單一提供者的串流，持有該提供者的並發名額直到結束或被關閉"""
+        func = self._chat_map()[chat_type]
+
+        # 取得提供者並發名額，滿載時拋出 AdmissionRejected 由呼叫端回應 429/503
+        ticket = None
+        if self.admission is not None:
+            ticket = self.admission.acquire(CHAT_TYPE_PROVIDERS.get(chat_type, 'gemini'), 0 if hedge else None)
+        return ProviderStream(func(user_input, role_description), ticket)
+
+    def _fallback_types(self, primary):
+        """已設定且可用的備援聊天類型"""
+        routing_config = self.config.get("Routing") or {}
+        fallbacks = routing_config.get('fallback_providers', [])
+        return [t for t in fallbacks if t != primary and t in self._chat_map() and self._is_configured(t)]
+
+    def _is_configured(self, chat_type):
+        provider = CHAT_TYPE_PROVIDERS.get(chat_type, 'gemini')
+        if provider == 'azure':
+            return bool(self.config["AzureOpenAIChat"].get("KEY") and self.config["AzureOpenAIChat"].get("END_POINT"))
+        if provider == 'ollama':
+            return bool(self.config["OllamaLLM"].get("MODEL_NAME"))
+        return bool(self.config["GeminiChat"].get("KEY"))
 
     def azure_chat_stream(self, user_input, role_description):
         """Azure 流式聊天"""
         try:
-            llm = AzureChatOpenAI(
-                openai_api_version=self.config["AzureOpenAIChat"]["VERSION"],
-                azure_deployment=self.config["AzureOpenAIChat"]["DEPLOYMENT_NAME"],
-                azure_endpoint=self.config["AzureOpenAIChat"]["END_POINT"],
-                api_key=self.config["AzureOpenAIChat"]["KEY"],
-                streaming=True
-            )
+            llm = self._get_azure_chat_llm()
             messages = [
                 ("system", role_description),
                 ("human", user_input),
             ]
             
-            for chunk in llm.stream(messages):
-                if hasattr(chunk, 'content') and chunk.content:
-                    yield chunk.content
+            stream = llm.stream(messages)
+            try:
+                for chunk in stream:
+                    if hasattr(chunk, 'content') and chunk.content:
+                        yield chunk.content
+            finally:
+                # 客戶端斷線時 GeneratorExit 會傳到這裡，立即關閉上游串流
+                close_upstream(stream)
         except Exception as e:
-            print(f"Azure Completions Chat Stream Error: {e}")
-            yield 'chat 模型需要升級，暫時無法提供服務'
+            print(f"Azure Chat Stream Error: {e}")
+            raise
 
     def azure_completions_chat_stream(self, user_input, role_description, message_text=None):
         """Azure Completions 流式聊天"""
         try:
-            client = AzureOpenAI(
-                api_key=self.config["AzureOpenAIChat"]["KEY"],
-                api_version=self.config["AzureOpenAIChat"]["VERSION"],
-                azure_endpoint=self.config["AzureOpenAIChat"]["END_POINT"],
-            )
+            client = self._get_azure_client()
             
             if message_text is None:
                 message_text = [
@@ -78,32 +360,36 @@ class ChatStreamService:
                 stream=True
             )
             
-            for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+            try:
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                close_upstream(stream)
                     
         except Exception as e:
             print(f"Azure Completions Chat Stream Error: {e}")
-            yield 'chat 模型需要升級，暫時無法提供服務'
+            raise
 
     def gemini_chat_stream(self, user_input, role_description):
         """Gemini 流式聊天"""
         try:
-            llm_gemini = ChatGoogleGenerativeAI(
-                model=self.config["GeminiChat"]["MODEL_NAME"],
-                google_api_key=self.config["GeminiChat"]["KEY"],
-                model_kwargs={"streaming": True}
-            )
+            llm_gemini = self._get_gemini_chat_llm()
             messages = [
                 ("system", role_description),
                 ("human", user_input),
             ]
             
-            for chunk in llm_gemini.stream(messages):
-                if hasattr(chunk, 'content') and chunk.content:
-                    yield chunk.content
+            stream = llm_gemini.stream(messages)
+            try:
+                for chunk in stream:
+                    if hasattr(chunk, 'content') and chunk.content:
+                        yield chunk.content
+            finally:
+                close_upstream(stream)
         except Exception as e:
-            yield 'chat 模型需要升級，暫時無法提供服務'
+            print(f"Gemini Chat Stream Error: {e}")
+            raise
         
     def ollama_chat_stream(self, user_input, role_description):
         """Ollama 流式聊天"""
@@ -113,7 +399,7 @@ class ChatStreamService:
                 ("human", user_input),
             ]
 
-            ollama_llm = OllamaLLM(model=self.config["OllamaLLM"]["MODEL_NAME"])
+            ollama_llm = self._get_ollama_llm()
             
             # OllamaLLM 可能不支援流式，這裡模擬分塊發送
             response = ollama_llm.invoke(messages)
@@ -130,13 +416,13 @@ class ChatStreamService:
                 time.sleep(0.1)  # 模擬網路延遲
                 
         except Exception as e:
-            yield 'chat 模型需要升級，暫時無法提供服務'
+            print(f"Ollama Chat Stream Error: {e}")
+            raise
 
     def ollama_client_chat_stream(self, user_input, role_description):
         """Ollama Client 流式聊天"""
         try:
-            # 使用 Config 類提供的動態 OLLAMA_CLIENT URL
-            client = OllamaClient(host=Config.OLLAMA_CLIENT)
+            client = self._get_ollama_client()
             
             stream = client.chat(
                 model=self.config["OllamaLLM"]["MODEL_NAME"],
@@ -153,9 +439,13 @@ class ChatStreamService:
                 stream=True
             )
             
-            for chunk in stream:
-                if chunk.get("message", {}).get("content"):
-                    yield chunk["message"]["content"]
+            try:
+                for chunk in stream:
+                    if chunk.get("message", {}).get("content"):
+                        yield chunk["message"]["content"]
+            finally:
+                close_upstream(stream)
                     
         except Exception as e:
-            yield 'chat 模型需要升級，暫時無法提供服務'
+            print(f"Ollama Client Chat Stream Error: {e}")
+            raise
@@ -0,0 +1,103 @@
+import os
+import json
+import hashlib
+import threading
+from typing import Any, Callable, Dict, Optional
+from .metrics import metrics
+
+
+class ClientRegistry:
+    """行程級客戶端註冊表，依提供者與配置指紋重用 LLM / HTTP 客戶端
+
+    - 同一提供者在配置不變時共用同一個客戶端（保留 keep-alive 連線與 TLS session）
+    - 配置指紋改變時關閉舊客戶端並重建
+    - fork 之後子行程會丟棄繼承的客戶端，避免與父行程共用 socket
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, tuple] = {}
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+
+    @staticmethod
+    def fingerprint(config: Dict[str, Any]) -> str:
+        payload = json.dumps(config, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+    def get(self, provider: str, config: Dict[str, Any], factory: Callable[[], Any]):
+        """取得提供者客戶端，不存在或配置已變更時以 factory 建立"""
+        self._check_fork()
+        fingerprint = self.fingerprint(config)
+
+        with self._lock:
+            entry = self._clients.get(provider)
+            if entry is not None and entry[0] == fingerprint:
+                return entry[1]
+
+            if entry is not None:
+                print(f"🔄 {provider} 配置已變更，重建客戶端")
+                self._close(entry[1])
+                metrics.incr('client_registry_invalidated_total')
+
+            client = factory()
+            self._clients[provider] = (fingerprint, client)
+            metrics.incr('client_registry_created_total')
+            return client
+
+    def invalidate(self, provider: Optional[str] = None):
+        """移除指定提供者（或全部）的客戶端"""
+        with self._lock:
+            providers = [provider] if provider else list(self._clients)
+            for name in providers:
+                entry = self._clients.pop(name, None)
+                if entry is not None:
+                    self._close(entry[1])
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._reset_after_fork()
+
+    def _reset_after_fork(self):
+        # 子行程不能關閉父行程的連線，只丟棄引用
+        self._clients = {}
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _close(client):
+        close = getattr(client, 'close', None)
+        if callable(close):
+            try:
+                close()
+            except Exception as e:
+                print(f"⚠️ 關閉客戶端失敗: {e}")
+
+
+# 全域客戶端註冊表
+client_registry = ClientRegistry()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=client_registry._reset_after_fork)
+
+
+def get_http_client(http_config: Optional[Dict[str, Any]] = None):
+    """取得共用的 httpx 連線池（keep-alive），供 OpenAI / Ollama 等 SDK 使用"""
+    import httpx
+
+    http_config = http_config or {}
+    max_connections = http_config.get('max_connections', 100)
+    max_keepalive = http_config.get('max_keepalive_connections', 20)
+    keepalive_expiry = http_config.get('keepalive_expiry', 60.0)
+    timeout = http_config.get('timeout', 600.0)
+
+    def factory():
+        return httpx.Client(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=keepalive_expiry
+            ),
+            timeout=httpx.Timeout(timeout, connect=10.0)
+        )
+
+    return client_registry.get('http', http_config, factory)
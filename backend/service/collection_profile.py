@@ -0,0 +1,91 @@
+from typing import Any, Dict
+
+
+QUANTIZATION_MODES = ('none', 'scalar', 'binary', 'product')
+PQ_COMPRESSION_RATIOS = ('x4', 'x8', 'x16', 'x32', 'x64')
+
+
+def _check(profile: Dict[str, Any]):
+    if profile['quantization'] not in QUANTIZATION_MODES:
+        raise ValueError(f"未知的量化方式: {profile['quantization']}（可用: {', '.join(QUANTIZATION_MODES)}）")
+    if profile['quantization'] == 'product' and profile['pq_compression'] not in PQ_COMPRESSION_RATIOS:
+        raise ValueError(f"未知的 PQ 壓縮比: {profile['pq_compression']}（可用: {', '.join(PQ_COMPRESSION_RATIOS)}）")
+
+
+def quantization_config(profile: Dict[str, Any]):
+    """依設定檔建立集合層級的量化設定；none 時返回 None（全精度）
+
+    量化向量常駐記憶體（always_ram），原始向量可搭配 on_disk 放在磁碟，
+    查詢時先以量化向量取得候選，再以原始向量重新評分（見 search_params）。
+    """
+    from qdrant_client import models
+
+    _check(profile)
+    mode = profile['quantization']
+    if mode == 'scalar':
+        return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8,
+            quantile=profile['quantile'],
+            always_ram=profile['always_ram']
+        ))
+    if mode == 'binary':
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(
+            always_ram=profile['always_ram']
+        ))
+    if mode == 'product':
+        return models.ProductQuantization(product=models.ProductQuantizationConfig(
+            compression=models.CompressionRatio(profile['pq_compression']),
+            always_ram=profile['always_ram']
+        ))
+    return None
+
+
+def hnsw_config(profile: Dict[str, Any]):
+    from qdrant_client import models
+
+    return models.HnswConfigDiff(m=profile['hnsw_m'], ef_construct=profile['hnsw_ef_construct'])
+
+
+def dense_vector_params(size: int, profile: Dict[str, Any], distance=None):
+    """建立密集向量設定（含 on_disk 與 HNSW 參數）"""
+    from qdrant_client import models
+
+    return models.VectorParams(
+        size=size,
+        distance=distance or models.Distance.COSINE,
+        on_disk=profile['on_disk'],
+        hnsw_config=hnsw_config(profile)
+    )
+
+
+def apply_to_vector_params(params, profile: Dict[str, Any]):
+    """以本節點的設定檔覆寫既有的密集向量設定（維度與距離保持不變）"""
+    return params.model_copy(update={'on_disk': profile['on_disk'], 'hnsw_config': hnsw_config(profile)})
+
+
+def search_params(profile: Dict[str, Any]):
+    """查詢參數：量化集合的重新評分與過量取樣、HNSW ef；皆為預設值時返回 None"""
+    from qdrant_client import models
+
+    _check(profile)
+    quantization = None
+    if profile['quantization'] != 'none':
+        quantization = models.QuantizationSearchParams(
+            ignore=False,
+            rescore=profile['rescore'],
+            oversampling=profile['oversampling'] if profile['oversampling'] > 1.0 else None
+        )
+    hnsw_ef = profile['hnsw_ef'] or None
+    if quantization is None and hnsw_ef is None:
+        return None
+    return models.SearchParams(hnsw_ef=hnsw_ef, quantization=quantization)
+
+
+def describe(profile: Dict[str, Any]) -> str:
+    parts = [f"quantization={profile['quantization']}"]
+    if profile['quantization'] == 'product':
+        parts.append(f"compression={profile['pq_compression']}")
+    if profile['quantization'] != 'none':
+        parts.append(f"rescore={profile['rescore']} oversampling={profile['oversampling']}")
+    parts.append(f"on_disk={profile['on_disk']} m={profile['hnsw_m']} ef_construct={profile['hnsw_ef_construct']}")
+    return ' '.join(parts)
@@ -1,6 +1,6 @@
 import configparser
 import os
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 
 class ConfigManager:
@@ -35,12 +35,24 @@ class ConfigManager:
         if 'QDRANT' in self.config:
             return {
                 'url': self.config.get('QDRANT', 'URL', fallback=''),
-                'api_key': self.config.get('QDRANT', 'API_KEY', fallback='')
+                'api_key': self.config.get('QDRANT', 'API_KEY', fallback=''),
+                'prefer_grpc': self.config.getboolean('QDRANT', 'PREFER_GRPC', fallback=False),
+                'grpc_port': self.config.getint('QDRANT', 'GRPC_PORT', fallback=6334),
+                'timeout': self.config.getint('QDRANT', 'TIMEOUT', fallback=60),
+                'max_connections': self.config.getint('QDRANT', 'MAX_CONNECTIONS', fallback=50),
+                'upsert_batch_size': self.config.getint('QDRANT', 'UPSERT_BATCH_SIZE', fallback=64),
+                'upsert_parallel': self.config.getint('QDRANT', 'UPSERT_PARALLEL', fallback=1)
             }
             
         return {
             'url': '',
-            'api_key': ''
+            'api_key': '',
+            'prefer_grpc': False,
+            'grpc_port': 6334,
+            'timeout': 60,
+            'max_connections': 50,
+            'upsert_batch_size': 64,
+            'upsert_parallel': 1
         }
     
     def get_azure_config(self) -> Dict[str, Any]:
@@ -108,12 +120,354 @@ class ConfigManager:
             
             return {
                 'allowed_extensions': allowed_extensions,
-                'max_file_size': self.config.getint('Upload', 'MAX_FILE_SIZE', fallback=16 * 1024 * 1024)  # 16MB
+                'max_file_size': self.config.getint('Upload', 'MAX_FILE_SIZE', fallback=16 * 1024 * 1024),  # 16MB
+                # 串流 / 續傳上傳的大小上限，0 表示不限制（邊收邊寫入磁碟，不受記憶體限制）
+                'stream_max_size': self.config.getint('Upload', 'STREAM_MAX_SIZE', fallback=0)
             }
             
         return {
             'allowed_extensions': {'pdf'},
-            'max_file_size': 16 * 1024 * 1024  # 16MB
+            'max_file_size': 16 * 1024 * 1024,  # 16MB
+            'stream_max_size': 0
+        }
+
+    def get_http_config(self) -> Dict[str, Any]:
+        """獲取共用 HTTP 連線池配置"""
+        if 'HTTP' in self.config:
+            return {
+                'max_connections': self.config.getint('HTTP', 'MAX_CONNECTIONS', fallback=100),
+                'max_keepalive_connections': self.config.getint('HTTP', 'MAX_KEEPALIVE_CONNECTIONS', fallback=20),
+                'keepalive_expiry': self.config.getfloat('HTTP', 'KEEPALIVE_EXPIRY', fallback=60.0),
+                'timeout': self.config.getfloat('HTTP', 'TIMEOUT', fallback=600.0)
+            }
+
+        return {
+            'max_connections': 100,
+            'max_keepalive_connections': 20,
+            'keepalive_expiry': 60.0,
+            'timeout': 600.0
+        }
+
+    def get_admission_config(self) -> Dict[str, Any]:
+        """獲取各 LLM 提供者的並發上限與等待佇列配置"""
+        defaults = {
+            'gemini': {'max_concurrency': 8, 'max_queue': 32, 'queue_timeout': 10.0},
+            'azure': {'max_concurrency': 8, 'max_queue': 32, 'queue_timeout': 10.0},
+            # 本地 Ollama 一次只能穩定服務少量生成
+            'ollama': {'max_concurrency': 1, 'max_queue': 8, 'queue_timeout': 30.0}
+        }
+        if 'Admission' not in self.config:
+            return defaults
+
+        limits = {}
+        for provider, default in defaults.items():
+            prefix = provider.upper()
+            limits[provider] = {
+                'max_concurrency': self.config.getint('Admission', f'{prefix}_MAX_CONCURRENCY', fallback=default['max_concurrency']),
+                'max_queue': self.config.getint('Admission', f'{prefix}_MAX_QUEUE', fallback=default['max_queue']),
+                'queue_timeout': self.config.getfloat('Admission', f'{prefix}_QUEUE_TIMEOUT', fallback=default['queue_timeout'])
+            }
+        return limits
+
+    def get_admission_slot_dir(self) -> Optional[str]:
+        """跨行程共用提供者並發名額的鎖檔目錄；SHARED_LIMITS 關閉時返回 None（每個行程各自計算上限）"""
+        if 'Admission' in self.config and not self.config.getboolean('Admission', 'SHARED_LIMITS', fallback=True):
+            return None
+        return os.path.join(self.get_ingestion_config()['job_dir'], 'admission')
+
+    def get_stream_spool_dir(self) -> Optional[str]:
+        """可續傳串流的共用事件檔目錄，續傳請求落在其他 gunicorn worker 時也能接上；SHARED_RESUME 關閉時返回 None"""
+        if 'Stream' in self.config and not self.config.getboolean('Stream', 'SHARED_RESUME', fallback=True):
+            return None
+        return os.path.join(self.get_ingestion_config()['job_dir'], 'streams')
+
+    def get_routing_config(self) -> Dict[str, Any]:
+        """獲取聊天提供者路由（對沖 / 備援）配置"""
+        defaults = {
+            'hedge_enabled': True,
+            'fallback_providers': ['gemini', 'azure_completions', 'ollama_client'],
+            'hedge_min_delay': 1.0,
+            'hedge_max_delay': 10.0,
+            'hedge_default_delay': 3.0,
+            'error_rate_threshold': 0.5,
+            'stats_window': 100
+        }
+        if 'Routing' not in self.config:
+            return defaults
+
+        providers = self.config.get('Routing', 'FALLBACK_PROVIDERS', fallback=','.join(defaults['fallback_providers'])).split(',')
+        return {
+            'hedge_enabled': self.config.getboolean('Routing', 'HEDGE_ENABLED', fallback=defaults['hedge_enabled']),
+            'fallback_providers': [p.strip() for p in providers if p.strip()],
+            'hedge_min_delay': self.config.getfloat('Routing', 'HEDGE_MIN_DELAY', fallback=defaults['hedge_min_delay']),
+            'hedge_max_delay': self.config.getfloat('Routing', 'HEDGE_MAX_DELAY', fallback=defaults['hedge_max_delay']),
+            'hedge_default_delay': self.config.getfloat('Routing', 'HEDGE_DEFAULT_DELAY', fallback=defaults['hedge_default_delay']),
+            'error_rate_threshold': self.config.getfloat('Routing', 'ERROR_RATE_THRESHOLD', fallback=defaults['error_rate_threshold']),
+            'stats_window': self.config.getint('Routing', 'STATS_WINDOW', fallback=defaults['stats_window'])
+        }
+
+    def get_ingestion_config(self) -> Dict[str, Any]:
+        """獲取索引工作佇列與 ingestion worker 配置"""
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        if 'Ingestion' in self.config:
+            return {
+                'mode': self.config.get('Ingestion', 'MODE', fallback='process'),
+                'job_dir': os.path.join(base_dir, self.config.get('Ingestion', 'JOB_DIR', fallback='./jobs')),
+                'poll_interval': self.config.getfloat('Ingestion', 'POLL_INTERVAL', fallback=0.5),
+                'batch_pages': self.config.getint('Ingestion', 'BATCH_PAGES', fallback=32),
+                'embed_batch_size': self.config.getint('Ingestion', 'EMBED_BATCH_SIZE', fallback=64),
+                'embed_concurrency': self.config.getint('Ingestion', 'EMBED_CONCURRENCY', fallback=4),
+                'node_store_dir': os.path.join(base_dir, self.config.get('Ingestion', 'NODE_STORE_DIR', fallback='./node_store'))
+            }
+
+        return {
+            'mode': 'process',
+            'job_dir': os.path.join(base_dir, './jobs'),
+            'poll_interval': 0.5,
+            'batch_pages': 32,
+            'embed_batch_size': 64,
+            'embed_concurrency': 4,
+            'node_store_dir': os.path.join(base_dir, './node_store')
+        }
+
+    def get_scheduler_config(self) -> Dict[str, Any]:
+        """獲取互動查詢與 ingestion 共用提供者配額的優先權排程配置"""
+        ingestion_config = self.get_ingestion_config()
+        defaults = {
+            'capacity': 8,
+            'interactive_share': 0.5,
+            'ingestion_share': 0.125,
+            'queue_timeout': 30.0,
+            'board_dir': os.path.join(ingestion_config['job_dir'], 'scheduler')
+        }
+        if 'Scheduler' not in self.config:
+            return defaults
+
+        return {
+            'capacity': self.config.getint('Scheduler', 'CAPACITY', fallback=defaults['capacity']),
+            'interactive_share': self.config.getfloat('Scheduler', 'INTERACTIVE_SHARE', fallback=defaults['interactive_share']),
+            'ingestion_share': self.config.getfloat('Scheduler', 'INGESTION_SHARE', fallback=defaults['ingestion_share']),
+            'queue_timeout': self.config.getfloat('Scheduler', 'QUEUE_TIMEOUT', fallback=defaults['queue_timeout']),
+            'board_dir': defaults['board_dir']
+        }
+
+    def get_snapshot_config(self) -> Dict[str, Any]:
+        """獲取索引快照匯出 / 匯入配置"""
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        if 'Snapshot' in self.config:
+            return {
+                'snapshot_dir': os.path.join(base_dir, self.config.get('Snapshot', 'DIR', fallback='./snapshots')),
+                'scroll_batch_size': self.config.getint('Snapshot', 'SCROLL_BATCH_SIZE', fallback=1024)
+            }
+
+        return {
+            'snapshot_dir': os.path.join(base_dir, './snapshots'),
+            'scroll_batch_size': 1024
+        }
+
+    def get_admin_config(self) -> Dict[str, Any]:
+        """獲取管理 API（/api/admin/*）的存取設定；未設定 TOKEN 時只接受本機請求"""
+        if 'Admin' in self.config:
+            return {
+                'token': self.config.get('Admin', 'TOKEN', fallback='').strip()
+            }
+
+        return {
+            'token': ''
+        }
+
+    def get_collection_config(self) -> Dict[str, Any]:
+        """獲取 Qdrant 集合設定檔：量化、on_disk 向量與 HNSW 參數"""
+        defaults = {
+            'quantization': 'none',
+            'quantile': 0.99,
+            'always_ram': True,
+            'pq_compression': 'x16',
+            'rescore': True,
+            'oversampling': 2.0,
+            'on_disk': False,
+            'hnsw_m': 16,
+            'hnsw_ef_construct': 100,
+            'hnsw_ef': 0,
+            'vector_size': 0
+        }
+        if 'Collection' not in self.config:
+            return defaults
+
+        return {
+            'quantization': self.config.get('Collection', 'QUANTIZATION', fallback=defaults['quantization']).strip().lower(),
+            'quantile': self.config.getfloat('Collection', 'QUANTILE', fallback=defaults['quantile']),
+            'always_ram': self.config.getboolean('Collection', 'ALWAYS_RAM', fallback=defaults['always_ram']),
+            'pq_compression': self.config.get('Collection', 'PQ_COMPRESSION', fallback=defaults['pq_compression']).strip().lower(),
+            'rescore': self.config.getboolean('Collection', 'RESCORE', fallback=defaults['rescore']),
+            'oversampling': self.config.getfloat('Collection', 'OVERSAMPLING', fallback=defaults['oversampling']),
+            'on_disk': self.config.getboolean('Collection', 'ON_DISK', fallback=defaults['on_disk']),
+            'hnsw_m': self.config.getint('Collection', 'HNSW_M', fallback=defaults['hnsw_m']),
+            'hnsw_ef_construct': self.config.getint('Collection', 'HNSW_EF_CONSTRUCT', fallback=defaults['hnsw_ef_construct']),
+            'hnsw_ef': self.config.getint('Collection', 'HNSW_EF', fallback=defaults['hnsw_ef']),
+            'vector_size': self.config.getint('Collection', 'VECTOR_SIZE', fallback=defaults['vector_size'])
+        }
+
+    def get_projection_config(self) -> Dict[str, Any]:
+        """獲取嵌入降維配置：Matryoshka 截斷或 PCA，查詢候選以全精度向量重新評分"""
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        if 'Projection' in self.config:
+            return {
+                'mode': self.config.get('Projection', 'MODE', fallback='none').strip().lower(),
+                'dim': self.config.getint('Projection', 'DIM', fallback=256),
+                'rescore': self.config.getboolean('Projection', 'RESCORE', fallback=True),
+                'oversampling': self.config.getfloat('Projection', 'OVERSAMPLING', fallback=4.0),
+                'pca_fit_samples': self.config.getint('Projection', 'PCA_FIT_SAMPLES', fallback=4096),
+                'projection_dir': os.path.join(base_dir, self.config.get('Projection', 'DIR', fallback='./projection'))
+            }
+
+        return {
+            'mode': 'none',
+            'dim': 256,
+            'rescore': True,
+            'oversampling': 4.0,
+            'pca_fit_samples': 4096,
+            'projection_dir': os.path.join(base_dir, './projection')
+        }
+
+    def get_document_routing_config(self) -> Dict[str, Any]:
+        """獲取兩階段檢索配置：先以文件向量挑選文件，再只在這些文件中搜尋段落"""
+        if 'DocumentRouting' in self.config:
+            return {
+                'enabled': self.config.getboolean('DocumentRouting', 'ENABLED', fallback=True),
+                'top_documents': self.config.getint('DocumentRouting', 'TOP_DOCUMENTS', fallback=5),
+                'section_pages': self.config.getint('DocumentRouting', 'SECTION_PAGES', fallback=0),
+                'count_cache_seconds': self.config.getfloat('DocumentRouting', 'COUNT_CACHE_SECONDS', fallback=30.0)
+            }
+
+        return {
+            'enabled': True,
+            'top_documents': 5,
+            'section_pages': 0,
+            'count_cache_seconds': 30.0
+        }
+
+    def get_boilerplate_config(self) -> Dict[str, Any]:
+        """獲取切塊前移除逐頁重複頁首、頁尾與頁碼的配置"""
+        if 'Boilerplate' in self.config:
+            return {
+                'enabled': self.config.getboolean('Boilerplate', 'ENABLED', fallback=True),
+                'edge_lines': self.config.getint('Boilerplate', 'EDGE_LINES', fallback=3),
+                'min_fraction': self.config.getfloat('Boilerplate', 'MIN_FRACTION', fallback=0.6),
+                'min_pages': self.config.getint('Boilerplate', 'MIN_PAGES', fallback=4)
+            }
+
+        return {
+            'enabled': True,
+            'edge_lines': 3,
+            'min_fraction': 0.6,
+            'min_pages': 4
+        }
+
+    def get_dedup_config(self) -> Dict[str, Any]:
+        """獲取建立索引時的近似重複段落剔除配置（SimHash，嵌入之前執行）"""
+        if 'Dedup' in self.config:
+            return {
+                'enabled': self.config.getboolean('Dedup', 'ENABLED', fallback=True),
+                'max_distance': self.config.getint('Dedup', 'MAX_DISTANCE', fallback=3),
+                'shingle': self.config.getint('Dedup', 'SHINGLE', fallback=5),
+                'min_chars': self.config.getint('Dedup', 'MIN_CHARS', fallback=50),
+                'scope': self.config.get('Dedup', 'SCOPE', fallback='document')
+            }
+
+        return {
+            'enabled': True,
+            'max_distance': 3,
+            'shingle': 5,
+            'min_chars': 50,
+            'scope': 'document'
+        }
+
+    def get_context_packing_config(self) -> Dict[str, Any]:
+        """獲取查詢時上下文打包配置：依 token 預算挑選候選段落並合併同頁段落"""
+        if 'ContextPacking' in self.config:
+            return {
+                'enabled': self.config.getboolean('ContextPacking', 'ENABLED', fallback=True),
+                'token_budget': self.config.getint('ContextPacking', 'TOKEN_BUDGET', fallback=3000),
+                'candidates': self.config.getint('ContextPacking', 'CANDIDATES', fallback=10),
+                'merge_adjacent': self.config.getboolean('ContextPacking', 'MERGE_ADJACENT', fallback=True)
+            }
+
+        return {
+            'enabled': True,
+            'token_budget': 3000,
+            'candidates': 10,
+            'merge_adjacent': True
+        }
+
+    def get_search_config(self) -> Dict[str, Any]:
+        """獲取純檢索 API（/api/search、/api/search/batch）與批次問答（/api/answer/batch）配置"""
+        if 'Search' in self.config:
+            return {
+                'mode': self.config.get('Search', 'MODE', fallback='hybrid'),
+                'alpha': self.config.getfloat('Search', 'ALPHA', fallback=0.5),
+                'top_k': self.config.getint('Search', 'TOP_K', fallback=5),
+                'max_top_k': self.config.getint('Search', 'MAX_TOP_K', fallback=50),
+                'max_batch_queries': self.config.getint('Search', 'MAX_BATCH_QUERIES', fallback=256),
+                'max_query_chars': self.config.getint('Search', 'MAX_QUERY_CHARS', fallback=2000),
+                'max_batch_questions': self.config.getint('Search', 'MAX_BATCH_QUESTIONS', fallback=1000),
+                'answer_concurrency': self.config.getint('Search', 'ANSWER_CONCURRENCY', fallback=4),
+                'answer_queue_timeout': self.config.getfloat('Search', 'ANSWER_QUEUE_TIMEOUT', fallback=120.0)
+            }
+
+        return {
+            'mode': 'hybrid',
+            'alpha': 0.5,
+            'top_k': 5,
+            'max_top_k': 50,
+            'max_batch_queries': 256,
+            'max_query_chars': 2000,
+            'max_batch_questions': 1000,
+            'answer_concurrency': 4,
+            'answer_queue_timeout': 120.0
+        }
+
+    def get_summarize_config(self) -> Dict[str, Any]:
+        """獲取整份文件 map-reduce 摘要配置"""
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        if 'Summarize' in self.config:
+            return {
+                'cache_dir': os.path.join(base_dir, self.config.get('Summarize', 'CACHE_DIR', fallback='./summary_cache')),
+                'map_group_tokens': self.config.getint('Summarize', 'MAP_GROUP_TOKENS', fallback=6000),
+                'reduce_group_tokens': self.config.getint('Summarize', 'REDUCE_GROUP_TOKENS', fallback=6000),
+                'concurrency': self.config.getint('Summarize', 'CONCURRENCY', fallback=4),
+                'queue_timeout': self.config.getfloat('Summarize', 'QUEUE_TIMEOUT', fallback=120.0)
+            }
+
+        return {
+            'cache_dir': os.path.join(base_dir, './summary_cache'),
+            'map_group_tokens': 6000,
+            'reduce_group_tokens': 6000,
+            'concurrency': 4,
+            'queue_timeout': 120.0
+        }
+
+    def get_stream_config(self) -> Dict[str, Any]:
+        """獲取 SSE 串流輸出配置"""
+        if 'Stream' in self.config:
+            return {
+                'flush_interval_ms': self.config.getint('Stream', 'FLUSH_INTERVAL_MS', fallback=50),
+                'flush_max_bytes': self.config.getint('Stream', 'FLUSH_MAX_BYTES', fallback=1024),
+                'resume_max_streams': self.config.getint('Stream', 'RESUME_MAX_STREAMS', fallback=256),
+                'resume_buffer_events': self.config.getint('Stream', 'RESUME_BUFFER_EVENTS', fallback=2048),
+                'resume_ttl_seconds': self.config.getfloat('Stream', 'RESUME_TTL_SECONDS', fallback=300),
+                'resume_grace_seconds': self.config.getfloat('Stream', 'RESUME_GRACE_SECONDS', fallback=30),
+                'wsgi_workers': self.config.getint('Stream', 'WSGI_WORKERS', fallback=64)
+            }
+
+        return {
+            'flush_interval_ms': 50,
+            'flush_max_bytes': 1024,
+            'resume_max_streams': 256,
+            'resume_buffer_events': 2048,
+            'resume_ttl_seconds': 300,
+            'resume_grace_seconds': 30,
+            'wsgi_workers': 64
         }
 
     def get_complete_config(self) -> tuple[Dict[str, Any], Dict[str, Any]]:
@@ -126,6 +480,8 @@ class ConfigManager:
         azure_config = self.get_azure_config()
         ollama_config = self.get_ollama_config()
         upload_config = self.get_upload_config()
+        http_config = self.get_http_config()
+        routing_config = self.get_routing_config()
         
         # 簡化配置格式
         config = {
@@ -141,7 +497,8 @@ class ConfigManager:
             'port_backend': base_config['port_backend'],
             'chat_role_description': base_config['chat_role_description'],
             'allowed_extensions': upload_config['allowed_extensions'],
-            'max_file_size': upload_config['max_file_size']
+            'max_file_size': upload_config['max_file_size'],
+            'stream_max_size': upload_config['stream_max_size']
         }
         
         # 兼容現有 ChatService 的格式
@@ -169,8 +526,18 @@ class ConfigManager:
                 'ALLOWED_EXTENSIONS': ','.join(config['allowed_extensions']),
                 'MAX_FILE_SIZE': config['max_file_size']
             },
-            'AzureOpenAIChat': azure_config,
-            'OllamaLLM': ollama_config
+            'AzureOpenAIChat': {
+                'KEY': azure_config['api_key'],
+                'END_POINT': azure_config['endpoint'],
+                'DEPLOYMENT_NAME': azure_config['deployment_name'],
+                'VERSION': azure_config['api_version']
+            },
+            'OllamaLLM': {
+                'MODEL_NAME': ollama_config['model_name'],
+                'OLLAMA_CLIENT': ollama_config['client_url']
+            },
+            'HTTP': http_config,
+            'Routing': routing_config
         }
         
         return config, config_sections
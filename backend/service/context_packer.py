@@ -0,0 +1,101 @@
+import uuid
+import hashlib
+from typing import Dict, List, Optional
+
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.core.utils import get_tokenizer
+from .metrics import metrics
+from .query_filters import DOC_ID_KEY, PAGE_NUMBER_KEY, TOKEN_COUNT_KEY
+
+
+def node_tokens(node) -> int:
+    """索引時預先計算的 token 數；較早建立的集合沒有時才即時計算"""
+    count = node.metadata.get(TOKEN_COUNT_KEY)
+    if count is None:
+        count = len(get_tokenizer()(node.get_content()))
+    return count
+
+
+def context_usage(nodes: Optional[List[NodeWithScore]]) -> Dict[str, int]:
+    """回答實際使用的上下文大小，供每個請求回報"""
+    nodes = nodes or []
+    return {'context_tokens': sum(node_tokens(n.node) for n in nodes), 'context_chunks': len(nodes)}
+
+
+class ContextPacker(BaseNodePostprocessor):
+    """依 token 預算打包上下文
+
+    依分數由高到低貪婪挑選候選段落，放不下的段落略過、改試較短的段落；
+    內容重複的段落只保留一個，挑出的同頁段落依原文順序合併為一段，省下重複的 metadata 標頭。
+    第一個段落即超過預算時仍會保留，避免沒有任何上下文。
+    """
+
+    token_budget: int = 3000
+    merge_adjacent: bool = True
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextPacker"
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        selected = []
+        seen = set()
+        used = 0
+        dropped = 0
+        for n in sorted(nodes, key=lambda n: n.score or 0.0, reverse=True):
+            digest = hashlib.sha1(n.node.get_content().encode('utf-8')).digest()
+            if n.node.node_id in seen or digest in seen:
+                dropped += 1
+                continue
+            tokens = node_tokens(n.node)
+            if selected and used + tokens > self.token_budget:
+                continue
+            seen.update((n.node.node_id, digest))
+            selected.append(n)
+            used += tokens
+
+        if self.merge_adjacent:
+            selected = self._merge_pages(selected)
+        metrics.incr('context_packer_duplicates_total', dropped)
+        metrics.observe('context_packed_tokens', used)
+        return selected
+
+    @staticmethod
+    def _merge_pages(nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """同一文件同一頁的段落合併為一個節點，順序與分數取該頁分數最高的段落；
+        合併後的 id 由成員 id 決定，不會與單獨使用的段落混淆"""
+        pages: Dict[tuple, List[NodeWithScore]] = {}
+        order = []
+        for n in nodes:
+            metadata = n.node.metadata
+            if metadata.get(PAGE_NUMBER_KEY) is None:
+                key = ('', n.node.node_id)
+            else:
+                key = (metadata.get(DOC_ID_KEY) or metadata.get('file_name'), metadata[PAGE_NUMBER_KEY])
+            if key not in pages:
+                pages[key] = []
+                order.append(key)
+            pages[key].append(n)
+
+        merged = []
+        for key in order:
+            group = pages[key]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            group = sorted(group, key=lambda n: n.node.start_char_idx or 0)
+            first = group[0].node
+            node = TextNode(
+                id_=str(uuid.uuid5(uuid.NAMESPACE_OID, '|'.join(n.node.node_id for n in group))),
+                text='\n'.join(n.node.get_content() for n in group),
+                metadata={**first.metadata, TOKEN_COUNT_KEY: sum(node_tokens(n.node) for n in group)},
+                excluded_embed_metadata_keys=list(first.excluded_embed_metadata_keys),
+                excluded_llm_metadata_keys=list(first.excluded_llm_metadata_keys),
+                start_char_idx=first.start_char_idx,
+                end_char_idx=group[-1].node.end_char_idx,
+                relationships=first.relationships
+            )
+            merged.append(NodeWithScore(node=node, score=max(n.score or 0.0 for n in group)))
+        return merged
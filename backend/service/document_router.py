@@ -0,0 +1,303 @@
+import time
+import uuid
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import BaseNode, NodeWithScore, QueryBundle
+from . import collection_profile
+from .metrics import metrics
+from .query_filters import (
+    QueryFilter, ensure_payload_indexes,
+    DOC_ID_KEY, DOC_SECTION_KEY, FILE_NAME_KEY, UPLOADED_AT_KEY
+)
+
+
+KIND_DOCUMENT = 'document'
+KIND_SECTION = 'section'
+DOCUMENT_PAYLOAD_INDEXES = (
+    (DOC_ID_KEY, 'keyword'),
+    ('kind', 'keyword'),
+    (FILE_NAME_KEY, 'keyword'),
+    (UPLOADED_AT_KEY, 'float'),
+)
+
+
+def documents_collection(collection_name: str) -> str:
+    return f"{collection_name}_documents"
+
+
+def routed_chunk_filter(query_filter: Optional[QueryFilter], doc_ids: Optional[List[str]]):
+    """合併請求過濾條件與第一階段挑出的文件，返回段落集合的 Qdrant Filter（無條件時為 None）"""
+    return (query_filter or QueryFilter()).chunk_filter(doc_ids)
+
+
+def _point_id(doc_id: str, section: Optional[int]) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{doc_id}#{'' if section is None else section}"))
+
+
+class DocumentVectorWriter:
+    """建立索引時累積每個文件（與段落）的段落向量質心，寫入 <collection>_documents 集合
+
+    每批提交後只更新該批涉及的文件，部分索引期間的文件也能被第一階段選到。
+    """
+
+    def __init__(self, client, collection_name: str, size: int, profile: Dict[str, Any]):
+        self.client = client
+        self.collection_name = collection_name
+        self.documents_collection = documents_collection(collection_name)
+        self.size = size
+        self.profile = profile
+        self._sums: Dict[tuple, np.ndarray] = {}
+        self._counts: Dict[tuple, int] = {}
+        self._file_names: Dict[str, str] = {}
+        self._uploaded_at: Dict[str, float] = {}
+        self._dirty = set()
+
+    def reset(self):
+        if self.client.collection_exists(self.documents_collection):
+            self.client.delete_collection(self.documents_collection)
+        self.client.create_collection(
+            self.documents_collection,
+            vectors_config=collection_profile.dense_vector_params(self.size, self.profile)
+        )
+        ensure_payload_indexes(self.client, self.documents_collection, DOCUMENT_PAYLOAD_INDEXES)
+
+    def add(self, nodes: Sequence[BaseNode]):
+        for node in nodes:
+            if node.embedding is None or DOC_ID_KEY not in node.metadata:
+                continue
+            self.add_vector(node.metadata[DOC_ID_KEY], node.metadata.get(DOC_SECTION_KEY),
+                            node.metadata.get(FILE_NAME_KEY), node.embedding, node.metadata.get(UPLOADED_AT_KEY))
+
+    def add_vector(self, doc_id: str, section: Optional[int], file_name: Optional[str], vector,
+                   uploaded_at: Optional[float] = None):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        keys = [(doc_id, None)] + ([(doc_id, section)] if section is not None else [])
+        for key in keys:
+            self._sums[key] = self._sums[key] + vector if key in self._sums else vector.copy()
+            self._counts[key] = self._counts.get(key, 0) + 1
+            self._dirty.add(key)
+        if file_name:
+            self._file_names[doc_id] = file_name
+        if uploaded_at is not None:
+            self._uploaded_at[doc_id] = uploaded_at
+
+    def flush(self):
+        """寫入有變動的文件向量"""
+        from qdrant_client import models
+
+        if not self._dirty:
+            return
+
+        points = []
+        for doc_id, section in self._dirty:
+            centroid = self._sums[(doc_id, section)] / self._counts[(doc_id, section)]
+            points.append(models.PointStruct(
+                id=_point_id(doc_id, section),
+                vector=centroid.tolist(),
+                payload={
+                    DOC_ID_KEY: doc_id,
+                    'kind': KIND_DOCUMENT if section is None else KIND_SECTION,
+                    'section': section,
+                    FILE_NAME_KEY: self._file_names.get(doc_id),
+                    UPLOADED_AT_KEY: self._uploaded_at.get(doc_id),
+                    'nodes': self._counts[(doc_id, section)]
+                }
+            ))
+        self.client.upsert(self.documents_collection, points=points, wait=True)
+        self._dirty.clear()
+
+    def rebuild_from_collection(self, vector_name: Optional[str] = None, batch_size: int = 1024) -> int:
+        """由既有段落集合的向量重建文件向量（例如匯入快照之後）；返回文件數"""
+        self.reset()
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=self.collection_name,
+                limit=batch_size,
+                offset=offset,
+                with_payload=[DOC_ID_KEY, DOC_SECTION_KEY, FILE_NAME_KEY, UPLOADED_AT_KEY],
+                with_vectors=[vector_name] if vector_name else True
+            )
+            for point in points:
+                payload = point.payload or {}
+                vector = point.vector.get(vector_name) if isinstance(point.vector, dict) else point.vector
+                if payload.get(DOC_ID_KEY) and vector is not None:
+                    self.add_vector(payload[DOC_ID_KEY], payload.get(DOC_SECTION_KEY), payload.get(FILE_NAME_KEY),
+                                    vector, payload.get(UPLOADED_AT_KEY))
+            self.flush()
+            if offset is None:
+                return len(self._file_names)
+
+
+class DocumentRouter:
+    """第一階段：以查詢向量在文件集合中挑選前 top_documents 個文件
+
+    文件數不超過 top_documents 或文件集合不存在時返回 None，代表直接搜尋所有段落。
+    """
+
+    def __init__(self, client, aclient, collection_name: str, top_documents: int = 5,
+                 section_pages: int = 0, count_cache_seconds: float = 30.0):
+        self.client = client
+        self.aclient = aclient
+        self.documents_collection = documents_collection(collection_name)
+        self.top_documents = max(top_documents, 1)
+        # 有段落向量時，同一文件可能佔用多個候選，因此多取一些
+        self.limit = self.top_documents * (4 if section_pages > 0 else 1)
+        self.count_cache_seconds = count_cache_seconds
+        self._count = None
+        self._count_at = 0.0
+        self._lock = threading.Lock()
+
+    def route(self, query_vector: List[float], document_filter=None) -> Optional[List[str]]:
+        """document_filter 為請求的文件 / 上傳時間條件，只在符合條件的文件中挑選"""
+        try:
+            if not self._should_route(self._document_count()):
+                return None
+            result = self.client.query_points(self.documents_collection, query=query_vector,
+                                              query_filter=document_filter,
+                                              limit=self.limit, with_payload=[DOC_ID_KEY])
+        except Exception as e:
+            print(f"⚠️ 文件路由失敗，改為搜尋所有段落: {e}")
+            metrics.incr('document_routing_error_total')
+            return None
+        return self._pick(result.points)
+
+    async def aroute(self, query_vector: List[float], document_filter=None) -> Optional[List[str]]:
+        try:
+            if not self._should_route(await self._adocument_count()):
+                return None
+            result = await self.aclient.query_points(self.documents_collection, query=query_vector,
+                                                     query_filter=document_filter,
+                                                     limit=self.limit, with_payload=[DOC_ID_KEY])
+        except Exception as e:
+            print(f"⚠️ 文件路由失敗，改為搜尋所有段落: {e}")
+            metrics.incr('document_routing_error_total')
+            return None
+        return self._pick(result.points)
+
+    def route_batch(self, query_vectors: List[List[float]], document_filter=None) -> List[Optional[List[str]]]:
+        """多個查詢的第一階段合併為一次 query_batch_points 請求"""
+        from qdrant_client import models
+
+        try:
+            if not self._should_route(self._document_count()):
+                return [None] * len(query_vectors)
+            responses = self.client.query_batch_points(self.documents_collection, requests=[
+                models.QueryRequest(query=vector, filter=document_filter, limit=self.limit, with_payload=[DOC_ID_KEY])
+                for vector in query_vectors
+            ])
+        except Exception as e:
+            print(f"⚠️ 文件路由失敗，改為搜尋所有段落: {e}")
+            metrics.incr('document_routing_error_total')
+            return [None] * len(query_vectors)
+        return [self._pick(response.points) for response in responses]
+
+    def needs_routing(self, query_filter: Optional[QueryFilter]) -> bool:
+        """請求已限定的文件數不超過 top_documents 時不需要第一階段"""
+        return query_filter is None or not query_filter.file_count or query_filter.file_count > self.top_documents
+
+    def _should_route(self, document_count: int) -> bool:
+        if document_count <= self.top_documents:
+            metrics.incr('document_routing_bypass_total')
+            return False
+        return True
+
+    def _pick(self, points) -> Optional[List[str]]:
+        doc_ids = []
+        for point in points:
+            doc_id = (point.payload or {}).get(DOC_ID_KEY)
+            if doc_id and doc_id not in doc_ids:
+                doc_ids.append(doc_id)
+                if len(doc_ids) >= self.top_documents:
+                    break
+        if not doc_ids:
+            return None
+        metrics.incr('document_routing_routed_total')
+        return doc_ids
+
+    def _count_filter(self):
+        from qdrant_client import models
+
+        return models.Filter(must=[models.FieldCondition(key='kind', match=models.MatchValue(value=KIND_DOCUMENT))])
+
+    def _document_count(self) -> int:
+        """文件數在 count_cache_seconds 內使用快取，避免每次查詢都多一次 count 請求"""
+        count = self._fresh_count()
+        if count is None:
+            count = 0
+            if self.client.collection_exists(self.documents_collection):
+                count = self.client.count(self.documents_collection, count_filter=self._count_filter(), exact=True).count
+            self._store_count(count)
+        return count
+
+    async def _adocument_count(self) -> int:
+        count = self._fresh_count()
+        if count is None:
+            count = 0
+            if await self.aclient.collection_exists(self.documents_collection):
+                count = (await self.aclient.count(self.documents_collection, count_filter=self._count_filter(), exact=True)).count
+            self._store_count(count)
+        return count
+
+    def _fresh_count(self) -> Optional[int]:
+        with self._lock:
+            if self._count is not None and time.monotonic() - self._count_at < self.count_cache_seconds:
+                return self._count
+        return None
+
+    def _store_count(self, count: int):
+        with self._lock:
+            self._count, self._count_at = count, time.monotonic()
+
+
+class DocumentRoutedRetriever(BaseRetriever):
+    """兩階段檢索：查詢向量只計算一次，先挑選文件，再以 doc_id 過濾搜尋段落
+
+    有請求過濾條件時，第一階段只在符合條件的文件中挑選，第二階段同時套用頁碼等條件；
+    請求已限定的文件數不超過 top_documents 時直接略過第一階段。
+    """
+
+    def __init__(self, index, router: DocumentRouter, embed_model,
+                 query_filter: Optional[QueryFilter] = None, **retriever_kwargs):
+        super().__init__()
+        self._index = index
+        self._router = router
+        self._embed_model = embed_model
+        self._query_filter = query_filter
+        self._retriever_kwargs = retriever_kwargs
+
+    def _document_filter(self):
+        return self._query_filter.document_filter() if self._query_filter is not None else None
+
+    def _chunk_retriever(self, doc_ids: Optional[List[str]]):
+        qdrant_filter = routed_chunk_filter(self._query_filter, doc_ids)
+        kwargs = dict(self._retriever_kwargs)
+        if qdrant_filter is not None:
+            kwargs['vector_store_kwargs'] = {**kwargs.get('vector_store_kwargs', {}), 'qdrant_filters': qdrant_filter}
+        return self._index.as_retriever(**kwargs)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            query_bundle = QueryBundle(
+                query_str=query_bundle.query_str,
+                custom_embedding_strs=query_bundle.custom_embedding_strs,
+                embedding=self._embed_model.get_agg_embedding_from_queries(query_bundle.embedding_strs)
+            )
+        doc_ids = self._router.route(query_bundle.embedding, self._document_filter()) \
+            if self._router.needs_routing(self._query_filter) else None
+        return self._chunk_retriever(doc_ids).retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            query_bundle = QueryBundle(
+                query_str=query_bundle.query_str,
+                custom_embedding_strs=query_bundle.custom_embedding_strs,
+                embedding=await self._embed_model.aget_agg_embedding_from_queries(query_bundle.embedding_strs)
+            )
+        doc_ids = await self._router.aroute(query_bundle.embedding, self._document_filter()) \
+            if self._router.needs_routing(self._query_filter) else None
+        return await self._chunk_retriever(doc_ids).aretrieve(query_bundle)
@@ -7,14 +7,16 @@ from langchain_qdrant import QdrantVectorStore
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import CharacterTextSplitter
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams
+from qdrant_client.http.models import Distance
+from .qdrant_factory import get_qdrant_client
+from . import collection_profile
 
 class EmbeddingService:
     def __init__(self, config_path: str = "config.ini"):
         self.config_manager = ConfigManager(config_path)
         self._embedding_models = {}
         self._qdrant_client = None
+        self.collection_profile = self.config_manager.get_collection_config()
     
     def get_qdrant_client(self):
         """獲取 Qdrant 客戶端實例"""
@@ -25,11 +27,7 @@ class EmbeddingService:
                     print("❌ Qdrant URL 未設定")
                     return None
                 
-                self._qdrant_client = QdrantClient(
-                    url=qdrant_config['url'],
-                    api_key=qdrant_config.get('api_key')
-                )
-                print("✅ Qdrant 客戶端連接成功")
+                self._qdrant_client = get_qdrant_client(qdrant_config)
                 
             except Exception as e:
                 print(f"❌ Qdrant 客戶端連接失敗: {e}")
@@ -176,15 +174,18 @@ class EmbeddingService:
         **kwargs
     ):
         try:
-            client = QdrantClient(path=path)
+            client = get_qdrant_client(path=path)
 
             try:
-                vector_size = kwargs.get('vector_size', 384) 
+                # 維度依序取自參數、設定檔，最後以一次嵌入探測，避免與模型不符
+                vector_size = kwargs.get('vector_size') or self.collection_profile['vector_size'] \
+                    or len(embeddings.embed_query("dimension probe"))
                 distance = kwargs.get('distance', Distance.COSINE)
                 
                 client.create_collection(
                     collection_name=collection_name,
-                    vectors_config=VectorParams(size=vector_size, distance=distance),
+                    vectors_config=collection_profile.dense_vector_params(vector_size, self.collection_profile, distance),
+                    quantization_config=collection_profile.quantization_config(self.collection_profile)
                 )
                 print(f"✓ 建立 Qdrant 集合: {collection_name}")
             except Exception as e:
@@ -277,10 +278,16 @@ class EmbeddingService:
         with_score: bool = False
     ):
         try:
+            search_kwargs = {}
+            if isinstance(vectorstore, QdrantVectorStore):
+                search_params = collection_profile.search_params(self.collection_profile)
+                if search_params is not None:
+                    search_kwargs['search_params'] = search_params
+            
             if with_score:
-                return vectorstore.similarity_search_with_score(query, k)
+                return vectorstore.similarity_search_with_score(query, k, **search_kwargs)
             else:
-                return vectorstore.similarity_search(query, k)
+                return vectorstore.similarity_search(query, k, **search_kwargs)
                 
         except Exception as e:
             print(f"❌ 相似度搜尋錯誤: {e}")
@@ -333,10 +340,11 @@ class EmbeddingService:
                 collection_name = kwargs.get('collection_name', 'default_collection')
                 vectorstore = self.create_qdrant_vectorstore(collection_name, embeddings, **kwargs)
                 if vectorstore and documents:
-                    # 添加文件到 Qdrant
+                    # 添加文件到 Qdrant（分批寫入）
                     texts = [doc.page_content for doc in documents]
                     metadatas = [doc.metadata for doc in documents]
-                    vectorstore.add_texts(texts=texts, metadatas=metadatas)
+                    batch_size = kwargs.get('batch_size') or self.config_manager.get_qdrant_config()['upsert_batch_size']
+                    vectorstore.add_texts(texts=texts, metadatas=metadatas, batch_size=batch_size)
             else:
                 print(f"❌ 不支援的向量資料庫類型: {vectorstore_type}")
                 return embeddings, None
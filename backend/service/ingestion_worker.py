@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import threading
+import multiprocessing
+from typing import Any, Dict, List, Optional
+from .upload_store import IndexedHashRegistry, INDEXED_HASHES_FILE
+
+
+class IngestionQueue:
+    """以本地目錄實作的索引工作佇列，web 行程與 ingestion worker 共用
+
+    - pending/：等待處理的工作（以 rename 原子地領取）
+    - running/：處理中的工作
+    - status/：每個工作的進度與結果，由 worker 寫入、web 行程讀取
+    """
+
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        self.pending_dir = os.path.join(base_dir, 'pending')
+        self.running_dir = os.path.join(base_dir, 'running')
+        self.status_dir = os.path.join(base_dir, 'status')
+        for path in (self.pending_dir, self.running_dir, self.status_dir):
+            os.makedirs(path, exist_ok=True)
+
+    def enqueue(self, job_type: str, payload: Dict[str, Any]) -> str:
+        job_id = f"{int(time.time() * 1000):013d}_{uuid.uuid4().hex[:8]}"
+        job = {'job_id': job_id, 'type': job_type, 'payload': payload, 'created_at': time.time()}
+        fields = {'files': payload['files']} if 'files' in payload else {}
+        self.update_status(job_id, state='queued', type=job_type, created_at=job['created_at'], **fields)
+        self._write_json(os.path.join(self.pending_dir, f"{job_id}.json"), job)
+        return job_id
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """領取最早的待處理工作，多個 worker 同時領取時只有一個會成功"""
+        for name in sorted(os.listdir(self.pending_dir)):
+            if not name.endswith('.json'):
+                continue
+            source = os.path.join(self.pending_dir, name)
+            target = os.path.join(self.running_dir, name)
+            try:
+                os.rename(source, target)
+            except OSError:
+                continue
+            with open(target, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return None
+
+    def has_pending(self) -> bool:
+        return any(name.endswith('.json') for name in os.listdir(self.pending_dir))
+
+    def finish(self, job_id: str):
+        try:
+            os.remove(os.path.join(self.running_dir, f"{job_id}.json"))
+        except FileNotFoundError:
+            pass
+
+    def requeue_running(self):
+        """worker 重啟時，把上次中斷的工作放回佇列"""
+        for name in os.listdir(self.running_dir):
+            try:
+                os.rename(os.path.join(self.running_dir, name), os.path.join(self.pending_dir, name))
+            except OSError:
+                pass
+
+    def update_status(self, job_id: str, **fields):
+        status = self.get_status(job_id) or {'job_id': job_id}
+        status.update(fields)
+        status['updated_at'] = time.time()
+        self._write_json(os.path.join(self.status_dir, f"{job_id}.json"), status)
+        return status
+
+    def get_status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.status_dir, f"{job_id}.json"), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def latest_status(self, job_types) -> Optional[Dict[str, Any]]:
+        """最新一個指定類型工作的狀態；工作 id 以建立時間開頭，依名稱排序即為建立順序"""
+        for name in sorted(os.listdir(self.status_dir), reverse=True):
+            if not name.endswith('.json'):
+                continue
+            status = self.get_status(name[:-5])
+            if status and status.get('type') in job_types:
+                return status
+        return None
+
+    def list_statuses(self) -> List[Dict[str, Any]]:
+        statuses = []
+        for name in sorted(os.listdir(self.status_dir)):
+            if name.endswith('.json'):
+                status = self.get_status(name[:-5])
+                if status:
+                    statuses.append(status)
+        return statuses
+
+    @staticmethod
+    def _write_json(path: str, data: Dict[str, Any]):
+        # 先寫暫存檔再 rename，讀取方不會看到寫到一半的內容
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+class IngestionWorker:
+    """消費索引工作佇列，在獨立行程中執行 PDF 解析、切塊、嵌入與快照匯出 / 匯入"""
+
+    def __init__(self, config_path: str, queue: IngestionQueue, poll_interval: float = 0.5):
+        self.config_path = config_path
+        self.queue = queue
+        self.poll_interval = poll_interval
+        self._stopping = threading.Event()
+        self._pdf_service = None
+
+    @property
+    def pdf_service(self):
+        if self._pdf_service is None:
+            from .pdf_service import PDFService
+            self._pdf_service = PDFService(self.config_path)
+        return self._pdf_service
+
+    def snapshot_manager(self, upload_folder: str):
+        from .snapshot import SnapshotManager
+        return SnapshotManager(self.pdf_service.config_manager, upload_folder)
+
+    def stop(self, *args):
+        self._stopping.set()
+
+    def watch_parent(self, parent_pid: int):
+        """父行程結束後停止 worker（在背景執行緒中執行）"""
+        while not self._stopping.wait(self.poll_interval):
+            if os.getppid() != parent_pid:
+                print("🛑 父行程已結束，停止 ingestion worker")
+                sys.stdout.flush()
+                self.stop()
+                return
+
+    def run_forever(self):
+        print(f"🛠️ Ingestion worker 啟動 (pid={os.getpid()})")
+        sys.stdout.flush()
+        self.queue.requeue_running()
+        while not self._stopping.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self._stopping.wait(self.poll_interval)
+                continue
+            self.run_job(job)
+
+    def run_job(self, job: Dict[str, Any]):
+        job_id = job['job_id']
+        queue = self.queue
+
+        def progress(stage: str, **fields):
+            queue.update_status(job_id, state='running', stage=stage, **fields)
+
+        queue.update_status(job_id, state='running', stage='starting', started_at=time.time())
+        try:
+            if job['type'] == 'index_folder':
+                payload = job['payload']
+                result = self.pdf_service.build_llama_index(
+                    payload['upload_folder'],
+                    payload.get('collection_name', 'pdf_chat_collection'),
+                    progress=progress
+                )
+            elif job['type'] == 'export_snapshot':
+                payload = job['payload']
+                result = self.snapshot_manager(payload['upload_folder']).export(
+                    payload.get('collection_name', 'pdf_chat_collection'),
+                    payload.get('name'),
+                    include_uploads=payload.get('include_uploads', True),
+                    progress=progress
+                )
+            elif job['type'] == 'import_snapshot':
+                payload = job['payload']
+                result = self.snapshot_manager(payload['upload_folder']).import_snapshot(
+                    payload['name'],
+                    payload.get('collection_name'),
+                    force=payload.get('force', False),
+                    progress=progress
+                )
+            else:
+                raise ValueError(f"未知的工作類型: {job['type']}")
+
+            if job['type'] == 'index_folder' and not queue.has_pending():
+                # 記錄集合中已索引檔案的 SHA-256，相同內容再次上傳時可直接沿用；
+                # 已有新的重建工作排隊時，集合內容即將被取代，不記錄
+                IndexedHashRegistry(os.path.join(queue.base_dir, INDEXED_HASHES_FILE)).replace(payload.get('files', []))
+
+            queue.update_status(job_id, state='completed', stage='done', finished_at=time.time(), result=result)
+            print(f"✅ 索引工作完成: {job_id}")
+        except Exception as e:
+            print(f"❌ 索引工作失敗 {job_id}: {e}")
+            queue.update_status(job_id, state='error', stage='failed', finished_at=time.time(), error=str(e))
+        finally:
+            queue.finish(job_id)
+            sys.stdout.flush()
+
+
+def run_worker(config_path: str, job_dir: str, poll_interval: float = 0.5, parent_pid: Optional[int] = None):
+    """ingestion worker 行程進入點；parent_pid 行程結束（例如 gunicorn master 被強制終止）時一併停止"""
+    worker = IngestionWorker(config_path, IngestionQueue(job_dir), poll_interval)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    if parent_pid is not None:
+        watcher = threading.Thread(target=worker.watch_parent, args=(parent_pid,), name='pdf-chat-ingestion-parent')
+        watcher.daemon = True
+        watcher.start()
+    worker.run_forever()
+
+
+def start_worker_process(config_path: str, job_dir: str, poll_interval: float = 0.5) -> multiprocessing.Process:
+    """以 spawn 啟動獨立的 ingestion worker 行程（不繼承 gunicorn / gevent 狀態）
+
+    不是 daemon 行程：daemon 行程不能再建立子行程，UPSERT_PARALLEL > 1 時 upload_points 的行程池
+    （建立索引與匯入快照）會失敗。停止由呼叫端負責（gunicorn 的 on_exit），父行程異常結束時 worker 自行停止。
+    """
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(
+        target=run_worker,
+        args=(config_path, job_dir, poll_interval, os.getpid()),
+        name='pdf-chat-ingestion',
+        daemon=False
+    )
+    process.start()
+    return process
+
+
+def start_worker_thread(config_path: str, job_dir: str, poll_interval: float = 0.5) -> IngestionWorker:
+    """開發模式：在目前行程的背景執行緒中執行 worker"""
+    worker = IngestionWorker(config_path, IngestionQueue(job_dir), poll_interval)
+    thread = threading.Thread(target=worker.run_forever, name='pdf-chat-ingestion')
+    thread.daemon = True
+    thread.start()
+    return worker
+
+
+if __name__ == '__main__':
+    from .config_manager import ConfigManager
+
+    config_file = sys.argv[1] if len(sys.argv) > 1 else 'config.ini'
+    ingestion_config = ConfigManager(config_file).get_ingestion_config()
+    run_worker(config_file, ingestion_config['job_dir'], ingestion_config['poll_interval'])
@@ -1,12 +1,80 @@
-from typing import List, Optional
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Callable, List, Optional
+import numpy as np
 from llama_index.core import SimpleDirectoryReader, VectorStoreIndex, StorageContext, Document, Settings
 from llama_index.core.node_parser import UnstructuredElementNodeParser
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import BaseNode, MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+from llama_index.core.utils import get_tokenizer
 from llama_index.llms.gemini import Gemini
 from llama_index.embeddings.google_genai import GoogleGenAIEmbedding
 from llama_index.vector_stores.qdrant import QdrantVectorStore
+from llama_index.vector_stores.qdrant.utils import relative_score_fusion
 from llama_index.core.postprocessor import LongContextReorder
-import qdrant_client
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.prompts.default_prompts import DEFAULT_TEXT_QA_PROMPT
+from llama_index.core.base.response.schema import StreamingResponse
 from .config_manager import ConfigManager
+from .qdrant_factory import get_qdrant_client, get_async_qdrant_client
+from .client_registry import client_registry
+from .stream_control import close_upstream
+from .priority_scheduler import PriorityScheduler, INGESTION
+from .node_store import ParsedNodeStore
+from .upload_store import sha256_file
+from . import collection_profile
+from .projection import ProjectionStore, ProjectedEmbedding, FullVectorRescorer
+from .document_router import (
+    DocumentRouter, DocumentRoutedRetriever, DocumentVectorWriter, documents_collection, routed_chunk_filter
+)
+from .query_filters import QueryFilter, ensure_payload_indexes, tag_nodes, TOKEN_COUNT_KEY
+from .context_packer import ContextPacker
+from .near_dedup import NearDuplicateFilter
+from .boilerplate import BoilerplateStripper
+
+
+class RoutedGeneration:
+    """檢索完成、尚未生成的 RAG 查詢，供路由器在提供者之間對沖 / 切換
+
+    主提供者以查詢引擎的合成器生成；備援提供者使用相同段落組成的預設 QA 提示詞（與批次問答相同）。
+    """
+
+    def __init__(self, engine, llm, query_bundle: QueryBundle, source_nodes: List[NodeWithScore]):
+        self.engine = engine
+        self.llm = llm
+        self.query_bundle = query_bundle
+        self.source_nodes = source_nodes
+        self.prompt = DEFAULT_TEXT_QA_PROMPT.format(
+            context_str='\n\n'.join(hit.node.get_content(metadata_mode=MetadataMode.LLM) for hit in source_nodes),
+            query_str=query_bundle.query_str
+        )
+
+    def open_primary(self):
+        response = self.engine.synthesize(self.query_bundle, self.source_nodes)
+        if hasattr(response, 'response_gen'):
+            return response.response_gen
+        return iter([str(response)])
+
+    async def aopen_primary(self):
+        response = await self.engine.asynthesize(self.query_bundle, self.source_nodes)
+        if hasattr(response, 'async_response_gen'):
+            async for text in response.async_response_gen():
+                yield text
+        elif hasattr(response, 'response_gen'):
+            # 合成器只提供同步生成器時不在事件迴圈中讀取它，改以 LLM 的非同步串流生成
+            close_upstream(response)
+            async for chunk in await self.llm.astream_complete(self.prompt):
+                if chunk.delta:
+                    yield chunk.delta
+        elif response is not None and str(response).strip():
+            yield str(response)
+
+    def response(self, response_gen) -> StreamingResponse:
+        """以路由後的文字串流組成帶來源節點的 StreamingResponse，沿用既有的來源與上下文事件"""
+        return StreamingResponse(response_gen=response_gen, source_nodes=self.source_nodes)
 
 
 class LlamaIndexProcessor:
@@ -16,31 +84,59 @@ class LlamaIndexProcessor:
         self.config_manager = config_manager or ConfigManager()
         self.gemini_config = self.config_manager.get_gemini_config()
         self.qdrant_config = self.config_manager.get_qdrant_config()
+        self.collection_profile = self.config_manager.get_collection_config()
+        self.projection_config = self.config_manager.get_projection_config()
+        self.routing_config = self.config_manager.get_document_routing_config()
+        self.packing_config = self.config_manager.get_context_packing_config()
+        self.dedup_config = self.config_manager.get_dedup_config()
+        self.ingestion_config = self.config_manager.get_ingestion_config()
+        boilerplate_config = self.config_manager.get_boilerplate_config()
+        self.boilerplate_stripper = BoilerplateStripper(
+            boilerplate_config['edge_lines'],
+            boilerplate_config['min_fraction'],
+            boilerplate_config['min_pages']
+        ) if boilerplate_config['enabled'] else None
+        self.context_packer = ContextPacker(
+            token_budget=self.packing_config['token_budget'],
+            merge_adjacent=self.packing_config['merge_adjacent']
+        ) if self.packing_config['enabled'] else None
+        self._full_vector_size = self.collection_profile['vector_size'] or None
         
         self._setup_models()
+        self.collection_name = None
+        self.projection_store = None
+        self.document_router = None
+        self.query_embed_model = self.embed_model
+        self._payload_indexes_ready = False
         
         self.index = None
         self.query_engine = None
+        self._engine_options = None
+        self.build_stats = {}
     
     def _setup_models(self):
         """設定 LLM 和嵌入模型"""
-        # LLM 設定
-        self.llm = Gemini(
+        # LLM 設定（行程內共用，避免每次重建客戶端與 TLS 連線）
+        self.llm = client_registry.get('llama_gemini_llm', self.gemini_config, lambda: Gemini(
             model_name=self.gemini_config['model_name'], 
             api_key=self.gemini_config['api_key']
-        )
+        ))
         
         # 嵌入模型設定
-        self.embed_model = GoogleGenAIEmbedding(
+        self.embed_model = client_registry.get('llama_gemini_embedding', self.gemini_config, lambda: GoogleGenAIEmbedding(
             api_key=self.gemini_config['api_key'],
             model=self.gemini_config['embedding_model'],
             task_type="RETRIEVAL_DOCUMENT"
-        )
+        ))
         
         # 全域設定
         Settings.llm = self.llm
         Settings.embed_model = self.embed_model
         Settings.node_parser = UnstructuredElementNodeParser(llm=self.llm)
+        # 切塊結果取決於 node parser 與其使用的 LLM，作為節點快取的指紋
+        self.parser_fingerprint = f"{type(Settings.node_parser).__name__}:{self.gemini_config['model_name']}"
+        if self.boilerplate_stripper is not None:
+            self.parser_fingerprint += f":{self.boilerplate_stripper.fingerprint}"
     
     def load_documents(self, input_dir: str, required_exts: List[str] = [".pdf"]) -> List[Document]:
         loader = SimpleDirectoryReader(
@@ -50,14 +146,230 @@ class LlamaIndexProcessor:
             exclude=["*.tmp"],
             encoding='utf-8'
         )
-        return loader.load_data()
+        documents = loader.load_data()
+        if self.boilerplate_stripper is not None:
+            stats = self.boilerplate_stripper.strip_documents(documents)
+            print(f"✂️ 移除頁首頁尾: {stats['lines']} 行，{stats['chars']} 字元")
+        return documents
     
     def create_qdrant_index(self, documents: List[Document], collection_name: str = "document_collection") -> VectorStoreIndex:
-        # Qdrant 客戶端連接
-        qdrant_client_instance = qdrant_client.QdrantClient(
-            url=self.qdrant_config['url'],
-            api_key=self.qdrant_config['api_key']
-        )
+        self._reset_collection(collection_name)
+        store = self._begin_projection(collection_name)
+        
+        # 建立向量存儲
+        vector_store = self._create_vector_store(collection_name, self._dense_vector_params())
+        storage_context = StorageContext.from_defaults(vector_store=vector_store)
+        
+        if store is None:
+            # 建立向量索引
+            self.index = VectorStoreIndex.from_documents(
+                documents,
+                storage_context=storage_context,
+                vector_store_kwargs={"enable_hybrid": True},
+                show_progress=True
+            )
+            ensure_payload_indexes(get_qdrant_client(self.qdrant_config), collection_name)
+            return self.index
+        
+        # 降維：全精度向量寫入側檔，Qdrant 只存投影後的向量
+        nodes = self.parse_nodes(documents)
+        full_vectors = self._embed_full(nodes)
+        if store.projection() is None:
+            store.fit(full_vectors)
+        self._insert_nodes(nodes, full_vectors, storage_context)
+        self.index = VectorStoreIndex.from_vector_store(vector_store, embed_model=self.query_embed_model)
+        return self.index
+    
+    def create_qdrant_index_progressive(self,
+                                        pdf_paths: List[str],
+                                        collection_name: str = "document_collection",
+                                        batch_pages: int = 32,
+                                        on_batch: Optional[Callable[[int, int, Optional[str]], None]] = None,
+                                        scheduler: Optional[PriorityScheduler] = None,
+                                        node_store: Optional[ParsedNodeStore] = None) -> VectorStoreIndex:
+        """依頁面範圍分批寫入 Qdrant，每批提交後即可被查詢
+
+        PDF 逐頁載入（每頁一個 Document），每批即為一段連續頁面；
+        on_batch(indexed_pages, total_pages, last_page_label) 在開始前與每批提交後呼叫。
+        有 scheduler 時解析與每個嵌入子批次各自取得 ingestion 名額：子批次並行嵌入（EMBED_CONCURRENCY），
+        系統空閒時 ingestion 可使用超出保留額度的名額，互動查詢在等待時於子批次之間退回保留額度。
+        有 node_store 時，已解析過的檔案（依 SHA-256）直接使用快取節點，只重新嵌入。
+        啟用 PCA 降維時，先累積 pca_fit_samples 個節點的全精度向量擬合投影，之後的批次直接寫入。
+        節點標記來源文件（檔案 SHA-256）、頁序與上傳時間（檔案修改時間）供查詢過濾；
+        啟用近似重複剔除時，與先前段落（同一次建立內，可跨文件）近似重複的段落不嵌入也不寫入；
+        啟用文件路由時，每批提交後更新文件向量。
+        """
+        self._reset_collection(collection_name)
+        store = self._begin_projection(collection_name)
+        doc_writer = self._begin_document_vectors(collection_name)
+        section_pages = self.routing_config['section_pages']
+        
+        vector_store = self._create_vector_store(collection_name, self._dense_vector_params())
+        storage_context = StorageContext.from_defaults(vector_store=vector_store)
+        batch_pages = max(batch_pages, 1)
+        
+        # 先決定每個檔案的來源：節點快取或重新解析；pages 為逐頁的 Document 或節點列表
+        plans = []
+        self.build_stats = {'boilerplate_lines': 0, 'boilerplate_chars': 0}
+        for path in pdf_paths:
+            sha256 = sha256_file(path)
+            records = node_store.load(sha256) if node_store is not None else None
+            cached_pages = self._pages_from_records(records, path) if records is not None else None
+            if cached_pages is not None:
+                plans.append((path, sha256, True, cached_pages))
+            else:
+                plans.append((path, sha256, False, [[document] for document in self.load_file(path)]))
+        
+        dedup = None
+        if self.dedup_config['enabled']:
+            dedup = NearDuplicateFilter(self.dedup_config['max_distance'], self.dedup_config['shingle'],
+                                        self.dedup_config['min_chars'], self.dedup_config['scope'])
+        
+        total_pages = sum(len(pages) for _, _, _, pages in plans)
+        self.build_stats.update({
+            'total_pages': total_pages,
+            'cached_files': sum(1 for plan in plans if plan[2]),
+            'parsed_files': sum(1 for plan in plans if not plan[2]),
+            'nodes': 0,
+            'duplicates': 0,
+            'dedup': {}
+        })
+        if on_batch:
+            on_batch(0, total_pages, None)
+        
+        indexed_pages = 0
+        # 投影尚未擬合前暫存的批次：(nodes, full_vectors, pages, last_page)
+        pending = []
+        
+        def commit(nodes, full_vectors, page_count, last_page):
+            nonlocal indexed_pages
+            self._insert_nodes(nodes, full_vectors, storage_context)
+            if doc_writer is not None:
+                doc_writer.add(nodes)
+                doc_writer.flush()
+            indexed_pages += page_count
+            if on_batch:
+                on_batch(indexed_pages, total_pages, last_page)
+        
+        def flush_pending():
+            samples = np.concatenate([item[1] for item in pending])
+            if store.projection() is None and len(samples):
+                store.fit(samples)
+            for item in pending:
+                commit(*item)
+            pending.clear()
+        
+        for path, sha256, cached, pages in plans:
+            records = []
+            uploaded_at = os.path.getmtime(path)
+            for start in range(0, len(pages), batch_pages):
+                batch = [item for page in pages[start:start + batch_pages] for item in page]
+                page_count = len(pages[start:start + batch_pages])
+                last_page = batch[-1].metadata.get('page_label') if batch else None
+                if cached:
+                    nodes = batch
+                    token_counts = [node.metadata.get(TOKEN_COUNT_KEY) for node in nodes]
+                    # 快取以頁序分組（含空白頁），位置即為解析時記錄的頁序
+                    page_numbers = [start + offset + 1
+                                    for offset, page in enumerate(pages[start:start + batch_pages]) for _ in page]
+                else:
+                    # 解析會呼叫 LLM（表格摘要），與嵌入共用提供者配額
+                    with (scheduler.slot(INGESTION) if scheduler is not None else nullcontext()):
+                        nodes = self.parse_nodes(batch)
+                    page_numbers = self._node_page_numbers(nodes, pages, start, batch_pages)
+                    batch_records = self._node_records(nodes, page_numbers, len(pages))
+                    records.extend(batch_records)
+                    token_counts = [record['tokens'] for record in batch_records]
+                self.build_stats['nodes'] += len(nodes)
+                sections = None
+                if doc_writer is not None and section_pages > 0:
+                    sections = [(page_number - 1) // section_pages for page_number in page_numbers]
+                tag_nodes(nodes, sha256, page_numbers, uploaded_at, sections, token_counts)
+                if dedup is not None:
+                    # 節點快取保存完整的解析結果，剔除只影響這次寫入
+                    nodes = dedup.filter(nodes)
+                
+                if store is None:
+                    commit(nodes, self._embed_full(nodes, scheduler), page_count, last_page)
+                else:
+                    pending.append((nodes, self._embed_full(nodes, scheduler), page_count, last_page))
+                    fitted = store.projection() is not None
+                    if fitted or sum(len(item[0]) for item in pending) >= self.projection_config['pca_fit_samples']:
+                        flush_pending()
+            
+            if not cached and node_store is not None:
+                node_store.save(sha256, records, file_name=os.path.basename(path))
+        
+        if pending:
+            flush_pending()
+        
+        if dedup is not None:
+            self.build_stats['duplicates'] = dedup.duplicates
+            self.build_stats['dedup'] = dedup.report()
+            print(f"🧹 近似重複段落: 剔除 {dedup.duplicates}/{self.build_stats['nodes']} 個（省下等量的嵌入與 Qdrant 點位）")
+        
+        self.index = VectorStoreIndex.from_vector_store(vector_store, embed_model=self.query_embed_model)
+        return self.index
+    
+    def load_file(self, path: str) -> List[Document]:
+        """載入單一檔案（PDF 每頁一個 Document），並在切塊前移除逐頁重複的頁首、頁尾與頁碼"""
+        pages = SimpleDirectoryReader(input_files=[path], encoding='utf-8').load_data()
+        if self.boilerplate_stripper is not None:
+            stats = self.boilerplate_stripper.strip(pages)
+            self.build_stats['boilerplate_lines'] = self.build_stats.get('boilerplate_lines', 0) + stats['lines']
+            self.build_stats['boilerplate_chars'] = self.build_stats.get('boilerplate_chars', 0) + stats['chars']
+            if stats['lines']:
+                print(f"✂️ {os.path.basename(path)}: 移除頁首頁尾 {stats['lines']} 行，{stats['chars']} 字元")
+        return pages
+    
+    def parse_nodes(self, documents: List[Document]) -> List[BaseNode]:
+        """執行切塊等轉換（不嵌入）"""
+        return run_transformations(documents, Settings.transformations)
+    
+    @staticmethod
+    def _node_records(nodes: List[BaseNode], page_numbers: List[int], file_pages: int) -> List[dict]:
+        """節點快取紀錄：保存頁序與檔案總頁數，從快取重建時頁面分組（含空白頁）與重新解析一致"""
+        tokenizer = get_tokenizer()
+        return [{
+            'page': node.metadata.get('page_label'),
+            'page_number': page_number,
+            'file_pages': file_pages,
+            'tokens': len(tokenizer(node.get_content())),
+            'node': doc_to_json(node)
+        } for node, page_number in zip(nodes, page_numbers)]
+    
+    @staticmethod
+    def _node_page_numbers(nodes: List[BaseNode], pages: list, start: int, batch_pages: int) -> List[int]:
+        """節點所在頁面在檔案中的順序（從 1 起算）；page_label 可能是羅馬數字或重複，不適合直接過濾"""
+        ordinals = {}
+        for offset, page in enumerate(pages[start:start + batch_pages]):
+            if page:
+                ordinals.setdefault(page[0].metadata.get('page_label'), start + offset + 1)
+        return [ordinals.get(node.metadata.get('page_label'), start + 1) for node in nodes]
+    
+    @staticmethod
+    def _pages_from_records(records: List[dict], path: str) -> Optional[List[List[BaseNode]]]:
+        """還原快取節點並依頁序放回各頁（沒有段落的頁面為空列表）；檔名以目前上傳的檔案為準
+
+        舊格式的紀錄沒有頁序與總頁數、或檔案沒有任何段落（無從得知總頁數）時無法還原空白頁，
+        返回 None 讓呼叫端重新解析。
+        """
+        if not records or any(record.get('page_number') is None or record.get('file_pages') is None for record in records):
+            return None
+        file_pages = max([record['file_pages'] for record in records] or [0])
+        pages = [[] for _ in range(file_pages)]
+        for record in records:
+            node = json_to_doc(record['node'])
+            node.metadata['file_name'] = os.path.basename(path)
+            node.metadata['file_path'] = path
+            if record.get('tokens') is not None:
+                node.metadata[TOKEN_COUNT_KEY] = record['tokens']
+            pages[record['page_number'] - 1].append(node)
+        return pages
+    
+    def _reset_collection(self, collection_name: str):
+        # Qdrant 客戶端連接（行程內共用）
+        qdrant_client_instance = get_qdrant_client(self.qdrant_config)
         
         # 檢查並刪除現有集合
         try:
@@ -68,24 +380,124 @@ class LlamaIndexProcessor:
         except Exception as e:
             print(f"集合 '{collection_name}' 不存在，無需刪除。")
         
-        # 建立向量存儲
-        vector_store = QdrantVectorStore(
-            client=qdrant_client_instance,
-            collection_name=collection_name,
-            enable_hybrid=True
-        )
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
+        self._payload_indexes_ready = False
         
-        # 建立向量索引
-        self.index = VectorStoreIndex.from_documents(
-            documents,
-            storage_context=storage_context,
-            vector_store_kwargs={"enable_hybrid": True},
-            show_progress=True
+        # 文件路由向量依附於段落集合，一併移除以免路由到已不存在的文件
+        if qdrant_client_instance.collection_exists(documents_collection(collection_name)):
+            qdrant_client_instance.delete_collection(collection_name=documents_collection(collection_name))
+    
+    def _create_vector_store(self, collection_name: str, dense_config=None) -> QdrantVectorStore:
+        """dense_config 與量化設定只在集合尚不存在、第一次寫入時使用"""
+        return QdrantVectorStore(
+            client=get_qdrant_client(self.qdrant_config),
+            aclient=get_async_qdrant_client(self.qdrant_config),
+            collection_name=collection_name,
+            enable_hybrid=True,
+            dense_config=dense_config,
+            quantization_config=collection_profile.quantization_config(self.collection_profile),
+            batch_size=self.qdrant_config['upsert_batch_size'],
+            parallel=self.qdrant_config['upsert_parallel']
         )
-        
+
+    def _dense_vector_params(self):
+        """依集合設定檔建立密集向量設定；啟用降維時集合只存投影後的維度"""
+        size = self._stored_vector_size()
+        print(f"📐 集合設定: size={size} {collection_profile.describe(self.collection_profile)}")
+        return collection_profile.dense_vector_params(size, self.collection_profile)
+
+    def _stored_vector_size(self) -> int:
+        return self.projection_store.dim if self.projection_store is not None else self._embedding_size()
+
+    def _embedding_size(self) -> int:
+        """嵌入模型的原始維度；未設定 VECTOR_SIZE 時以一次嵌入探測"""
+        if self._full_vector_size is None:
+            self._full_vector_size = len(self.embed_model.get_text_embedding("dimension probe"))
+        return self._full_vector_size
+
+    def _use_collection(self, collection_name: str):
+        """依降維與文件路由設定準備查詢元件；未啟用降維時直接使用原始嵌入模型"""
+        self.collection_name = collection_name
+        self.projection_store = ProjectionStore.for_collection(self.projection_config, collection_name)
+        self.query_embed_model = self.embed_model if self.projection_store is None \
+            else ProjectedEmbedding(self.embed_model, self.projection_store)
+        self.document_router = None
+        if self.routing_config['enabled']:
+            self.document_router = DocumentRouter(
+                get_qdrant_client(self.qdrant_config),
+                get_async_qdrant_client(self.qdrant_config),
+                collection_name,
+                self.routing_config['top_documents'],
+                self.routing_config['section_pages'],
+                self.routing_config['count_cache_seconds']
+            )
+        return self.projection_store
+
+    def _begin_projection(self, collection_name: str):
+        """重建集合前清除該集合的投影參數與全精度側檔"""
+        store = self._use_collection(collection_name)
+        if store is not None:
+            store.reset(self._embedding_size(), self.gemini_config['embedding_model'])
+            print(f"📉 嵌入降維: {store.mode} {self._embedding_size()} → {store.dim}")
+        return store
+
+    def _begin_document_vectors(self, collection_name: str) -> Optional[DocumentVectorWriter]:
+        """重建集合前建立空的文件向量集合；未啟用文件路由時返回 None"""
+        if not self.routing_config['enabled']:
+            return None
+        writer = DocumentVectorWriter(get_qdrant_client(self.qdrant_config), collection_name,
+                                      self._stored_vector_size(), self.collection_profile)
+        writer.reset()
+        return writer
+
+    def _embed_full(self, nodes: List[BaseNode], scheduler: Optional[PriorityScheduler] = None) -> np.ndarray:
+        """分成子批次嵌入，每個子批次各自取得 ingestion 名額並行執行；名額在子批次之間釋放，
+        互動查詢等待時 ingestion 只能保有保留額度，其餘子批次排在互動查詢之後"""
+        if not nodes:
+            return np.zeros((0, self._embedding_size()), dtype=np.float32)
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        size = max(self.ingestion_config['embed_batch_size'], 1)
+        batches = [texts[i:i + size] for i in range(0, len(texts), size)]
+
+        def embed(batch):
+            with (scheduler.slot(INGESTION) if scheduler is not None else nullcontext()):
+                return self.embed_model.get_text_embedding_batch(batch)
+
+        workers = min(max(self.ingestion_config['embed_concurrency'], 1), len(batches))
+        if workers == 1:
+            vectors = [vector for batch in batches for vector in embed(batch)]
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='embed') as executor:
+                vectors = [vector for result in executor.map(embed, batches) for vector in result]
+        return np.asarray(vectors, dtype=np.float32)
+
+    def _insert_nodes(self, nodes: List[BaseNode], full_vectors: np.ndarray, storage_context: StorageContext):
+        """寫入已嵌入的節點；啟用降維時全精度向量先寫入側檔，Qdrant 只存投影後的向量"""
+        if not nodes:
+            return
+        vectors = full_vectors
+        if self.projection_store is not None:
+            vectors = self.projection_store.projection().project(full_vectors)
+            self.projection_store.append([node.node_id for node in nodes], full_vectors)
+        for node, vector in zip(nodes, vectors):
+            node.embedding = vector.tolist()
+        VectorStoreIndex(nodes, storage_context=storage_context)
+        if not self._payload_indexes_ready:
+            # QdrantVectorStore 在第一次寫入時才建立集合，建立後立即補上過濾欄位的 payload 索引
+            ensure_payload_indexes(get_qdrant_client(self.qdrant_config), storage_context.vector_store.collection_name)
+            self._payload_indexes_ready = True
+
+    def load_qdrant_index(self, collection_name: str = "document_collection") -> VectorStoreIndex:
+        """從既有的 Qdrant 集合載入索引（不重新解析或嵌入）"""
+        vector_store = self._create_vector_store(collection_name)
+        self._use_collection(collection_name)
+        # 較早建立的集合可能缺少過濾欄位的索引，背景建立不阻塞載入
+        try:
+            ensure_payload_indexes(get_qdrant_client(self.qdrant_config), collection_name, wait=False)
+        except Exception as e:
+            print(f"⚠️ 建立 payload 索引失敗: {e}")
+        self.index = VectorStoreIndex.from_vector_store(vector_store, embed_model=self.query_embed_model)
         return self.index
-    
+
     def create_query_engine(self, 
                           vector_store_query_mode: str = 'hybrid',
                           alpha: float = 0.5,
@@ -96,29 +508,87 @@ class LlamaIndexProcessor:
         if not self.index:
             raise ValueError("請先建立索引")
         
-        chat_llm = Gemini(
-            model_name=self.gemini_config['model_name'],
-            api_key=self.gemini_config['api_key']
-        )
+        self._engine_options = {
+            'vector_store_query_mode': vector_store_query_mode,
+            'alpha': alpha,
+            'similarity_top_k': similarity_top_k,
+            'sparse_top_k': sparse_top_k,
+            'num_queries': num_queries,
+            'streaming': streaming
+        }
+        self.query_engine = self._build_query_engine()
+        return self.query_engine
+    
+    def _build_query_engine(self, query_filter: Optional[QueryFilter] = None):
+        """依 create_query_engine 的參數建立查詢引擎；有 query_filter 時為單次請求建立帶過濾條件的引擎"""
+        options = self._engine_options
+        similarity_top_k = options['similarity_top_k']
         
-        self.query_engine = self.index.as_query_engine(
-            llm=chat_llm,
-            vector_store_query_mode=vector_store_query_mode,
-            alpha=alpha,
-            similarity_top_k=similarity_top_k,
-            sparse_top_k=sparse_top_k,
-            node_postprocessors=[LongContextReorder()],
-            num_queries=num_queries,
-            streaming=streaming
-        )
+        # 上下文打包時多取一些候選，依 token 預算挑選，不再固定只送 similarity_top_k 個段落
+        candidates = self.candidate_count(similarity_top_k)
+        node_postprocessors = [LongContextReorder()]
+        if self.context_packer is not None:
+            node_postprocessors.insert(0, self.context_packer)
         
-        return self.query_engine
+        # 降維集合先在投影空間多取候選，再以全精度向量重新評分
+        retrieve_top_k = candidates
+        if self.projection_store is not None and self.projection_config['rescore']:
+            retrieve_top_k = max(candidates, math.ceil(candidates * self.projection_config['oversampling']))
+            hybrid = options['vector_store_query_mode'] == 'hybrid' and getattr(self.index.vector_store, 'enable_hybrid', False)
+            node_postprocessors.insert(0, FullVectorRescorer(self.query_embed_model, self.projection_store, candidates,
+                                                             options['alpha'] if hybrid else None))
+        
+        retriever_kwargs = {
+            'vector_store_query_mode': options['vector_store_query_mode'],
+            'alpha': options['alpha'],
+            'similarity_top_k': retrieve_top_k,
+            'sparse_top_k': options['sparse_top_k'],
+            'vector_store_kwargs': self._vector_store_kwargs()
+        }
+        if self.document_router is not None:
+            # 兩階段檢索：先挑選文件，再只在這些文件的段落中搜尋
+            retriever = DocumentRoutedRetriever(self.index, self.document_router, self.query_embed_model,
+                                                query_filter=query_filter, **retriever_kwargs)
+            return RetrieverQueryEngine.from_args(
+                retriever,
+                llm=self.llm,
+                node_postprocessors=node_postprocessors,
+                streaming=options['streaming']
+            )
+        
+        if query_filter is not None:
+            qdrant_filter = query_filter.chunk_filter()
+            if qdrant_filter is not None:
+                retriever_kwargs['vector_store_kwargs']['qdrant_filters'] = qdrant_filter
+        return self.index.as_query_engine(
+            llm=self.llm,
+            node_postprocessors=node_postprocessors,
+            num_queries=options['num_queries'],
+            streaming=options['streaming'],
+            **retriever_kwargs
+        )
     
-    def query(self, question: str) -> str:
+    def _engine_for(self, query_filter: Optional[QueryFilter]):
         if not self.query_engine:
             raise ValueError("請先建立查詢引擎")
-        
-        response = self.query_engine.query(question)
+        if query_filter is None:
+            return self.query_engine
+        print(f"🔎 查詢過濾條件: {query_filter.to_dict()}")
+        return self._build_query_engine(query_filter)
+    
+    def candidate_count(self, top_k: int) -> int:
+        """送進上下文打包的候選段落數"""
+        if self.context_packer is None:
+            return top_k
+        return max(top_k, self.packing_config['candidates'])
+    
+    def _vector_store_kwargs(self) -> dict:
+        """量化集合查詢時的重新評分與過量取樣參數"""
+        search_params = collection_profile.search_params(self.collection_profile)
+        return {'search_params': search_params} if search_params is not None else {}
+    
+    def query(self, question: str, query_filter: Optional[QueryFilter] = None) -> str:
+        response = self._engine_for(query_filter).query(question)
         
         print(f"🔍 LlamaIndex 查詢: {question}")
         print(f"📝 響應類型: {type(response)}")
@@ -138,6 +608,104 @@ class LlamaIndexProcessor:
                 print(f"⚠️ 響應為空或無效")
                 return None  # 返回 None 而不是字串 "None"
     
+    def prepare_generation(self, question: str, query_filter: Optional[QueryFilter] = None) -> RoutedGeneration:
+        """只執行檢索與後處理，生成交由呼叫端的提供者路由"""
+        engine = self._engine_for(query_filter)
+        query_bundle = QueryBundle(question)
+        print(f"🔍 LlamaIndex 路由查詢: {question}")
+        return RoutedGeneration(engine, self.llm, query_bundle, engine.retrieve(query_bundle))
+
+    async def aprepare_generation(self, question: str, query_filter: Optional[QueryFilter] = None) -> RoutedGeneration:
+        engine = self._engine_for(query_filter)
+        query_bundle = QueryBundle(question)
+        print(f"🔍 LlamaIndex 非同步路由查詢: {question}")
+        return RoutedGeneration(engine, self.llm, query_bundle, await engine.aretrieve(query_bundle))
+
+    async def aquery(self, question: str, query_filter: Optional[QueryFilter] = None):
+        """非同步查詢，串流模式下返回 AsyncStreamingResponse"""
+        engine = self._engine_for(query_filter)
+
+        print(f"🔍 LlamaIndex 非同步查詢: {question}")
+        return await engine.aquery(question)
+
+    async def astream(self, question: str, query_filter: Optional[QueryFilter] = None):
+        """非同步串流查詢，逐塊產生回答文字"""
+        generation = await self.aprepare_generation(question, query_filter)
+        async for text in generation.aopen_primary():
+            yield text
+
+    def search(self,
+               queries: List[str],
+               top_k: int = 5,
+               query_filter: Optional[QueryFilter] = None,
+               mode: str = 'hybrid',
+               alpha: float = 0.5) -> List[List[NodeWithScore]]:
+        """純檢索（不經 LLM）：返回每個查詢的前 top_k 個段落
+
+        所有查詢以一次批次嵌入計算向量，文件路由與段落搜尋各合併為一次 query_batch_points 請求；
+        hybrid 模式的密集與稀疏結果以與查詢引擎相同的 relative_score_fusion 融合。
+        """
+        if not self.index:
+            raise ValueError("請先建立索引")
+        if not queries:
+            return []
+        from qdrant_client import models
+        
+        vector_store = self.index.vector_store
+        vectors = self._embed_queries(queries)
+        
+        # QdrantVectorStore 沒有公開的稀疏查詢編碼介面，沿用其內部編碼器以與索引時一致
+        sparse_query_fn = getattr(vector_store, '_sparse_query_fn', None)
+        hybrid = mode == 'hybrid' and vector_store.enable_hybrid and sparse_query_fn is not None
+        
+        fetch_k = top_k
+        rescorer = None
+        if self.projection_store is not None and self.projection_config['rescore']:
+            fetch_k = max(top_k, math.ceil(top_k * self.projection_config['oversampling']))
+            rescorer = FullVectorRescorer(self.query_embed_model, self.projection_store, top_k,
+                                          alpha if hybrid else None)
+        
+        if self.document_router is not None and self.document_router.needs_routing(query_filter):
+            document_filter = query_filter.document_filter() if query_filter is not None else None
+            routed = self.document_router.route_batch(vectors, document_filter)
+        else:
+            routed = [None] * len(queries)
+        filters = [routed_chunk_filter(query_filter, doc_ids) for doc_ids in routed]
+        
+        search_params = collection_profile.search_params(self.collection_profile)
+        requests = [
+            models.QueryRequest(query=vector, using=vector_store.dense_vector_name, limit=fetch_k,
+                                filter=qdrant_filter, with_payload=True, params=search_params)
+            for vector, qdrant_filter in zip(vectors, filters)
+        ]
+        if hybrid:
+            sparse_indices, sparse_values = sparse_query_fn(queries)
+            requests.extend(
+                models.QueryRequest(query=models.SparseVector(indices=indices, values=values),
+                                    using=vector_store.sparse_vector_name, limit=fetch_k,
+                                    filter=qdrant_filter, with_payload=True)
+                for indices, values, qdrant_filter in zip(sparse_indices, sparse_values, filters)
+            )
+        responses = vector_store.client.query_batch_points(vector_store.collection_name, requests=requests)
+        
+        results = []
+        for i, query in enumerate(queries):
+            result = vector_store.parse_to_query_result(responses[i].points)
+            if hybrid:
+                sparse_result = vector_store.parse_to_query_result(responses[len(queries) + i].points)
+                result = relative_score_fusion(result, sparse_result, alpha=alpha, top_k=fetch_k)
+            nodes = [NodeWithScore(node=node, score=score) for node, score in zip(result.nodes or [], result.similarities or [])]
+            if rescorer is not None:
+                nodes = rescorer.postprocess_nodes(nodes, query_bundle=QueryBundle(query))
+            results.append(nodes[:top_k])
+        return results
+    
+    def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """批次嵌入查詢；嵌入模型以單一 task_type 建立，查詢與文件嵌入相同"""
+        if isinstance(self.query_embed_model, ProjectedEmbedding):
+            return self.query_embed_model.get_query_embedding_batch(queries)
+        return self.embed_model.get_text_embedding_batch(queries)
+    
     def process_documents_and_query(self, 
                                   input_dir: str, 
                                   question: str,
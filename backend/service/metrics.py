@@ -0,0 +1,59 @@
+import time
+from collections import defaultdict
+from threading import Lock
+from typing import Dict, Any
+
+
+class Metrics:
+    """行程內指標收集器（計數器、量表、耗時統計）"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._timings = {}
+        self._started_at = time.time()
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def set_gauge(self, name: str, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def add_gauge(self, name: str, delta):
+        with self._lock:
+            self._gauges[name] = self._gauges.get(name, 0) + delta
+
+    def observe(self, name: str, value: float):
+        """記錄一次觀測值（例如耗時秒數）"""
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = {'count': 0, 'sum': 0.0, 'max': 0.0}
+            timing['count'] += 1
+            timing['sum'] += value
+            if value > timing['max']:
+                timing['max'] = value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            timings = {}
+            for name, timing in self._timings.items():
+                timings[name] = {
+                    'count': timing['count'],
+                    'sum': round(timing['sum'], 6),
+                    'avg': round(timing['sum'] / timing['count'], 6) if timing['count'] else 0.0,
+                    'max': round(timing['max'], 6)
+                }
+            return {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'timings': timings,
+                'uptime': round(time.time() - self._started_at, 3)
+            }
+
+
+# 全域指標實例
+metrics = Metrics()
@@ -0,0 +1,134 @@
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+from .metrics import metrics
+from .query_filters import DOC_ID_KEY, FILE_NAME_KEY
+
+
+SIGNATURE_BITS = 64
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """splitmix64 終結函數：把多項式滾動雜湊打散成均勻的 64 位元"""
+    with np.errstate(over='ignore'):
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return values ^ (values >> np.uint64(31))
+
+
+def simhash(text: str, shingle: int = 5) -> int:
+    """文字的 64 位元 SimHash
+
+    以字元 n-gram 為特徵（中文沒有空白分詞也適用），空白正規化並忽略大小寫；
+    特徵雜湊與逐位元加總都以 numpy 向量化計算。
+    """
+    text = _WHITESPACE.sub(' ', text).strip().lower()
+    if not text:
+        return 0
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    width = min(shingle, len(codes))
+    # 每個位置的 n-gram 以多項式組合碼位，溢位即為模 2^64
+    grams = np.zeros(len(codes) - width + 1, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for offset in range(width):
+            grams = grams * np.uint64(0x100000001B3) + codes[offset:offset + len(grams)]
+    hashes = _mix(grams)
+    bits = (hashes[:, None] >> np.arange(SIGNATURE_BITS, dtype=np.uint64)) & np.uint64(1)
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(hashes)
+    signature = 0
+    for bit in np.flatnonzero(votes > 0):
+        signature |= 1 << int(bit)
+    return signature
+
+
+class NearDuplicateFilter:
+    """建立索引時以 SimHash 剔除近似重複的段落，在嵌入之前執行
+
+    簽章漢明距離不超過 max_distance 即視為重複，保留最先出現的段落。
+    依鴿籠原理將 64 位元切成 max_distance + 1 段，任一段完全相同的段落才比對完整距離，
+    不需要和所有已保留的段落逐一比較。
+    scope 預設為 'document'，只比對同一文件內的段落，每份文件的點位仍然完整，
+    文件過濾、路由質心與整份文件摘要都不受影響；
+    'collection' 時跨文件比對（不同版本的相同章節只存一份），被剔除的段落只屬於先出現的文件，
+    限定後出現文件的過濾、其路由質心與摘要都會缺少這些段落。
+    """
+
+    def __init__(self, max_distance: int = 3, shingle: int = 5, min_chars: int = 50, scope: str = 'document'):
+        self.max_distance = max(0, min(max_distance, 15))
+        self.shingle = max(shingle, 1)
+        self.min_chars = min_chars
+        self.scope = scope
+        bands = self.max_distance + 1
+        width = SIGNATURE_BITS // bands
+        self._bands: List[Tuple[int, int]] = [
+            (i * width, (1 << (width if i < bands - 1 else SIGNATURE_BITS - i * width)) - 1)
+            for i in range(bands)
+        ]
+        self._buckets: List[Dict[tuple, List[int]]] = [{} for _ in self._bands]
+        self._kept: List[Tuple[int, str]] = []
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def filter(self, nodes: Sequence[BaseNode]) -> List[BaseNode]:
+        """返回需要嵌入與寫入的段落；重複段落計入其文件的統計"""
+        kept = []
+        for node in nodes:
+            doc_id = node.metadata.get(DOC_ID_KEY, '')
+            stats = self._file_stats(node)
+            stats['chunks'] += 1
+            text = node.get_content()
+            if len(text.strip()) < self.min_chars:
+                kept.append(node)
+                continue
+
+            signature = simhash(text, self.shingle)
+            original = self._find(signature, doc_id)
+            if original is not None:
+                stats['duplicates'] += 1
+                if self._kept[original][1] != doc_id:
+                    stats['cross_document'] += 1
+                continue
+            self._add(signature, doc_id)
+            kept.append(node)
+
+        dropped = len(nodes) - len(kept)
+        if dropped:
+            metrics.incr('ingest_near_duplicates_total', dropped)
+        return kept
+
+    @property
+    def duplicates(self) -> int:
+        return sum(stats['duplicates'] for stats in self.stats.values())
+
+    def report(self) -> Dict[str, Dict[str, int]]:
+        """每個檔案的段落數、剔除數（= 省下的嵌入與 Qdrant 點位）與其中跨文件重複的數量"""
+        return {name: dict(stats) for name, stats in self.stats.items()}
+
+    def _file_stats(self, node: BaseNode) -> Dict[str, int]:
+        name = node.metadata.get(FILE_NAME_KEY) or node.metadata.get(DOC_ID_KEY, '')
+        if name not in self.stats:
+            self.stats[name] = {'chunks': 0, 'duplicates': 0, 'cross_document': 0}
+        return self.stats[name]
+
+    def _band_keys(self, signature: int, doc_id: str) -> List[tuple]:
+        scope = doc_id if self.scope == 'document' else ''
+        return [(scope, (signature >> shift) & mask) for shift, mask in self._bands]
+
+    def _find(self, signature: int, doc_id: str) -> Optional[int]:
+        checked = set()
+        for buckets, key in zip(self._buckets, self._band_keys(signature, doc_id)):
+            for index in buckets.get(key, ()):
+                if index in checked:
+                    continue
+                checked.add(index)
+                if bin(self._kept[index][0] ^ signature).count('1') <= self.max_distance:
+                    return index
+        return None
+
+    def _add(self, signature: int, doc_id: str):
+        index = len(self._kept)
+        self._kept.append((signature, doc_id))
+        for buckets, key in zip(self._buckets, self._band_keys(signature, doc_id)):
+            buckets.setdefault(key, []).append(index)
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import zlib
+import struct
+import hashlib
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    import zstandard
+except ImportError:  # 未安裝 zstandard 時改用 zlib
+    zstandard = None
+
+
+MAGIC = b'PNS1'
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+_LENGTH = struct.Struct('>I')
+
+
+def _compress(data: bytes, level: int):
+    if zstandard is not None:
+        return CODEC_ZSTD, zstandard.ZstdCompressor(level=level).compress(data)
+    return CODEC_ZLIB, zlib.compress(data, min(level, 9))
+
+
+def _decompress(codec: int, data: bytes) -> bytes:
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("節點快取以 zstd 壓縮，但未安裝 zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    raise ValueError(f"未知的節點快取壓縮格式: {codec}")
+
+
+def encode_records(records: List[Dict[str, Any]], level: int = 3) -> bytes:
+    """檔案格式：MAGIC + codec(1 byte) + 壓縮後的 [u32 長度 + JSON] 紀錄序列"""
+    body = bytearray()
+    for record in records:
+        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        body += _LENGTH.pack(len(payload))
+        body += payload
+    codec, compressed = _compress(bytes(body), level)
+    return MAGIC + bytes([codec]) + compressed
+
+
+def decode_records(data: bytes) -> Iterator[Dict[str, Any]]:
+    if data[:4] != MAGIC:
+        raise ValueError("不是有效的節點快取檔案")
+    body = _decompress(data[4], data[5:])
+    offset = 0
+    while offset < len(body):
+        (length,) = _LENGTH.unpack_from(body, offset)
+        offset += _LENGTH.size
+        yield json.loads(body[offset:offset + length])
+        offset += length
+
+
+class ParsedNodeStore:
+    """依檔案 SHA-256 保存解析與切塊後的節點，重建索引時略過 PDF 解析
+
+    快取鍵包含切塊設定的指紋（node parser 與其使用的 LLM）；
+    只更換嵌入模型時快取仍然有效，可直接從節點重新嵌入。
+    """
+
+    def __init__(self, directory: str, fingerprint: str, level: int = 3):
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.level = level
+        self._fingerprint_key = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:12]
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self, sha256: str) -> Optional[List[Dict[str, Any]]]:
+        try:
+            with open(self._data_path(sha256), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            return list(decode_records(data))
+        except Exception as e:
+            print(f"⚠️ 節點快取損毀，將重新解析: {e}")
+            return None
+
+    def save(self, sha256: str, records: List[Dict[str, Any]], **meta):
+        data_path = self._data_path(sha256)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        data = encode_records(records, self.level)
+
+        tmp_path = f"{data_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, data_path)
+
+        manifest = {
+            'sha256': sha256,
+            'fingerprint': self.fingerprint,
+            'nodes': len(records),
+            'pages': records[0].get('file_pages', len({r.get('page') for r in records})) if records else 0,
+            'tokens': sum(r.get('tokens', 0) for r in records),
+            'codec': 'zstd' if data[4] == CODEC_ZSTD else 'zlib',
+            'bytes': len(data),
+            'created_at': time.time(),
+            **meta
+        }
+        tmp_path = f"{self._meta_path(sha256)}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self._meta_path(sha256))
+        return manifest
+
+    def manifest(self, sha256: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._meta_path(sha256), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _data_path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256[:2], f"{sha256}-{self._fingerprint_key}.pns")
+
+    def _meta_path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256[:2], f"{sha256}-{self._fingerprint_key}.json")
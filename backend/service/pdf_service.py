@@ -5,6 +5,9 @@ from .chat_stream_service import ChatStreamService
 from .embedding_service import EmbeddingService
 from .llama_index_utils import LlamaIndexProcessor
 from .config_manager import ConfigManager
+from .admission import AdmissionController
+from .priority_scheduler import create_priority_scheduler
+from .node_store import ParsedNodeStore
 
 class PDFService:
     def __init__(self, config_path = 'config.ini'):
@@ -14,6 +17,12 @@ class PDFService:
         self.config_sections = config_sections
         self.config_manager = config_manager
         self.embedding_service = EmbeddingService(config_path)
+        # 並發上限以鎖檔在所有 gunicorn worker 之間共用
+        self.admission = AdmissionController(config_manager.get_admission_config(),
+                                             config_manager.get_admission_slot_dir())
+        self.chat_stream_service = ChatStreamService(config_sections, self.admission)
+        # 互動查詢與 ingestion 共用 Gemini 配額，互動查詢優先
+        self.scheduler = create_priority_scheduler(config_manager.get_scheduler_config())
 
     def clear_uploaded_data(self, upload_folder=None, collection_name="operation_guide"):
         try:
@@ -134,7 +143,89 @@ class PDFService:
             }
 
 
-    def query_with_llama_index(self, service, question: str, use_chat_enhancement=False, chat_type='gemini'):
+    def build_llama_index(self, upload_folder, collection_name="pdf_chat_collection", progress=None):
+        """解析 PDF 並寫入 Qdrant 集合，由 ingestion worker 行程呼叫；不建立查詢引擎"""
+        progress = progress or (lambda stage, **fields: None)
+
+        pdf_files = [f for f in os.listdir(upload_folder) if f.lower().endswith('.pdf')] \
+            if upload_folder and os.path.exists(upload_folder) else []
+        if not pdf_files:
+            raise ValueError(f"上傳目錄中沒有 PDF 文件: {upload_folder}")
+
+        processor = LlamaIndexProcessor(self.config_manager)
+        ingestion_config = self.config_manager.get_ingestion_config()
+        node_store = ParsedNodeStore(ingestion_config['node_store_dir'], processor.parser_fingerprint)
+
+        progress('loading', pdf_files=pdf_files)
+        print("🔍 分批創建向量索引...")
+
+        def on_batch(indexed_pages, total_pages, last_page):
+            # 已提交的頁面立即可查詢，web 行程依此水位線提前連接索引
+            progress('indexing',
+                     documents=total_pages,
+                     indexed_pages=indexed_pages,
+                     total_pages=total_pages,
+                     queryable_through=last_page)
+            if indexed_pages:
+                print(f"📑 已索引 {indexed_pages}/{total_pages} 頁")
+
+        pdf_paths = [os.path.join(upload_folder, f) for f in sorted(pdf_files)]
+        processor.create_qdrant_index_progressive(
+            pdf_paths,
+            collection_name,
+            ingestion_config['batch_pages'],
+            on_batch,
+            self.scheduler,
+            node_store
+        )
+        stats = processor.build_stats
+        print(f"✅ 向量索引創建成功（快取 {stats['cached_files']} 個文件，解析 {stats['parsed_files']} 個文件）")
+
+        return {
+            'collection_name': collection_name,
+            'pdf_files': pdf_files,
+            'documents': stats['total_pages'],
+            'indexed_pages': stats['total_pages'],
+            'total_pages': stats['total_pages'],
+            'nodes': stats['nodes'],
+            'duplicates': stats['duplicates'],
+            'boilerplate_lines': stats['boilerplate_lines'],
+            'boilerplate_chars': stats['boilerplate_chars'],
+            'dedup': stats['dedup'],
+            'cached_files': stats['cached_files'],
+            'parsed_files': stats['parsed_files']
+        }
+
+    def attach_llama_index_service(self, upload_folder, collection_name="pdf_chat_collection"):
+        """連接 ingestion worker 已建立的 Qdrant 集合並建立查詢引擎（不解析、不嵌入）"""
+        processor = LlamaIndexProcessor(self.config_manager)
+        pdf_files = [f for f in os.listdir(upload_folder) if f.lower().endswith('.pdf')] \
+            if upload_folder and os.path.exists(upload_folder) else []
+
+        try:
+            index = processor.load_qdrant_index(collection_name)
+            query_engine = processor.create_query_engine()
+        except Exception as e:
+            print(f"❌ 連接向量索引失敗: {e}")
+            return {
+                'processor': processor,
+                'mode': 'error',
+                'upload_folder': upload_folder,
+                'error': str(e)
+            }
+
+        return {
+            'processor': processor,
+            'mode': 'full',
+            'upload_folder': upload_folder,
+            'index': index,
+            'query_engine': query_engine,
+            'collection_name': collection_name,
+            'pdf_files': pdf_files
+        }
+
+    def query_with_llama_index(self, service, question: str, use_chat_enhancement=False, chat_type='gemini',
+                               query_filter=None, admission_ticket=None):
         if not service:
             return "❌ 服務未初始化"
         
@@ -146,9 +237,7 @@ class PDFService:
         if service.get('mode') == 'chat_only':
             if use_chat_enhancement:
                 try:
-                    # 使用實例的配置創建聊天服務
-                    chat_stream_service = ChatStreamService(self.config_sections)
-                    return chat_stream_service.chat(question, chat_type)
+                    return self.chat_stream_service.chat(question, chat_type)
                 except Exception as e:
                     return f"❌ 聊天服務錯誤: {e}"
             else:
@@ -160,7 +249,15 @@ class PDFService:
         
         # 執行 PDF 查詢
         try:
-            response = processor.query(question)
+            if self.chat_stream_service.router is not None and not use_chat_enhancement:
+                # 啟用路由時只在這裡檢索，生成交給路由器：主提供者首字過慢或失敗時對沖備援提供者；
+                # admission_ticket 為呼叫端已取得的 gemini 名額，由主提供者的串流持有
+                generation = processor.prepare_generation(question, query_filter)
+                return generation.response(self.chat_stream_service.routed_stream(
+                    generation.open_primary, generation.prompt, primary_ticket=admission_ticket
+                ))
+
+            response = processor.query(question, query_filter)
             
             # 調試日誌
             print(f"🔍 查詢問題: {question}")
@@ -179,7 +276,7 @@ class PDFService:
             # 如果啟用聊天增強
             if use_chat_enhancement:
                 try:
-                    chat_stream_service = ChatStreamService(self.config_sections)
+                    chat_stream_service = self.chat_stream_service
                     
                     if has_valid_response:
                         # 構建增強問題
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import socket
+import threading
+from typing import Dict, Optional
+from .admission import AdmissionRejected
+from .metrics import metrics
+
+
+INTERACTIVE = 'interactive'
+INGESTION = 'ingestion'
+PRIORITY_CLASSES = (INTERACTIVE, INGESTION)
+
+
+def _pid_alive(pid: str) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedUsageBoard:
+    """跨行程共用的使用量看板：每個行程以 <hostname>.<pid>.json 回報各類別的使用中與等待數量
+
+    web worker（互動查詢）與 ingestion worker（批次嵌入）共用同一個提供者配額，
+    藉由此目錄得知其他行程的負載；已結束行程或過久未更新的檔案會被忽略。
+    目錄可能位於多台主機共用的磁碟上，PID 只在同一主機內檢查是否存活，其他主機的檔案只依更新時間判斷。
+    """
+
+    def __init__(self, directory: str, ttl_seconds: float = 600.0, refresh_interval: float = 0.2):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.refresh_interval = refresh_interval
+        self._cache = None
+        self._cache_at = 0.0
+        self.hostname = socket.gethostname()
+        os.makedirs(directory, exist_ok=True)
+
+    def _own_name(self) -> str:
+        # fork 出的 worker 沿用同一個看板物件，因此每次取目前的 PID
+        return f"{self.hostname}.{os.getpid()}.json"
+
+    def report(self, in_use: Dict[str, int], waiting: Dict[str, int]):
+        path = os.path.join(self.directory, self._own_name())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'in_use': in_use, 'waiting': waiting, 'updated_at': time.time()}, f)
+        os.replace(tmp_path, path)
+
+    def remote_totals(self):
+        """其他行程的 (in_use, waiting) 合計，短時間內重複讀取會使用快取"""
+        now = time.monotonic()
+        if self._cache is not None and now - self._cache_at < self.refresh_interval:
+            return self._cache
+
+        in_use = {cls: 0 for cls in PRIORITY_CLASSES}
+        waiting = {cls: 0 for cls in PRIORITY_CLASSES}
+        own_name = self._own_name()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name == own_name:
+                continue
+            hostname, _, pid = name[:-5].rpartition('.')
+            try:
+                with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                    usage = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+            if hostname == self.hostname and not _pid_alive(pid):
+                continue
+            if time.time() - usage.get('updated_at', 0) > self.ttl_seconds:
+                continue
+            for cls in PRIORITY_CLASSES:
+                in_use[cls] += usage.get('in_use', {}).get(cls, 0)
+                waiting[cls] += usage.get('waiting', {}).get(cls, 0)
+
+        self._cache = (in_use, waiting)
+        self._cache_at = now
+        return self._cache
+
+
+class PriorityTicket:
+    """已取得的排程名額，release 可重複呼叫"""
+
+    def __init__(self, scheduler: 'PriorityScheduler', priority_class: str):
+        self._scheduler = scheduler
+        self.priority_class = priority_class
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._scheduler.release(self.priority_class)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class PriorityScheduler:
+    """共用提供者配額（嵌入與 LLM）的優先權排程
+
+    - 每個類別有保留額度（capacity * share），在保留額度內一定可以取得名額
+    - 互動查詢優先：有互動請求在等待時，ingestion 不會取得超出保留額度的名額
+    - ingestion 只使用剩餘容量，且永遠不佔用互動類別尚未使用的保留額度
+    - 搶占發生在名額邊界：ingestion 每個批次完成後釋放名額，再重新排隊
+    """
+
+    def __init__(self,
+                 capacity: int = 8,
+                 reserved_shares: Optional[Dict[str, float]] = None,
+                 board: Optional[SharedUsageBoard] = None,
+                 queue_timeout: float = 30.0,
+                 poll_interval: float = 0.2):
+        self.capacity = max(capacity, 1)
+        reserved_shares = reserved_shares or {INTERACTIVE: 0.5, INGESTION: 0.125}
+        self.reserved = {
+            cls: min(int(self.capacity * reserved_shares.get(cls, 0.0)), self.capacity)
+            for cls in PRIORITY_CLASSES
+        }
+        self.board = board
+        self.queue_timeout = queue_timeout
+        self.poll_interval = poll_interval
+        self._in_use = {cls: 0 for cls in PRIORITY_CLASSES}
+        self._waiting = {cls: 0 for cls in PRIORITY_CLASSES}
+        self._cond = threading.Condition()
+        self._snapshot_seq = 0
+        self._published_seq = 0
+        self._publish_lock = threading.Lock()
+
+    def acquire(self, priority_class: str, timeout: Optional[float] = None) -> PriorityTicket:
+        """取得名額；互動類別逾時（預設 queue_timeout）時拋出 AdmissionRejected，ingestion 預設一直等待"""
+        if priority_class not in PRIORITY_CLASSES:
+            raise ValueError(f"未知的優先權類別: {priority_class}")
+        if timeout is None and priority_class == INTERACTIVE:
+            timeout = self.queue_timeout
+
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self._cond:
+            self._waiting[priority_class] += 1
+            snapshot = self._snapshot_locked()
+        self._publish(snapshot)
+        try:
+            while True:
+                # 看板的檔案讀取不持有鎖，避免其他執行緒的 acquire / release 排隊等待磁碟 I/O
+                remote = self.board.remote_totals() if self.board is not None else None
+                with self._cond:
+                    if self._allowed_locked(priority_class, remote):
+                        self._in_use[priority_class] += 1
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        metrics.incr(f'scheduler_{priority_class}_timeout_total')
+                        raise AdmissionRejected(priority_class, '排程等待逾時', 503, max(1, int(self.queue_timeout / 2)))
+                    # 其他行程的負載變化不會喚醒這裡，因此定期重新檢查
+                    wait = self.poll_interval if remaining is None else min(self.poll_interval, remaining)
+                    self._cond.wait(wait)
+        finally:
+            with self._cond:
+                self._waiting[priority_class] -= 1
+                snapshot = self._snapshot_locked()
+            self._publish(snapshot)
+
+        metrics.observe(f'scheduler_{priority_class}_wait_seconds', time.monotonic() - start)
+        return PriorityTicket(self, priority_class)
+
+    def slot(self, priority_class: str, timeout: Optional[float] = None) -> PriorityTicket:
+        """可用於 with 區塊的名額"""
+        return self.acquire(priority_class, timeout)
+
+    def release(self, priority_class: str):
+        with self._cond:
+            self._in_use[priority_class] -= 1
+            snapshot = self._snapshot_locked()
+            self._cond.notify_all()
+        self._publish(snapshot)
+
+    def _allowed_locked(self, priority_class: str, remote=None) -> bool:
+        in_use = dict(self._in_use)
+        waiting = dict(self._waiting)
+        # 自己這個請求不算在等待者中
+        waiting[priority_class] -= 1
+        if remote is not None:
+            remote_in_use, remote_waiting = remote
+            for cls in PRIORITY_CLASSES:
+                in_use[cls] += remote_in_use[cls]
+                waiting[cls] += remote_waiting[cls]
+
+        headroom = self.capacity - sum(in_use.values())
+        if headroom <= 0:
+            return False
+        if in_use[priority_class] < self.reserved[priority_class]:
+            return True
+
+        if priority_class == INGESTION:
+            if waiting[INTERACTIVE] > 0:
+                return False
+            unused_interactive = max(self.reserved[INTERACTIVE] - in_use[INTERACTIVE], 0)
+            return headroom > unused_interactive
+
+        # 互動類別只在 ingestion 確實在等待時才讓出其保留額度
+        unused_ingestion = max(self.reserved[INGESTION] - in_use[INGESTION], 0) if waiting[INGESTION] > 0 else 0
+        return headroom > unused_ingestion
+
+    def _snapshot_locked(self):
+        self._snapshot_seq += 1
+        return self._snapshot_seq, dict(self._in_use), dict(self._waiting)
+
+    def _publish(self, snapshot):
+        """在 _cond 之外發布計數；多個執行緒同時發布時只寫入較新的快照，看板不會被舊值覆蓋"""
+        seq, in_use, waiting = snapshot
+        with self._publish_lock:
+            if seq <= self._published_seq:
+                return
+            self._published_seq = seq
+            for cls in PRIORITY_CLASSES:
+                metrics.set_gauge(f'scheduler_{cls}_in_use', in_use[cls])
+                metrics.set_gauge(f'scheduler_{cls}_waiting', waiting[cls])
+            if self.board is not None:
+                try:
+                    self.board.report(in_use, waiting)
+                except OSError as e:
+                    print(f"⚠️ 無法更新排程看板: {e}")
+
+
+def create_priority_scheduler(scheduler_config: Dict) -> PriorityScheduler:
+    """依設定建立排程器，跨行程的負載透過 board_dir 共用"""
+    return PriorityScheduler(
+        capacity=scheduler_config['capacity'],
+        reserved_shares={
+            INTERACTIVE: scheduler_config['interactive_share'],
+            INGESTION: scheduler_config['ingestion_share']
+        },
+        board=SharedUsageBoard(scheduler_config['board_dir']),
+        queue_timeout=scheduler_config['queue_timeout']
+    )
@@ -0,0 +1,342 @@
+import os
+import json
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from pydantic import PrivateAttr
+
+
+PROJECTION_MODES = ('none', 'truncate', 'pca')
+META_FILE = 'meta.json'
+VECTORS_FILE = 'full_vectors.f32'
+IDS_FILE = 'full_vectors.ids'
+PCA_FILE = 'pca.npz'
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class Projection:
+    """全維度嵌入 → 儲存維度
+
+    - truncate：保留前 dim 維後重新正規化（僅適用以 Matryoshka 方式訓練的模型）
+    - pca：以語料擬合的主成分矩陣投影
+    """
+
+    def __init__(self, mode: str, dim: int, mean: Optional[np.ndarray] = None,
+                 components: Optional[np.ndarray] = None):
+        if mode not in PROJECTION_MODES or mode == 'none':
+            raise ValueError(f"未知的投影方式: {mode}（可用: truncate, pca）")
+        self.mode = mode
+        self.dim = dim
+        self.mean = mean
+        self.components = components
+
+    @property
+    def ready(self) -> bool:
+        return self.mode == 'truncate' or self.components is not None
+
+    def fit(self, vectors: np.ndarray):
+        """以 SVD 擬合主成分；樣本數少於 dim 時不足的維度補零（對 cosine 無影響）"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.mean = vectors.mean(axis=0)
+        _, _, vt = np.linalg.svd(vectors - self.mean, full_matrices=False)
+        components = np.zeros((self.dim, vectors.shape[1]), dtype=np.float32)
+        rank = min(self.dim, vt.shape[0])
+        components[:rank] = vt[:rank]
+        self.components = components
+
+    def project(self, vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.mode == 'truncate':
+            return _normalize(vectors[..., :self.dim])
+        if self.components is None:
+            raise ValueError("PCA 投影尚未擬合")
+        return _normalize((vectors - self.mean) @ self.components.T)
+
+    def save(self, path: str):
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, mean=self.mean, components=self.components)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str):
+        with np.load(path) as data:
+            self.mean = data['mean']
+            self.components = data['components']
+
+
+class ProjectionStore:
+    """每個集合一個目錄：投影參數與全精度向量側檔
+
+    - full_vectors.f32：逐列附加的 float32 全精度向量，查詢時以 memmap 讀取
+    - full_vectors.ids：與向量逐列對應的 node id（每行一個）
+    ingestion worker 先寫向量再寫 id，最後才寫入 Qdrant，
+    因此 web 行程查到的點位一定能在側檔中找到全精度向量。
+    """
+
+    def __init__(self, directory: str, mode: str, dim: int):
+        self.directory = directory
+        self.mode = mode
+        self.dim = dim
+        self._projection = None
+        self._projection_key = None
+        self._vectors = None
+        self._vectors_key = None
+        self._rows: Dict[str, int] = {}
+        self._row_count = 0
+        self._generation = None
+        self._ids_key = None
+        self._ids_offset = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_collection(cls, projection_config: Dict[str, Any], collection_name: str) -> Optional['ProjectionStore']:
+        if projection_config['mode'] == 'none':
+            return None
+        return cls(os.path.join(projection_config['projection_dir'], collection_name),
+                   projection_config['mode'], projection_config['dim'])
+
+    def reset(self, full_dim: int, embedding_model: str):
+        """重建集合時清除舊的側檔與投影參數"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+        meta = {
+            'mode': self.mode,
+            'dim': self.dim,
+            'full_dim': full_dim,
+            'embedding_model': embedding_model,
+            'generation': uuid.uuid4().hex
+        }
+        with open(os.path.join(self.directory, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        open(os.path.join(self.directory, VECTORS_FILE), 'wb').close()
+        open(os.path.join(self.directory, IDS_FILE), 'wb').close()
+        self._projection = Projection(self.mode, self.dim)
+        self._projection_key = None
+
+    def meta(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.directory, META_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def projection(self) -> Optional[Projection]:
+        """目前的投影；PCA 尚未擬合時返回 None。其他行程重新擬合後會自動重新載入"""
+        if self.mode == 'truncate':
+            if self._projection is None:
+                self._projection = Projection(self.mode, self.dim)
+            return self._projection
+
+        path = os.path.join(self.directory, PCA_FILE)
+        key = _file_key(path)
+        if key is None:
+            return self._projection if self._projection is not None and self._projection.ready else None
+        if key != self._projection_key:
+            projection = Projection(self.mode, self.dim)
+            projection.load(path)
+            self._projection, self._projection_key = projection, key
+        return self._projection
+
+    def fit(self, vectors: np.ndarray) -> Projection:
+        projection = Projection(self.mode, self.dim)
+        projection.fit(vectors)
+        path = os.path.join(self.directory, PCA_FILE)
+        projection.save(path)
+        self._projection, self._projection_key = projection, _file_key(path)
+        return projection
+
+    def append(self, node_ids: List[str], vectors: np.ndarray):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with open(os.path.join(self.directory, VECTORS_FILE), 'ab') as f:
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(os.path.join(self.directory, IDS_FILE), 'a', encoding='utf-8') as f:
+            f.write(''.join(f"{node_id}\n" for node_id in node_ids))
+
+    def lookup(self, node_ids: List[str]) -> Dict[str, np.ndarray]:
+        """返回找得到全精度向量的 node id → 向量"""
+        with self._lock:
+            self._refresh_locked()
+            if self._vectors is None:
+                return {}
+            return {node_id: self._vectors[self._rows[node_id]]
+                    for node_id in node_ids
+                    if node_id in self._rows and self._rows[node_id] < len(self._vectors)}
+
+    def _refresh_locked(self):
+        meta = self.meta()
+        if meta is None:
+            self._vectors, self._rows = None, {}
+            return
+
+        ids_path = os.path.join(self.directory, IDS_FILE)
+        ids_key = _file_key(ids_path)
+        if ids_key is None:
+            self._vectors, self._rows = None, {}
+            return
+        # 重建後 inode 可能被重用，以 meta 中的 generation 判斷是否需要從頭讀取；否則只讀新附加的完整行
+        if meta.get('generation') != self._generation:
+            self._generation = meta.get('generation')
+            self._rows, self._ids_offset, self._ids_key, self._vectors_key = {}, 0, None, None
+            self._row_count = 0
+        if ids_key != self._ids_key:
+            with open(ids_path, 'rb') as f:
+                f.seek(self._ids_offset)
+                data = f.read()
+            complete = data[:data.rfind(b'\n') + 1]
+            # 每一行對應向量檔的一列；同一個 node id 重複寫入時 dict 不會變大，列號必須另外計數，
+            # 否則之後的 id 都會對應到錯誤的向量（重複的 id 以最後寫入的向量為準）
+            for line in complete.decode('utf-8').splitlines():
+                self._rows[line] = self._row_count
+                self._row_count += 1
+            self._ids_offset += len(complete)
+            self._ids_key = ids_key
+
+        vectors_path = os.path.join(self.directory, VECTORS_FILE)
+        vectors_key = _file_key(vectors_path)
+        if vectors_key != self._vectors_key:
+            rows = (vectors_key[1] // (4 * meta['full_dim'])) if vectors_key else 0
+            self._vectors = np.memmap(vectors_path, dtype=np.float32, mode='r',
+                                      shape=(rows, meta['full_dim'])) if rows else None
+            self._vectors_key = vectors_key
+
+
+def _file_key(path: str):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class ProjectedEmbedding(BaseEmbedding):
+    """查詢時使用的嵌入模型：回傳投影後的向量，並保留全精度查詢向量供重新評分"""
+
+    _base: BaseEmbedding = PrivateAttr()
+    _store: ProjectionStore = PrivateAttr()
+    _full_queries: OrderedDict = PrivateAttr()
+    _cache_size: int = PrivateAttr()
+    _lock: Any = PrivateAttr()
+
+    def __init__(self, base: BaseEmbedding, store: ProjectionStore, cache_size: int = 256):
+        super().__init__(model_name=f"{base.model_name}:{store.mode}{store.dim}",
+                         embed_batch_size=base.embed_batch_size)
+        self._base = base
+        self._store = store
+        self._full_queries = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ProjectedEmbedding"
+
+    def full_query_embedding(self, query: str) -> np.ndarray:
+        with self._lock:
+            cached = self._full_queries.get(query)
+        if cached is not None:
+            return cached
+        return self._remember(query, self._base.get_query_embedding(query))
+
+    def _remember(self, query: str, embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._full_queries[query] = vector
+            self._full_queries.move_to_end(query)
+            while len(self._full_queries) > self._cache_size:
+                self._full_queries.popitem(last=False)
+        return vector
+
+    def get_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        """批次嵌入多個查詢（依 embed_batch_size 合併 API 呼叫），並保留全精度向量供重新評分"""
+        full = self._base.get_text_embedding_batch(queries)
+        for query, embedding in zip(queries, full):
+            self._remember(query, embedding)
+        return self._project(full)
+
+    def _project(self, vectors) -> List[List[float]]:
+        projection = self._store.projection()
+        if projection is None:
+            raise ValueError("投影參數尚未建立，請等待索引建立完成")
+        return projection.project(vectors).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        full = self._remember(query, self._base.get_query_embedding(query))
+        return self._project(full)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        full = self._remember(query, await self._base.aget_query_embedding(query))
+        return self._project(full)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._project(self._base.get_text_embedding(text))
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._project(self._base.get_text_embedding_batch(texts))
+
+
+class FullVectorRescorer(BaseNodePostprocessor):
+    """以全精度向量重新評分投影空間的候選，保留前 top_k 個
+
+    hybrid 模式下候選分數是密集與稀疏的融合分數（relative_score_fusion），只以餘弦取代會丟掉稀疏檢索的貢獻；
+    設定 hybrid_alpha 時比照融合方式，將全精度餘弦在候選間正規化到 [0, 1] 後，
+    以 hybrid_alpha * 餘弦 + (1 - hybrid_alpha) * 原融合分數 重新排序。
+    側檔中找不到向量的節點（例如舊路徑直接插入的文件）排在重新評分的節點之後。
+    """
+
+    top_k: int = 5
+    hybrid_alpha: Optional[float] = None
+    _embed_model: ProjectedEmbedding = PrivateAttr()
+    _store: ProjectionStore = PrivateAttr()
+
+    def __init__(self, embed_model: ProjectedEmbedding, store: ProjectionStore, top_k: int = 5,
+                 hybrid_alpha: Optional[float] = None):
+        super().__init__(top_k=top_k, hybrid_alpha=hybrid_alpha)
+        self._embed_model = embed_model
+        self._store = store
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FullVectorRescorer"
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        if not nodes or query_bundle is None:
+            return nodes[:self.top_k]
+
+        full_vectors = self._store.lookup([n.node.node_id for n in nodes])
+        if not full_vectors:
+            return nodes[:self.top_k]
+
+        query = _normalize(self._embed_model.full_query_embedding(query_bundle.query_str))
+        scored, missing = [], []
+        for n in nodes:
+            vector = full_vectors.get(n.node.node_id)
+            if vector is None:
+                missing.append(n)
+            else:
+                scored.append((n, float(_normalize(vector) @ query)))
+
+        if self.hybrid_alpha is None:
+            rescored = [NodeWithScore(node=n.node, score=cosine) for n, cosine in scored]
+        else:
+            cosines = [cosine for _, cosine in scored]
+            low, span = min(cosines), max(cosines) - min(cosines)
+            rescored = [NodeWithScore(
+                node=n.node,
+                score=self.hybrid_alpha * ((cosine - low) / span if span > 0 else 1.0)
+                + (1.0 - self.hybrid_alpha) * (n.score or 0.0)
+            ) for n, cosine in scored]
+        rescored.sort(key=lambda n: n.score, reverse=True)
+        return (rescored + missing)[:self.top_k]
@@ -0,0 +1,238 @@
+import time
+import queue
+import threading
+from collections import deque
+from typing import Callable, Dict, Iterator, List, Optional
+from .admission import AdmissionRejected
+from .metrics import metrics
+from .stream_control import close_upstream, current_greenlet, interrupt, INTERRUPTED
+
+
+class ProviderStats:
+    """單一提供者的滾動首字延遲（TTFT）與錯誤率
+
+    對沖落敗、首字前就被取消的請求只知道 TTFT 至少有多久，以設限（censored）樣本記錄；
+    只記錄勝出者會讓 p95 偏低，對沖等待時間隨之越縮越短。
+    """
+
+    def __init__(self, window: int = 100):
+        self._ttft = deque(maxlen=window)
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record_ttft(self, seconds: float, censored: bool = False):
+        with self._lock:
+            self._ttft.append((seconds, censored))
+
+    def record_outcome(self, success: bool):
+        with self._lock:
+            self._outcomes.append(1 if success else 0)
+
+    def p95_ttft(self, min_samples: int = 10) -> Optional[float]:
+        """以 Kaplan-Meier 估計含設限樣本的 p95；尾端全是設限樣本時取最大的下界"""
+        with self._lock:
+            if len(self._ttft) < min_samples:
+                return None
+            # 同一時間點的實際觀測排在設限樣本之前
+            ordered = sorted(self._ttft, key=lambda sample: (sample[0], sample[1]))
+        survival = 1.0
+        at_risk = len(ordered)
+        for seconds, censored in ordered:
+            if not censored:
+                survival *= 1.0 - 1.0 / at_risk
+                if survival <= 0.05 + 1e-9:
+                    return seconds
+            at_risk -= 1
+        return ordered[-1][0]
+
+    def error_rate(self) -> float:
+        with self._lock:
+            if not self._outcomes:
+                return 0.0
+            return 1.0 - sum(self._outcomes) / len(self._outcomes)
+
+
+class _Attempt:
+    """在背景執行緒中消費單一提供者的串流，將事件送回共用佇列
+
+    首字延遲在這裡記錄，落敗者也計入：取消前已出字為實際觀測，首字前被取消則為設限樣本。
+    准入被拒（名額已滿）時請求根本沒有送到提供者，不計入延遲與錯誤率。
+    """
+
+    def __init__(self, provider: str, open_stream: Callable[[str], Iterator[str]], events: queue.Queue,
+                 stats: ProviderStats):
+        self.provider = provider
+        self.started_at = time.monotonic()
+        self.cancelled = threading.Event()
+        self._open_stream = open_stream
+        self._events = events
+        self._stats = stats
+        self._stream = None
+        self._runner = None
+        self._ttft_recorded = False
+        self._failed = False
+        self._lock = threading.Lock()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def cancel(self):
+        """立即停止：關閉上游並歸還名額，不等待下一個分塊（尚未出字的一方可能一直不會出字）"""
+        if self.cancelled.is_set():
+            return
+        self.cancelled.set()
+        if not self._failed:
+            self._record_ttft(censored=True)
+        # 串流包裝的 close 可從任何執行緒呼叫，立即歸還提供者名額；
+        # gevent 下另中斷阻塞在上游讀取的 greenlet，使上游連線一併關閉
+        close_upstream(self._stream)
+        interrupt(self._runner)
+
+    def _record_ttft(self, censored: bool = False):
+        with self._lock:
+            if self._ttft_recorded:
+                return
+            self._ttft_recorded = True
+        self._stats.record_ttft(time.monotonic() - self.started_at, censored)
+
+    def _run(self):
+        self._runner = current_greenlet()
+        try:
+            self._stream = self._open_stream(self.provider)
+            if self.cancelled.is_set():
+                return
+            for chunk in self._stream:
+                self._record_ttft()
+                if self.cancelled.is_set():
+                    return
+                self._events.put(('chunk', self, chunk))
+            # 沒有任何輸出就結束，視為成功但空回應
+            self._record_ttft()
+            self._events.put(('done', self, None))
+        except INTERRUPTED:
+            pass
+        except AdmissionRejected as e:
+            self._failed = True
+            self._events.put(('rejected', self, e))
+        except Exception as e:
+            self._failed = True
+            self._events.put(('error', self, e))
+        finally:
+            close_upstream(self._stream)
+
+
+class HedgedRouter:
+    """依延遲與錯誤率選擇提供者，主提供者首字過慢時發出對沖請求，取先出字者並取消另一方"""
+
+    def __init__(self,
+                 window: int = 100,
+                 min_delay: float = 1.0,
+                 max_delay: float = 10.0,
+                 default_delay: float = 3.0,
+                 error_rate_threshold: float = 0.5):
+        self.window = window
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.error_rate_threshold = error_rate_threshold
+        self._stats: Dict[str, ProviderStats] = {}
+        self._lock = threading.Lock()
+
+    def stats(self, provider: str) -> ProviderStats:
+        with self._lock:
+            if provider not in self._stats:
+                self._stats[provider] = ProviderStats(self.window)
+            return self._stats[provider]
+
+    def hedge_delay(self, provider: str) -> float:
+        """以主提供者的 p95 TTFT 作為對沖等待時間"""
+        p95 = self.stats(provider).p95_ttft()
+        if p95 is None:
+            return self.default_delay
+        return min(max(p95, self.min_delay), self.max_delay)
+
+    def order(self, primary: str, candidates: List[str]) -> List[str]:
+        """主提供者優先；錯誤率過高時降級，其餘依錯誤率與 p95 TTFT 排序"""
+        others = [c for c in candidates if c != primary]
+        others.sort(key=lambda c: (self.stats(c).error_rate(), self.stats(c).p95_ttft() or self.default_delay))
+        if self.stats(primary).error_rate() > self.error_rate_threshold and others:
+            metrics.incr('router_primary_demoted_total')
+            return others + [primary]
+        return [primary] + others
+
+    def stream(self, providers: List[str], open_stream: Callable[[str], Iterator[str]]) -> Iterator[str]:
+        """依序啟動提供者串流，輸出最先產生首字的提供者內容"""
+        events = queue.Queue()
+        pending = list(providers)
+        attempts: List[_Attempt] = []
+        winner = None
+        last_error = None
+
+        def launch():
+            provider = pending.pop(0)
+            attempt = _Attempt(provider, open_stream, events, self.stats(provider))
+            attempts.append(attempt)
+            return attempt
+
+        try:
+            primary = launch()
+            hedge_at = time.monotonic() + self.hedge_delay(primary.provider)
+
+            while True:
+                live = [a for a in attempts if not a.cancelled.is_set()]
+                if winner is None and not live:
+                    if not pending:
+                        raise last_error or RuntimeError("所有聊天提供者都無法回應")
+                    launch()
+                    continue
+
+                timeout = None
+                if winner is None and pending:
+                    timeout = max(hedge_at - time.monotonic(), 0)
+
+                try:
+                    kind, attempt, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    # 主提供者在截止時間內沒有首字，發出對沖請求
+                    hedge = launch()
+                    metrics.incr('router_hedge_started_total')
+                    print(f"⏱️ {primary.provider} 首字逾時，對沖請求 {hedge.provider}")
+                    hedge_at = time.monotonic() + self.hedge_delay(hedge.provider)
+                    continue
+
+                if attempt.cancelled.is_set() or (winner is not None and attempt is not winner):
+                    continue
+
+                if kind == 'rejected':
+                    # 提供者名額已滿，換下一個提供者，但不影響該提供者的錯誤率
+                    last_error = payload
+                    attempt.cancel()
+                    metrics.incr(f'router_{attempt.provider}_rejected_total')
+                    continue
+
+                stats = self.stats(attempt.provider)
+                if kind == 'error':
+                    last_error = payload
+                    stats.record_outcome(False)
+                    attempt.cancel()
+                    metrics.incr(f'router_{attempt.provider}_error_total')
+                    print(f"❌ {attempt.provider} 串流錯誤: {payload}")
+                    if winner is attempt:
+                        raise payload
+                    continue
+
+                if kind == 'done':
+                    stats.record_outcome(True)
+                    return
+
+                if winner is None:
+                    winner = attempt
+                    for other in attempts:
+                        if other is not winner:
+                            other.cancel()
+                    if winner is not primary:
+                        metrics.incr('router_hedge_won_total')
+                yield payload
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
@@ -0,0 +1,68 @@
+import os
+from typing import Any, Dict, Optional
+from .client_registry import client_registry
+
+
+def get_qdrant_client(qdrant_config: Optional[Dict[str, Any]] = None, path: Optional[str] = None):
+    """取得共用的 Qdrant 客戶端
+
+    - 遠端模式依 URL / API key / 傳輸方式共用一個連線池客戶端
+    - 本地模式（path）每個目錄只允許一個客戶端，因此同樣必須共用
+    """
+    from qdrant_client import QdrantClient
+
+    if path:
+        path = os.path.abspath(path)
+        return client_registry.get(f'qdrant_local:{path}', {'path': path}, lambda: QdrantClient(path=path))
+
+    qdrant_config = qdrant_config or {}
+    if not qdrant_config.get('url'):
+        raise ValueError("Qdrant URL 未設定")
+
+    connection_config = {
+        'url': qdrant_config['url'],
+        'api_key': qdrant_config.get('api_key') or None,
+        'prefer_grpc': qdrant_config.get('prefer_grpc', False),
+        'grpc_port': qdrant_config.get('grpc_port', 6334),
+        'timeout': qdrant_config.get('timeout', 60),
+        'max_connections': qdrant_config.get('max_connections', 50)
+    }
+
+    def factory():
+        import httpx
+
+        client = QdrantClient(
+            url=connection_config['url'],
+            api_key=connection_config['api_key'],
+            prefer_grpc=connection_config['prefer_grpc'],
+            grpc_port=connection_config['grpc_port'],
+            timeout=connection_config['timeout'],
+            limits=httpx.Limits(
+                max_connections=connection_config['max_connections'],
+                max_keepalive_connections=connection_config['max_connections']
+            )
+        )
+        transport = 'gRPC' if connection_config['prefer_grpc'] else 'REST'
+        print(f"✅ Qdrant 客戶端連接成功 ({transport})")
+        return client
+
+    return client_registry.get('qdrant', connection_config, factory)
+
+
+def get_async_qdrant_client(qdrant_config: Optional[Dict[str, Any]] = None):
+    """取得共用的 AsyncQdrantClient，供 asyncio / ASGI 查詢路徑使用"""
+    from qdrant_client import AsyncQdrantClient
+
+    qdrant_config = qdrant_config or {}
+    if not qdrant_config.get('url'):
+        raise ValueError("Qdrant URL 未設定")
+
+    connection_config = {
+        'url': qdrant_config['url'],
+        'api_key': qdrant_config.get('api_key') or None,
+        'prefer_grpc': qdrant_config.get('prefer_grpc', False),
+        'grpc_port': qdrant_config.get('grpc_port', 6334),
+        'timeout': qdrant_config.get('timeout', 60)
+    }
+
+    return client_registry.get('qdrant_async', connection_config, lambda: AsyncQdrantClient(**connection_config))
@@ -0,0 +1,254 @@
+import re
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from llama_index.core.schema import BaseNode
+
+
+# LlamaIndex 寫入 payload 時會以 ref_doc_id 覆寫 doc_id / document_id，因此使用獨立的鍵
+DOC_ID_KEY = 'source_doc_id'
+DOC_SECTION_KEY = 'source_section'
+FILE_NAME_KEY = 'file_name'
+PAGE_NUMBER_KEY = 'page_number'
+UPLOADED_AT_KEY = 'uploaded_at'
+TOKEN_COUNT_KEY = 'token_count'
+_SOURCE_KEYS = (DOC_ID_KEY, DOC_SECTION_KEY, PAGE_NUMBER_KEY, UPLOADED_AT_KEY, TOKEN_COUNT_KEY)
+
+# 段落集合的 payload 索引：過濾條件只在有索引的欄位上才能走 Qdrant 的過濾 HNSW / 基數估計
+PAYLOAD_INDEXES = (
+    (DOC_ID_KEY, 'keyword'),
+    (FILE_NAME_KEY, 'keyword'),
+    (PAGE_NUMBER_KEY, 'integer'),
+    (UPLOADED_AT_KEY, 'float'),
+)
+
+MAX_FILES = 100
+MAX_PAGE_RANGES = 50
+_SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+_PAGE_RANGE_PATTERN = re.compile(r'^\s*(\d+)\s*(?:-\s*(\d+)\s*)?$')
+
+
+class QueryFilterError(ValueError):
+    """請求中的過濾條件格式錯誤，對應 HTTP 400"""
+
+
+def tag_nodes(nodes: Sequence[BaseNode], doc_id: str, page_numbers: Sequence[int],
+              uploaded_at: Optional[float] = None, sections: Optional[Sequence[int]] = None,
+              token_counts: Optional[Sequence[int]] = None):
+    """在節點 metadata 中標記來源文件、頁序（從 1 起算）、上傳時間、段落與 token 數，寫入 Qdrant payload
+    供過濾與上下文打包；不參與嵌入與 LLM 內容"""
+    for i, node in enumerate(nodes):
+        node.metadata[DOC_ID_KEY] = doc_id
+        node.metadata[PAGE_NUMBER_KEY] = page_numbers[i]
+        if uploaded_at is not None:
+            node.metadata[UPLOADED_AT_KEY] = uploaded_at
+        if sections is not None:
+            node.metadata[DOC_SECTION_KEY] = sections[i]
+        if token_counts is not None and token_counts[i] is not None:
+            node.metadata[TOKEN_COUNT_KEY] = token_counts[i]
+        for key in _SOURCE_KEYS:
+            if key not in node.excluded_embed_metadata_keys:
+                node.excluded_embed_metadata_keys.append(key)
+            if key not in node.excluded_llm_metadata_keys:
+                node.excluded_llm_metadata_keys.append(key)
+
+
+def ensure_payload_indexes(client, collection_name: str, indexes=PAYLOAD_INDEXES, wait: bool = True) -> List[str]:
+    """為集合建立缺少的 payload 索引；集合不存在時略過。返回新建立的欄位"""
+    from qdrant_client import models
+
+    if not client.collection_exists(collection_name):
+        return []
+    existing = client.get_collection(collection_name).payload_schema or {}
+    created = []
+    for field, schema in indexes:
+        if field in existing:
+            continue
+        client.create_payload_index(collection_name, field, models.PayloadSchemaType(schema), wait=wait)
+        created.append(field)
+    if created:
+        print(f"🗂️ 已建立 payload 索引 {collection_name}: {', '.join(created)}")
+    return created
+
+
+class QueryFilter:
+    """單次查詢的過濾條件：文件、頁碼範圍與上傳時間範圍
+
+    文件以 SHA-256（/api/files 的 file_id）或檔名指定；同一條件內為 OR，不同條件之間為 AND。
+    """
+
+    def __init__(self,
+                 doc_ids: Optional[List[str]] = None,
+                 file_names: Optional[List[str]] = None,
+                 page_ranges: Optional[List[tuple]] = None,
+                 uploaded_after: Optional[float] = None,
+                 uploaded_before: Optional[float] = None):
+        self.doc_ids = doc_ids or []
+        self.file_names = file_names or []
+        self.page_ranges = page_ranges or []
+        self.uploaded_after = uploaded_after
+        self.uploaded_before = uploaded_before
+
+    @property
+    def file_count(self) -> int:
+        """指定的文件數；0 代表不限文件"""
+        return len(self.doc_ids) + len(self.file_names)
+
+    def chunk_filter(self, routed_doc_ids: Optional[List[str]] = None):
+        """段落集合的 Qdrant Filter；routed_doc_ids 為第一階段路由挑出的文件，與請求條件取交集"""
+        from qdrant_client import models
+
+        must = self._common_conditions()
+        if routed_doc_ids:
+            must.append(models.FieldCondition(key=DOC_ID_KEY, match=models.MatchAny(any=routed_doc_ids)))
+        if self.page_ranges:
+            must.append(models.Filter(should=[
+                models.FieldCondition(key=PAGE_NUMBER_KEY, range=models.Range(gte=start, lte=end))
+                for start, end in self.page_ranges
+            ]))
+        return models.Filter(must=must) if must else None
+
+    def document_filter(self):
+        """文件集合（第一階段路由）的 Qdrant Filter；頁碼條件只適用於段落"""
+        from qdrant_client import models
+
+        must = self._common_conditions()
+        return models.Filter(must=must) if must else None
+
+    def _common_conditions(self) -> list:
+        from qdrant_client import models
+
+        conditions = []
+        files = []
+        if self.doc_ids:
+            files.append(models.FieldCondition(key=DOC_ID_KEY, match=models.MatchAny(any=self.doc_ids)))
+        if self.file_names:
+            files.append(models.FieldCondition(key=FILE_NAME_KEY, match=models.MatchAny(any=self.file_names)))
+        if len(files) == 1:
+            conditions.append(files[0])
+        elif files:
+            conditions.append(models.Filter(should=files))
+        if self.uploaded_after is not None or self.uploaded_before is not None:
+            conditions.append(models.FieldCondition(
+                key=UPLOADED_AT_KEY,
+                range=models.Range(gte=self.uploaded_after, lte=self.uploaded_before)
+            ))
+        return conditions
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'files': self.doc_ids + self.file_names,
+            'pages': [list(page_range) for page_range in self.page_ranges],
+            'uploaded_after': self.uploaded_after,
+            'uploaded_before': self.uploaded_before
+        }
+
+
+def parse_query_filter(data: Any, resolve_file: Optional[Callable[[str], Optional[str]]] = None) -> Optional[QueryFilter]:
+    """解析請求 JSON 的 filters 欄位；未指定任何條件時返回 None
+
+    {
+        "files": ["<sha256>", "manual.pdf"],
+        "pages": [[1, 20], 35, "40-45"],
+        "uploaded_after": 1760000000 或 "2025-10-01T00:00:00",
+        "uploaded_before": ...
+    }
+    resolve_file(name) 將檔名轉為 SHA-256；找不到時改以 payload 中的 file_name 比對。
+    """
+    if data is None:
+        return None
+    if not isinstance(data, dict):
+        raise QueryFilterError('filters 必須是物件')
+    unknown = set(data) - {'files', 'pages', 'uploaded_after', 'uploaded_before'}
+    if unknown:
+        raise QueryFilterError(f"未知的過濾條件: {', '.join(sorted(unknown))}")
+
+    doc_ids, file_names = _parse_files(data.get('files'), resolve_file)
+    query_filter = QueryFilter(
+        doc_ids=doc_ids,
+        file_names=file_names,
+        page_ranges=_parse_pages(data.get('pages')),
+        uploaded_after=_parse_time(data.get('uploaded_after'), 'uploaded_after'),
+        uploaded_before=_parse_time(data.get('uploaded_before'), 'uploaded_before')
+    )
+    if query_filter.uploaded_after is not None and query_filter.uploaded_before is not None \
+            and query_filter.uploaded_after > query_filter.uploaded_before:
+        raise QueryFilterError('uploaded_after 不能晚於 uploaded_before')
+    if not (query_filter.file_count or query_filter.page_ranges
+            or query_filter.uploaded_after is not None or query_filter.uploaded_before is not None):
+        return None
+    return query_filter
+
+
+def _parse_files(values: Any, resolve_file: Optional[Callable[[str], Optional[str]]]):
+    if values is None:
+        return [], []
+    if isinstance(values, str):
+        values = [values]
+    if not isinstance(values, list) or not all(isinstance(v, str) and v.strip() for v in values):
+        raise QueryFilterError('files 必須是文件 ID 或檔名的列表')
+    if len(values) > MAX_FILES:
+        raise QueryFilterError(f'files 最多 {MAX_FILES} 個')
+
+    doc_ids, file_names = [], []
+    for value in values:
+        value = value.strip()
+        if _SHA256_PATTERN.match(value.lower()):
+            doc_id = value.lower()
+        else:
+            doc_id = resolve_file(value) if resolve_file else None
+        if doc_id:
+            if doc_id not in doc_ids:
+                doc_ids.append(doc_id)
+        elif value not in file_names:
+            file_names.append(value)
+    return doc_ids, file_names
+
+
+def _parse_pages(values: Any) -> List[tuple]:
+    if values is None:
+        return []
+    if not isinstance(values, list):
+        values = [values]
+    if len(values) > MAX_PAGE_RANGES:
+        raise QueryFilterError(f'pages 最多 {MAX_PAGE_RANGES} 個範圍')
+
+    ranges = []
+    for value in values:
+        if isinstance(value, bool):
+            raise QueryFilterError(f'無效的頁碼: {value}')
+        if isinstance(value, int):
+            start, end = value, value
+        elif isinstance(value, (list, tuple)) and len(value) == 2 \
+                and all(isinstance(v, int) and not isinstance(v, bool) for v in value):
+            start, end = value
+        elif isinstance(value, str) and _PAGE_RANGE_PATTERN.match(value):
+            match = _PAGE_RANGE_PATTERN.match(value)
+            start = int(match.group(1))
+            end = int(match.group(2) or start)
+        else:
+            raise QueryFilterError(f'無效的頁碼範圍: {value}（可用 12、[1, 20] 或 "1-20"）')
+        if start < 1 or end < start:
+            raise QueryFilterError(f'無效的頁碼範圍: {value}（頁碼從 1 起算，且起始頁不能大於結束頁）')
+        ranges.append((start, end))
+    return ranges
+
+
+def _parse_time(value: Any, field: str) -> Optional[float]:
+    """接受 Unix 時間戳（秒）或 ISO 8601 字串"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise QueryFilterError(f'{field} 必須是時間戳或 ISO 8601 時間')
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return datetime.fromisoformat(value.strip().replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            pass
+    raise QueryFilterError(f'{field} 必須是時間戳或 ISO 8601 時間')
@@ -0,0 +1,401 @@
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import struct
+from array import array
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional
+from .config_manager import ConfigManager
+from .node_store import encode_records, decode_records
+from .qdrant_factory import get_qdrant_client
+from .upload_store import IndexedHashRegistry, INDEXED_HASHES_FILE, sha256_file
+from . import collection_profile
+from .projection import ProjectionStore
+from .document_router import DocumentVectorWriter
+from .query_filters import ensure_payload_indexes
+
+
+SNAPSHOT_FORMAT = 1
+MANIFEST_FILE = 'manifest.json'
+POINTS_FILE = 'points.pnf'
+_FRAME_LENGTH = struct.Struct('>I')
+
+
+class SnapshotError(Exception):
+    """快照無法匯出或匯入"""
+
+
+def embedding_fingerprint(gemini_config: Dict[str, Any]) -> str:
+    """查詢時的嵌入模型必須與快照中的向量一致"""
+    return f"gemini:{gemini_config['embedding_model']}"
+
+
+def _encode_vector(vector) -> Dict[str, Any]:
+    if hasattr(vector, 'indices'):
+        return {'indices': list(vector.indices), 'values': list(vector.values)}
+    # 密集向量以 float32 位元組保存，比 JSON 浮點數小且解析快
+    return {'dense': base64.b64encode(array('f', vector).tobytes()).decode('ascii')}
+
+
+def _decode_vector(data: Dict[str, Any]):
+    from qdrant_client import models
+
+    if 'dense' in data:
+        vector = array('f')
+        vector.frombytes(base64.b64decode(data['dense']))
+        return vector.tolist()
+    return models.SparseVector(indices=data['indices'], values=data['values'])
+
+
+def write_frame(f: BinaryIO, records: List[Dict[str, Any]]):
+    """點位檔由多個 [u32 長度 + 壓縮紀錄區塊] 組成，可邊讀邊匯入"""
+    frame = encode_records(records)
+    f.write(_FRAME_LENGTH.pack(len(frame)))
+    f.write(frame)
+
+
+def read_frames(f: BinaryIO) -> Iterator[List[Dict[str, Any]]]:
+    while True:
+        header = f.read(_FRAME_LENGTH.size)
+        if not header:
+            return
+        (length,) = _FRAME_LENGTH.unpack(header)
+        yield list(decode_records(f.read(length)))
+
+
+class SnapshotManager:
+    """匯出 / 匯入可直接啟用的索引快照，新節點不需重新解析或嵌入
+
+    快照目錄包含：
+    - manifest.json：集合設定、點數、嵌入模型指紋、文件清單（最後寫入，代表快照完整）
+    - points.pnf：Qdrant 點位（向量與 payload）的壓縮區塊
+    - nodes/：解析節點快取（供之後更換嵌入模型時重建）
+    - uploads/：原始 PDF
+    - projection/：降維集合的投影參數與全精度向量側檔
+    """
+
+    def __init__(self, config_manager: ConfigManager, upload_folder: str):
+        self.config_manager = config_manager
+        self.upload_folder = upload_folder
+        self.qdrant_config = config_manager.get_qdrant_config()
+        self.ingestion_config = config_manager.get_ingestion_config()
+        self.snapshot_config = config_manager.get_snapshot_config()
+        self.snapshot_dir = self.snapshot_config['snapshot_dir']
+        self.hash_registry = IndexedHashRegistry(os.path.join(self.ingestion_config['job_dir'], INDEXED_HASHES_FILE))
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        if not name or os.path.basename(name) != name or name.startswith('.'):
+            raise SnapshotError(f"無效的快照名稱: {name}")
+        return os.path.join(self.snapshot_dir, name)
+
+    def list_snapshots(self) -> List[Dict[str, Any]]:
+        snapshots = []
+        for name in sorted(os.listdir(self.snapshot_dir)):
+            manifest = self.read_manifest(name)
+            if manifest:
+                snapshots.append({
+                    'name': name,
+                    'created_at': manifest['created_at'],
+                    'collection_name': manifest['collection_name'],
+                    'points': manifest['points'],
+                    'files': len(manifest['files']),
+                    'embedding_fingerprint': manifest['embedding_fingerprint']
+                })
+        return snapshots
+
+    def read_manifest(self, name: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.path(name), MANIFEST_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def export(self, collection_name: str, name: Optional[str] = None,
+               include_uploads: bool = True, progress: Optional[Callable] = None) -> Dict[str, Any]:
+        progress = progress or (lambda stage, **fields: None)
+        name = name or time.strftime('snapshot-%Y%m%d-%H%M%S')
+        target = self.path(name)
+        if os.path.exists(target):
+            raise SnapshotError(f"快照已存在: {name}")
+
+        client = get_qdrant_client(self.qdrant_config)
+        info = client.get_collection(collection_name=collection_name)
+        params = info.config.params
+        work_dir = f"{target}.partial"
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+
+        try:
+            progress('exporting_points', total_points=info.points_count)
+            points = self._dump_points(client, collection_name, os.path.join(work_dir, POINTS_FILE), progress)
+
+            progress('exporting_files')
+            files = self._export_files(work_dir, include_uploads)
+            projection = self._export_projection(collection_name, work_dir)
+
+            manifest = {
+                'format': SNAPSHOT_FORMAT,
+                'created_at': time.time(),
+                'collection_name': collection_name,
+                'points': points,
+                'vectors_config': self._dump_vectors_config(params.vectors),
+                'sparse_vectors_config': self._dump_vectors_config(params.sparse_vectors),
+                'embedding_fingerprint': embedding_fingerprint(self.config_manager.get_gemini_config()),
+                'projection': projection,
+                'include_uploads': include_uploads,
+                'files': files
+            }
+            with open(os.path.join(work_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            os.replace(work_dir, target)
+        except BaseException:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise
+
+        print(f"✅ 快照匯出完成: {name}（{points} 個點位，{len(files)} 個文件）")
+        return {'name': name, 'points': points, 'files': files}
+
+    def import_snapshot(self, name: str, collection_name: Optional[str] = None,
+                        force: bool = False, progress: Optional[Callable] = None) -> Dict[str, Any]:
+        from qdrant_client import models
+
+        progress = progress or (lambda stage, **fields: None)
+        source = self.path(name)
+        manifest = self.read_manifest(name)
+        if manifest is None:
+            raise SnapshotError(f"快照不存在或不完整: {name}")
+        if manifest['format'] != SNAPSHOT_FORMAT:
+            raise SnapshotError(f"不支援的快照格式: {manifest['format']}")
+
+        current = embedding_fingerprint(self.config_manager.get_gemini_config())
+        if manifest['embedding_fingerprint'] != current and not force:
+            raise SnapshotError(
+                f"快照的嵌入模型（{manifest['embedding_fingerprint']}）與目前設定（{current}）不同，查詢向量將無法比對"
+            )
+
+        projection = manifest.get('projection')
+        projection_config = self.config_manager.get_projection_config()
+        expected = None if projection_config['mode'] == 'none' else \
+            {'mode': projection_config['mode'], 'dim': projection_config['dim']}
+        actual = None if projection is None else {'mode': projection['mode'], 'dim': projection['dim']}
+        if actual != expected and not force:
+            raise SnapshotError(f"快照的嵌入降維設定（{actual}）與目前設定（{expected}）不同，查詢向量將無法比對")
+
+        collection_name = collection_name or manifest['collection_name']
+        client = get_qdrant_client(self.qdrant_config)
+        if client.collection_exists(collection_name):
+            client.delete_collection(collection_name=collection_name)
+        # 量化、on_disk 與 HNSW 參數依匯入節點的集合設定檔，向量維度與距離沿用快照
+        profile = self.config_manager.get_collection_config()
+        vectors_config = self._load_vectors_config(manifest['vectors_config'], models.VectorParams)
+        if isinstance(vectors_config, dict):
+            vectors_config = {name: collection_profile.apply_to_vector_params(params, profile)
+                              for name, params in vectors_config.items()}
+        elif vectors_config is not None:
+            vectors_config = collection_profile.apply_to_vector_params(vectors_config, profile)
+        client.create_collection(
+            collection_name=collection_name,
+            vectors_config=vectors_config,
+            sparse_vectors_config=self._load_vectors_config(manifest['sparse_vectors_config'], models.SparseVectorParams),
+            quantization_config=collection_profile.quantization_config(profile)
+        )
+        # 先建立過濾欄位的 payload 索引，寫入點位時一併建立索引
+        ensure_payload_indexes(client, collection_name)
+
+        progress('importing_points', total_points=manifest['points'])
+        with open(os.path.join(source, POINTS_FILE), 'rb') as f:
+            client.upload_points(
+                collection_name=collection_name,
+                points=self._iter_points(f),
+                batch_size=self.qdrant_config['upsert_batch_size'],
+                parallel=self.qdrant_config['upsert_parallel'],
+                wait=True
+            )
+
+        progress('importing_files')
+        self._import_files(source, manifest)
+        self._import_projection(source, collection_name)
+
+        if self.config_manager.get_document_routing_config()['enabled']:
+            # 文件路由向量由段落向量的質心組成，直接從匯入的點位重建
+            progress('rebuilding_document_vectors')
+            vector_name, params = next(iter(vectors_config.items())) if isinstance(vectors_config, dict) \
+                else (None, vectors_config)
+            DocumentVectorWriter(client, collection_name, params.size, profile).rebuild_from_collection(vector_name)
+        self.hash_registry.replace(manifest['files'])
+
+        print(f"✅ 快照匯入完成: {name}（{manifest['points']} 個點位）")
+        return {
+            'name': name,
+            'collection_name': collection_name,
+            'points': manifest['points'],
+            'files': manifest['files']
+        }
+
+    def _dump_points(self, client, collection_name: str, path: str, progress: Callable) -> int:
+        batch_size = self.snapshot_config['scroll_batch_size']
+        total = 0
+        offset = None
+        with open(path, 'wb') as f:
+            while True:
+                points, offset = client.scroll(
+                    collection_name=collection_name,
+                    limit=batch_size,
+                    offset=offset,
+                    with_payload=True,
+                    with_vectors=True
+                )
+                if points:
+                    write_frame(f, [self._encode_point(point) for point in points])
+                    total += len(points)
+                    progress('exporting_points', exported_points=total)
+                if offset is None:
+                    return total
+
+    @staticmethod
+    def _encode_point(point) -> Dict[str, Any]:
+        vector = point.vector
+        if isinstance(vector, dict):
+            vectors = {name: _encode_vector(v) for name, v in vector.items()}
+        else:
+            vectors = {'': _encode_vector(vector)}
+        return {'id': point.id, 'payload': point.payload, 'vectors': vectors}
+
+    @staticmethod
+    def _iter_points(f: BinaryIO):
+        from qdrant_client import models
+
+        for records in read_frames(f):
+            for record in records:
+                vectors = {name: _decode_vector(v) for name, v in record['vectors'].items()}
+                yield models.PointStruct(
+                    id=record['id'],
+                    payload=record['payload'],
+                    vector=vectors[''] if list(vectors) == [''] else vectors
+                )
+
+    @staticmethod
+    def _dump_vectors_config(config):
+        if config is None:
+            return None
+        if isinstance(config, dict):
+            return {'named': {name: params.model_dump(mode='json', exclude_none=True) for name, params in config.items()}}
+        return {'single': config.model_dump(mode='json', exclude_none=True)}
+
+    @staticmethod
+    def _load_vectors_config(data, params_type):
+        if data is None:
+            return None
+        if 'named' in data:
+            return {name: params_type(**params) for name, params in data['named'].items()}
+        return params_type(**data['single'])
+
+    def _export_files(self, work_dir: str, include_uploads: bool) -> List[Dict[str, Any]]:
+        indexed = {f['sha256']: f for f in self.hash_registry.all()}
+        node_store_dir = self.ingestion_config['node_store_dir']
+        files = []
+        for filename in sorted(os.listdir(self.upload_folder)):
+            if not filename.lower().endswith('.pdf'):
+                continue
+            path = os.path.join(self.upload_folder, filename)
+            sha256 = sha256_file(path)
+            files.append({
+                'filename': filename,
+                'original_name': indexed.get(sha256, {}).get('original_name') or filename,
+                'sha256': sha256,
+                'size': os.path.getsize(path)
+            })
+            if include_uploads:
+                _link_or_copy(path, os.path.join(work_dir, 'uploads', filename))
+
+            # 解析節點快取依 SHA-256 分目錄保存
+            shard = os.path.join(node_store_dir, sha256[:2])
+            if os.path.isdir(shard):
+                for name in os.listdir(shard):
+                    if name.startswith(sha256) and not name.endswith('.tmp'):
+                        _link_or_copy(os.path.join(shard, name), os.path.join(work_dir, 'nodes', sha256[:2], name))
+        return files
+
+    def _export_projection(self, collection_name: str, work_dir: str) -> Optional[Dict[str, Any]]:
+        store = ProjectionStore.for_collection(self.config_manager.get_projection_config(), collection_name)
+        meta = store.meta() if store is not None else None
+        if meta is None:
+            return None
+        for name in os.listdir(store.directory):
+            if not name.endswith('.tmp') and not name.endswith('.tmp.npz'):
+                _link_or_copy(os.path.join(store.directory, name), os.path.join(work_dir, 'projection', name))
+        return meta
+
+    def _import_projection(self, source: str, collection_name: str):
+        store = ProjectionStore.for_collection(self.config_manager.get_projection_config(), collection_name)
+        projection_dir = os.path.join(source, 'projection')
+        if store is None or not os.path.isdir(projection_dir):
+            return
+        # 重建時會先刪除側檔再重新建立，硬連結不會寫回快照
+        shutil.rmtree(store.directory, ignore_errors=True)
+        for name in os.listdir(projection_dir):
+            _link_or_copy(os.path.join(projection_dir, name), os.path.join(store.directory, name))
+
+    def _import_files(self, source: str, manifest: Dict[str, Any]):
+        nodes_dir = os.path.join(source, 'nodes')
+        if os.path.isdir(nodes_dir):
+            for shard in os.listdir(nodes_dir):
+                for name in os.listdir(os.path.join(nodes_dir, shard)):
+                    _link_or_copy(os.path.join(nodes_dir, shard, name),
+                                  os.path.join(self.ingestion_config['node_store_dir'], shard, name))
+
+        if not manifest.get('include_uploads'):
+            return
+
+        # 快照取代目前節點的文件集合
+        os.makedirs(self.upload_folder, exist_ok=True)
+        for filename in os.listdir(self.upload_folder):
+            if filename.lower().endswith('.pdf'):
+                os.remove(os.path.join(self.upload_folder, filename))
+        for file_info in manifest['files']:
+            _link_or_copy(os.path.join(source, 'uploads', file_info['filename']),
+                          os.path.join(self.upload_folder, file_info['filename']))
+
+
+def _link_or_copy(source: str, target: str):
+    """同一檔案系統時以硬連結取代複製"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='匯出 / 匯入索引快照')
+    parser.add_argument('command', choices=['export', 'import', 'list'])
+    parser.add_argument('name', nargs='?')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--collection', default='pdf_chat_collection')
+    parser.add_argument('--no-uploads', action='store_true', help='匯出時不包含原始 PDF')
+    parser.add_argument('--force', action='store_true', help='嵌入模型不同時仍然匯入')
+    args = parser.parse_args()
+
+    config_manager = ConfigManager(args.config)
+    base_config = config_manager.get_complete_config()[0]
+    manager = SnapshotManager(config_manager, base_config['input_dir'])
+
+    try:
+        if args.command == 'export':
+            manager.export(args.collection, args.name, include_uploads=not args.no_uploads)
+        elif args.command == 'import':
+            if not args.name:
+                parser.error('匯入需要指定快照名稱')
+            manager.import_snapshot(args.name, force=args.force)
+        else:
+            print(json.dumps(manager.list_snapshots(), ensure_ascii=False, indent=2))
+    except SnapshotError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
@@ -0,0 +1,184 @@
+import json
+import time
+import queue
+import asyncio
+import threading
+import contextvars
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, Optional
+from .stream_control import close_upstream, current_greenlet, interrupt
+
+
+class SSEEncoder:
+    """預編譯的 SSE 事件編碼器，避免每個事件重複建立 JSON 編碼器與格式化字串"""
+
+    def __init__(self):
+        self._encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+        self.complete_event = self.event({'status': 'complete'})
+
+    def event(self, payload: Dict[str, Any]) -> str:
+        return 'data: ' + self._encode(payload) + '\n\n'
+
+    def chunk(self, text: str, status: str = 'streaming') -> str:
+        return 'data: {"chunk":' + self._encode(text) + ',"status":"' + status + '"}\n\n'
+
+    def error(self, message: str) -> str:
+        return self.event({'error': message, 'status': 'error'})
+
+
+class TokenCoalescer:
+    """依時間窗或位元組上限合併 LLM 小分塊，第一個分塊立即送出"""
+
+    def __init__(self, flush_interval_ms: int = 50, max_bytes: int = 1024, clock=time.monotonic):
+        self.flush_interval = max(flush_interval_ms, 0) / 1000.0
+        self.max_bytes = max(max_bytes, 1)
+        self._clock = clock
+        self._parts = []
+        self._size = 0
+        self._last_flush = None
+
+    def push(self, text: str) -> Optional[str]:
+        """加入一個分塊，若達到送出條件則返回合併後的文字"""
+        if not text:
+            return None
+
+        self._parts.append(text)
+        self._size += len(text.encode('utf-8'))
+
+        now = self._clock()
+        if (self._last_flush is None
+                or self._size >= self.max_bytes
+                or now - self._last_flush >= self.flush_interval):
+            return self._drain(now)
+        return None
+
+    def flush(self) -> Optional[str]:
+        """送出剩餘的緩衝內容"""
+        if not self._parts:
+            return None
+        return self._drain(self._clock())
+
+    def poll(self) -> Optional[str]:
+        """緩衝內容已到送出時間時返回合併後的文字；上游暫停、沒有新分塊時由 SSE 迴圈定期呼叫"""
+        if not self._parts:
+            return None
+        now = self._clock()
+        if now - self._last_flush >= self.flush_interval:
+            return self._drain(now)
+        return None
+
+    def time_until_flush(self) -> Optional[float]:
+        """距離緩衝內容必須送出的秒數；沒有緩衝內容時為 None（不需要計時）"""
+        if not self._parts:
+            return None
+        return max(0.0, self._last_flush + self.flush_interval - self._clock())
+
+    def _drain(self, now: float) -> str:
+        text = ''.join(self._parts)
+        self._parts = []
+        self._size = 0
+        self._last_flush = now
+        return text
+
+
+def coalesce(source: Iterable[Any], coalescer: TokenCoalescer,
+             text_of: Optional[Callable[[Any], Optional[str]]] = None) -> Iterator[Any]:
+    """依 coalescer 合併上游分塊後輸出；上游暫停時，已收到的文字也不會等待超過 flush_interval
+
+    上游在背景執行緒（gevent 下為 greenlet）中讀取，本生成器以送出期限為逾時等待下一個分塊。
+    text_of(item) 返回項目的文字；返回 None 的項目（例如進度事件）會先送出緩衝文字再原樣輸出。
+    本生成器在上游結束前被關閉時，gevent 下立即中斷阻塞中的讀取並關閉上游，
+    一般執行緒則在取回控制權後關閉上游。
+    """
+    items = queue.Queue()
+    stop = threading.Event()
+    runner = []
+    finished = False
+
+    def read():
+        runner.append(current_greenlet())
+        try:
+            for item in source:
+                if stop.is_set():
+                    break
+                items.put((True, item))
+            items.put((False, None))
+        except BaseException as e:
+            items.put((False, e))
+        finally:
+            if stop.is_set():
+                close_upstream(source)
+
+    # 沿用呼叫端的 contextvars（LlamaIndex 的 instrumentation span 依賴它）
+    reader = threading.Thread(target=contextvars.copy_context().run, args=(read,))
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            try:
+                ok, item = items.get(timeout=coalescer.time_until_flush())
+            except queue.Empty:
+                text = coalescer.poll()
+                if text:
+                    yield text
+                continue
+            if not ok:
+                finished = True
+                if item is not None:
+                    raise item
+                break
+
+            text = text_of(item) if text_of else item
+            if text is None:
+                text = coalescer.flush()
+                if text:
+                    yield text
+                yield item
+                continue
+            text = coalescer.push(text)
+            if text:
+                yield text
+
+        text = coalescer.flush()
+        if text:
+            yield text
+    finally:
+        stop.set()
+        if not finished and runner:
+            interrupt(runner[0])
+
+
+async def acoalesce(source: AsyncIterator[str], coalescer: TokenCoalescer) -> AsyncIterator[str]:
+    """coalesce 的 asyncio 版本：等待下一個分塊的任務跨越逾時保留，不會因定期送出而被取消"""
+    iterator = source.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=coalescer.time_until_flush())
+            if not done:
+                text = coalescer.poll()
+                if text:
+                    yield text
+                continue
+
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            text = coalescer.push(str(chunk)) if chunk else None
+            if text:
+                yield text
+
+        text = coalescer.flush()
+        if text:
+            yield text
+    finally:
+        if pending is not None:
+            # 上游 aclose 之前必須先結束進行中的 __anext__
+            pending.cancel()
+            try:
+                await pending
+            except BaseException:
+                pass
@@ -0,0 +1,148 @@
+import json
+import time
+import uuid
+import hashlib
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+from .metrics import metrics
+from .stream_control import AsyncWaiters, wait_notified
+
+
+class StatusBroadcaster:
+    """系統狀態快照的版本化廣播，狀態有變化時才推送給 SSE 訂閱者
+
+    - publish()：內容與上一版相同時不遞增版本，也不喚醒訂閱者；返回快照的 ETag
+    - current()：返回 (version, body, etag)，供 /api/status 做 If-None-Match 比對
+    - subscribe()：以 SSE 輸出狀態事件，事件 id 為 <epoch>:<版本號>，閒置時送出 keep-alive；
+      asubscribe() 為 ASGI 模式使用的 asyncio 版本，等待時不佔用執行緒
+    - 有訂閱者時由單一背景執行緒定期呼叫 refresh（讀取 worker 進度），
+      與開啟的分頁數量無關
+    """
+
+    def __init__(self,
+                 refresh: Optional[Callable[[], Any]] = None,
+                 poll_interval: float = 0.5,
+                 heartbeat_seconds: float = 15.0):
+        self.refresh = refresh
+        self.poll_interval = poll_interval
+        self.heartbeat_seconds = heartbeat_seconds
+        self._encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode
+        # 版本號只在同一行程內遞增，重新啟動或連到其他 worker 後不可比較，以 epoch 區分
+        self.epoch = uuid.uuid4().hex[:8]
+        self._cond = threading.Condition()
+        self._async_waiters = AsyncWaiters()
+        self._version = 0
+        self._body = None
+        self._etag = None
+        self._subscribers = 0
+        self._watcher = None
+
+    def publish(self, snapshot: Dict[str, Any]) -> str:
+        """發布狀態快照並返回其 ETag；內容未變時沿用目前版本"""
+        body = self._encode(snapshot)
+        with self._cond:
+            if body == self._body:
+                return self._etag
+            self._version += 1
+            self._body = body
+            # ETag 只由內容決定、不含行程內的版本號：各 worker 由同一份共用工作狀態組出相同快照時 ETag 相同，
+            # 輪詢被負載平衡到另一個 worker 也能得到 304
+            self._etag = hashlib.sha1(body.encode("utf-8")).hexdigest()[:16]
+            self._cond.notify_all()
+            self._async_waiters.notify_all()
+            etag = self._etag
+        metrics.incr('status_published_total')
+        return etag
+
+    def current(self) -> Tuple[int, Optional[str], Optional[str]]:
+        with self._cond:
+            return self._version, self._body, self._etag
+
+    def resume_version(self, last_event_id: str) -> int:
+        """由 Last-Event-ID 取得客戶端已收到的版本
+
+        epoch 不同（行程重新啟動或連到其他 worker）或版本號超過目前版本時返回 0，讓訂閱者先收到目前狀態。
+        """
+        epoch, _, version = (last_event_id or '').rpartition(':')
+        if epoch != self.epoch:
+            return 0
+        try:
+            version = int(version)
+        except ValueError:
+            return 0
+        with self._cond:
+            return version if 0 <= version <= self._version else 0
+
+    def subscribe(self, last_version: int = 0):
+        """輸出 last_version 之後的狀態事件；首次連線會先收到目前狀態"""
+        self._attach()
+        try:
+            while True:
+                with self._cond:
+                    if self._version <= last_version:
+                        self._cond.wait(self.heartbeat_seconds)
+                    version, body = self._version, self._body
+
+                if version > last_version and body is not None:
+                    last_version = version
+                    yield f"id: {self.epoch}:{version}\ndata: {body}\n\n"
+                else:
+                    # 保持連線，避免代理伺服器因閒置而中斷
+                    yield ': keep-alive\n\n'
+        finally:
+            self._detach()
+
+    async def asubscribe(self, last_version: int = 0):
+        """subscribe 的 asyncio 版本"""
+        self._attach()
+        try:
+            while True:
+                with self._cond:
+                    waiter = self._async_waiters.add() if self._version <= last_version else None
+                if waiter is not None:
+                    try:
+                        await wait_notified(waiter, self.heartbeat_seconds)
+                    finally:
+                        with self._cond:
+                            self._async_waiters.discard(waiter)
+                with self._cond:
+                    version, body = self._version, self._body
+
+                if version > last_version and body is not None:
+                    last_version = version
+                    yield f"id: {self.epoch}:{version}\ndata: {body}\n\n"
+                else:
+                    yield ': keep-alive\n\n'
+        finally:
+            self._detach()
+
+    def _attach(self):
+        with self._cond:
+            self._subscribers += 1
+            metrics.set_gauge('status_stream_subscribers', self._subscribers)
+            self._ensure_watcher_locked()
+
+    def _detach(self):
+        with self._cond:
+            self._subscribers -= 1
+            metrics.set_gauge('status_stream_subscribers', self._subscribers)
+
+    def _ensure_watcher_locked(self):
+        if self.refresh is None or (self._watcher is not None and self._watcher.is_alive()):
+            return
+        self._watcher = threading.Thread(target=self._watch, name='status-watcher')
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def _watch(self):
+        # 沒有訂閱者時結束，下一位訂閱者連線時再啟動
+        while True:
+            with self._cond:
+                if self._subscribers == 0:
+                    self._watcher = None
+                    return
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"❌ 狀態更新失敗: {e}")
+            time.sleep(self.poll_interval)
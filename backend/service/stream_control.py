@@ -0,0 +1,105 @@
+import asyncio
+
+try:
+    from greenlet import GreenletExit
+    # interrupt() 在被中斷的 greenlet 中拋出的例外
+    INTERRUPTED = (GreenletExit,)
+except ImportError:
+    INTERRUPTED = ()
+
+
+def close_upstream(source) -> bool:
+    """關閉上游流式回應（生成器、SDK stream 或 StreamingResponse），釋放連線與生成資源"""
+    if source is None:
+        return False
+
+    targets = []
+    response_gen = getattr(source, 'response_gen', None)
+    if response_gen is not None:
+        targets.append(response_gen)
+    targets.append(source)
+
+    closed = False
+    for target in targets:
+        close = getattr(target, 'close', None)
+        if not callable(close):
+            continue
+        if getattr(target, 'gi_running', False):
+            # 正在其他執行緒（greenlet）中執行的生成器無法從這裡關閉，由讀取它的一方在取回控制權後關閉
+            continue
+        try:
+            close()
+            closed = True
+        except Exception as e:
+            print(f"⚠️ 關閉上游串流失敗: {e}")
+    return closed
+
+
+def current_greenlet():
+    """gevent monkey patch 下背景執行緒即為 greenlet，返回目前的 greenlet 供之後中斷；否則為 None"""
+    try:
+        from gevent import monkey, getcurrent
+    except ImportError:
+        return None
+    if not monkey.is_module_patched('threading'):
+        return None
+    return getcurrent()
+
+
+def interrupt(runner) -> bool:
+    """中斷執行串流的 greenlet 或 asyncio Task，其中的生成器會執行 finally、釋放名額並關閉上游連線
+
+    greenlet 內拋出 GreenletExit；Task 則在其事件迴圈上取消（可從其他執行緒呼叫），拋出 CancelledError。
+    """
+    if isinstance(runner, asyncio.Task):
+        if runner.done():
+            return False
+        runner.get_loop().call_soon_threadsafe(runner.cancel)
+        return True
+    if runner is None or runner.dead:
+        return False
+    import gevent
+    gevent.kill(runner)
+    return True
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AsyncWaiters:
+    """讓 asyncio 協程等待由其他執行緒發出的通知，搭配 threading.Condition 使用
+
+    add()、discard() 與 notify_all() 都須在呼叫端持有同一把鎖時呼叫，
+    先檢查條件再登記等待，通知才不會在兩者之間遺失。
+    """
+
+    def __init__(self):
+        self._futures = set()
+
+    def add(self) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._futures.add(future)
+        return future
+
+    def discard(self, future: asyncio.Future):
+        self._futures.discard(future)
+
+    def notify_all(self):
+        for future in self._futures:
+            try:
+                future.get_loop().call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                # 事件迴圈已關閉，等待者也已不存在
+                pass
+        self._futures.clear()
+
+
+async def wait_notified(future: asyncio.Future, timeout: float) -> bool:
+    """等待 AsyncWaiters 的通知，逾時返回 False"""
+    try:
+        await asyncio.wait_for(future, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
@@ -0,0 +1,471 @@
+import os
+import re
+import json
+import time
+import uuid
+import asyncio
+import threading
+from collections import deque, OrderedDict
+from typing import AsyncIterator, Callable, Iterable, Optional, Sequence
+from .metrics import metrics
+from .stream_control import AsyncWaiters, close_upstream, current_greenlet, interrupt, wait_notified, INTERRUPTED
+
+
+GAP_EVENT = 'data: {"error":"串流緩衝已過期，請重新提問","status":"error"}\n\n'
+_STREAM_ID = re.compile(r'[0-9a-f]{32}')
+
+
+class StreamSpool:
+    """跨 worker 行程共用的串流事件檔
+
+    每個串流在 <directory>/<stream_id>.events 逐行寫入 JSON 事件，結束時寫入 {"done": true}；
+    續傳請求被負載平衡送到其他 worker 時，由該 worker 讀取事件檔補發與跟隨後續事件，
+    並定期更新 <stream_id>.attached 的修改時間，讓擁有串流的行程知道仍有客戶端連線。
+    """
+
+    def __init__(self, directory: str, poll_interval: float = 0.2):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, stream_id: str, suffix: str) -> Optional[str]:
+        # stream_id 來自網址，只接受 uuid4().hex 格式，避免組出目錄外的路徑
+        if not _STREAM_ID.fullmatch(stream_id):
+            return None
+        return os.path.join(self.directory, f"{stream_id}.{suffix}")
+
+    def open_writer(self, stream_id: str):
+        return open(self.path(stream_id, 'events'), 'a', encoding='utf-8')
+
+    def exists(self, stream_id: str) -> bool:
+        path = self.path(stream_id, 'events')
+        return path is not None and os.path.exists(path)
+
+    def touch_attached(self, stream_id: str):
+        path = self.path(stream_id, 'attached')
+        try:
+            with open(path, 'a'):
+                os.utime(path, None)
+        except OSError:
+            pass
+
+    def last_attached(self, stream_id: str) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.path(stream_id, 'attached'))
+        except OSError:
+            return None
+
+    def remove(self, stream_id: str):
+        for suffix in ('events', 'attached'):
+            try:
+                os.remove(self.path(stream_id, suffix))
+            except OSError:
+                pass
+
+    def sweep(self, max_age: float):
+        """移除超過 max_age 未更新的檔案（包括已結束行程遺留的串流）"""
+        now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except OSError:
+                continue
+
+
+class SpooledStream:
+    """由其他 worker 行程擁有的串流，從 StreamSpool 的事件檔讀取；介面與 StreamBuffer 的讀取端相同"""
+
+    def __init__(self, spool: StreamSpool, stream_id: str, stale_seconds: float):
+        self.spool = spool
+        self.stream_id = stream_id
+        self.stale_seconds = stale_seconds
+        self.events = []
+        self.done = False
+        self._offset = 0
+
+    def attach(self):
+        self.spool.touch_attached(self.stream_id)
+
+    def detach(self):
+        pass
+
+    def wait_events(self, after_seq: int, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            pending = self._poll(after_seq)
+            remaining = deadline - time.monotonic()
+            if pending or self.done or remaining <= 0:
+                return pending, self.done, False
+            time.sleep(min(self.spool.poll_interval, remaining))
+
+    async def await_events(self, after_seq: int, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            pending = self._poll(after_seq)
+            remaining = deadline - time.monotonic()
+            if pending or self.done or remaining <= 0:
+                return pending, self.done, False
+            await asyncio.sleep(min(self.spool.poll_interval, remaining))
+
+    def _poll(self, after_seq: int):
+        self.spool.touch_attached(self.stream_id)
+        self._read()
+        return [event for event in self.events if event[0] > after_seq]
+
+    def _read(self):
+        path = self.spool.path(self.stream_id, 'events')
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                f.seek(self._offset)
+                data = f.read()
+                stale = time.time() - os.fstat(f.fileno()).st_mtime > self.stale_seconds
+        except OSError:
+            # 事件檔已過期被移除
+            self.done = True
+            return
+        # 只處理完整的行，寫到一半的行留待下次讀取
+        end = data.rfind('\n') + 1
+        self._offset += len(data[:end].encode('utf-8'))
+        for line in data[:end].splitlines():
+            record = json.loads(line)
+            if record.get('done'):
+                self.done = True
+            else:
+                self.events.append((record['seq'], record['data']))
+        if stale and not self.done:
+            # 擁有者行程已結束而沒有寫入結束標記
+            self.done = True
+
+
+class StreamBuffer:
+    """單一 SSE 串流的事件環形緩衝，供斷線重連時補發事件"""
+
+    def __init__(self, stream_id: str, max_events: int):
+        self.stream_id = stream_id
+        self.events = deque(maxlen=max_events)
+        self.next_seq = 1
+        self.done = False
+        self.consumers = 0
+        self.cancelled = False
+        self.created_at = time.time()
+        self.detached_at = None
+        self.finished_at = None
+        self.aborted = False
+        self.on_abort: Sequence[Callable[[], None]] = ()
+        self.runner = None
+        self.spool: Optional[StreamSpool] = None
+        self._spool_file = None
+        self._cond = threading.Condition()
+        self._async_waiters = AsyncWaiters()
+
+    def attach_spool(self, spool: StreamSpool):
+        """同時把事件寫入共用事件檔，讓其他 worker 也能處理這個串流的續傳"""
+        try:
+            self._spool_file = spool.open_writer(self.stream_id)
+            self.spool = spool
+        except OSError as e:
+            print(f"⚠️ 無法建立串流事件檔: {e}")
+
+    def _spool_write_locked(self, record: dict):
+        if self._spool_file is None:
+            return
+        try:
+            self._spool_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._spool_file.flush()
+        except OSError as e:
+            print(f"⚠️ 寫入串流事件檔失敗: {e}")
+            self._spool_file = None
+
+    def append(self, payload: str) -> int:
+        with self._cond:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.events.append((seq, payload))
+            self._spool_write_locked({'seq': seq, 'data': payload})
+            self._cond.notify_all()
+            self._async_waiters.notify_all()
+            return seq
+
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self.finished_at = time.time()
+            self._spool_write_locked({'done': True})
+            if self._spool_file is not None:
+                self._spool_file.close()
+                self._spool_file = None
+            self._cond.notify_all()
+            self._async_waiters.notify_all()
+
+    def attach(self):
+        with self._cond:
+            self.consumers += 1
+            self.detached_at = None
+
+    def detach(self):
+        with self._cond:
+            self.consumers -= 1
+            if self.consumers <= 0:
+                self.consumers = 0
+                self.detached_at = time.time()
+
+    def is_abandoned(self, grace_seconds: float) -> bool:
+        """沒有任何客戶端連線（包括在其他 worker 續傳的客戶端）且超過重連寬限期"""
+        if self.done or self.consumers > 0 or self.detached_at is None:
+            return False
+        last_seen = self.detached_at
+        if self.spool is not None:
+            last_seen = max(last_seen, self.spool.last_attached(self.stream_id) or 0)
+        return time.time() - last_seen > grace_seconds
+
+    def wait_events(self, after_seq: int, timeout: float):
+        """等待 after_seq 之後的事件，返回 (events, done, gap)；gap 表示所需事件已被環形緩衝淘汰"""
+        with self._cond:
+            if not self._ready_locked(after_seq):
+                self._cond.wait(timeout)
+            return self._collect_locked(after_seq)
+
+    async def await_events(self, after_seq: int, timeout: float):
+        """wait_events 的 asyncio 版本，等待時不佔用執行緒"""
+        with self._cond:
+            waiter = None if self._ready_locked(after_seq) else self._async_waiters.add()
+        if waiter is not None:
+            try:
+                await wait_notified(waiter, timeout)
+            finally:
+                with self._cond:
+                    self._async_waiters.discard(waiter)
+        with self._cond:
+            return self._collect_locked(after_seq)
+
+    def _ready_locked(self, after_seq: int) -> bool:
+        return self.done or bool(self.events and self.events[-1][0] > after_seq)
+
+    def _collect_locked(self, after_seq: int):
+        pending = [event for event in self.events if event[0] > after_seq]
+        oldest = self.events[0][0] if self.events else self.next_seq
+        gap = after_seq + 1 < oldest
+        return pending, self.done, gap
+
+
+class StreamRegistry:
+    """可續傳 SSE 串流的註冊表：背景產生事件，客戶端可用 Last-Event-ID 重新接上"""
+
+    def __init__(self,
+                 max_streams: int = 256,
+                 max_events: int = 2048,
+                 ttl_seconds: float = 300,
+                 grace_seconds: float = 30,
+                 heartbeat_seconds: float = 15,
+                 spool: Optional[StreamSpool] = None):
+        self.max_streams = max_streams
+        self.max_events = max_events
+        self.ttl_seconds = ttl_seconds
+        self.grace_seconds = grace_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        # 多個 worker 行程時，續傳請求可能落在沒有這個串流的行程，透過共用事件檔處理
+        self.spool = spool
+        self._last_sweep = 0.0
+        self._streams = OrderedDict()
+        self._running = set()
+        self._lock = threading.Lock()
+        self._watchdog = None
+        # 棄置檢查的間隔：上游停滯時不會有新事件觸發 _pump 中的檢查
+        self.watchdog_seconds = max(min(grace_seconds / 2, 1.0), 0.05)
+
+    def create(self, source: Iterable[str], on_abort: Sequence[Callable[[], None]] = ()) -> StreamBuffer:
+        """註冊新串流並在背景執行緒（gevent 下為 greenlet）中消費 source
+
+        on_abort 為串流被棄置或淘汰時立即執行的釋放動作（例如准入名額的 release，須可重複呼叫），
+        即使上游停滯、source 無法在這時關閉也能歸還名額。
+        """
+        stream = self._register(on_abort)
+        thread = threading.Thread(target=self._pump, args=(stream, source))
+        thread.daemon = True
+        thread.start()
+        return stream
+
+    def create_async(self, source: AsyncIterator[str], on_abort: Sequence[Callable[[], None]] = ()) -> StreamBuffer:
+        """create 的 asyncio 版本：在目前的事件迴圈上以 Task 消費非同步生成器 source
+
+        Task 不隨客戶端連線取消，斷線後仍在寬限期內生成；被棄置時由 watchdog 取消 Task。
+        """
+        stream = self._register(on_abort)
+        stream.runner = asyncio.ensure_future(self._apump(stream, source))
+        return stream
+
+    def _register(self, on_abort: Sequence[Callable[[], None]]) -> StreamBuffer:
+        stream = StreamBuffer(uuid.uuid4().hex, self.max_events)
+        stream.on_abort = tuple(on_abort)
+        if self.spool is not None:
+            stream.attach_spool(self.spool)
+        with self._lock:
+            self._evict_locked()
+            self._streams[stream.stream_id] = stream
+            self._running.add(stream)
+            self._start_watchdog_locked()
+        return stream
+
+    def get(self, stream_id: str):
+        """返回本行程的 StreamBuffer；串流屬於其他 worker 時返回讀取共用事件檔的 SpooledStream"""
+        with self._lock:
+            self._evict_locked()
+            stream = self._streams.get(stream_id)
+        if stream is None and self.spool is not None and self.spool.exists(stream_id):
+            metrics.incr('chat_stream_resume_spooled_total')
+            return SpooledStream(self.spool, stream_id, self.ttl_seconds)
+        return stream
+
+    def subscribe(self, stream: StreamBuffer, last_seq: int = 0):
+        """將緩衝事件與後續事件以 SSE 格式輸出，事件 id 為 <stream_id>:<seq>"""
+        stream.attach()
+        try:
+            while True:
+                events, done, gap = stream.wait_events(last_seq, self.heartbeat_seconds)
+                if gap:
+                    metrics.incr('chat_stream_resume_gap_total')
+                    yield GAP_EVENT
+                    return
+
+                for seq, payload in events:
+                    yield f"id: {stream.stream_id}:{seq}\n{payload}"
+                    last_seq = seq
+
+                if done and not events:
+                    return
+                if not events:
+                    # 保持連線，避免代理伺服器因閒置而中斷
+                    yield ': keep-alive\n\n'
+        finally:
+            stream.detach()
+
+    async def asubscribe(self, stream: StreamBuffer, last_seq: int = 0):
+        """subscribe 的 asyncio 版本，輸出格式相同，可與同步版本互相續傳"""
+        stream.attach()
+        try:
+            while True:
+                events, done, gap = await stream.await_events(last_seq, self.heartbeat_seconds)
+                if gap:
+                    metrics.incr('chat_stream_resume_gap_total')
+                    yield GAP_EVENT
+                    return
+
+                for seq, payload in events:
+                    yield f"id: {stream.stream_id}:{seq}\n{payload}"
+                    last_seq = seq
+
+                if done and not events:
+                    return
+                if not events:
+                    yield ': keep-alive\n\n'
+        finally:
+            stream.detach()
+
+    def _pump(self, stream: StreamBuffer, source: Iterable[str]):
+        stream.runner = current_greenlet()
+        try:
+            for payload in source:
+                stream.append(payload)
+                if stream.cancelled or stream.is_abandoned(self.grace_seconds):
+                    # 客戶端在寬限期內沒有重連（或串流被淘汰），停止上游生成
+                    stream.cancelled = True
+                    break
+        except INTERRUPTED:
+            # watchdog 已中止此串流，source 的 finally 已隨例外執行
+            pass
+        except Exception as e:
+            print(f"❌ 串流背景生成錯誤: {e}")
+        finally:
+            # source 若尚未結束，關閉它會觸發其 GeneratorExit 處理並釋放上游連線
+            close_upstream(source)
+            stream.finish()
+            with self._lock:
+                self._running.discard(stream)
+
+    async def _apump(self, stream: StreamBuffer, source: AsyncIterator[str]):
+        try:
+            async for payload in source:
+                stream.append(payload)
+                if stream.cancelled or stream.is_abandoned(self.grace_seconds):
+                    stream.cancelled = True
+                    break
+        except asyncio.CancelledError:
+            # watchdog 已取消此 Task，source 的 finally 已隨例外執行
+            pass
+        except Exception as e:
+            print(f"❌ 串流背景生成錯誤: {e}")
+        finally:
+            try:
+                # source 若尚未結束，關閉它會觸發其 GeneratorExit 處理並釋放上游連線
+                aclose = getattr(source, 'aclose', None)
+                if aclose is not None:
+                    await aclose()
+            except Exception as e:
+                print(f"⚠️ 關閉上游串流失敗: {e}")
+            stream.finish()
+            with self._lock:
+                self._running.discard(stream)
+
+    def _start_watchdog_locked(self):
+        if self._watchdog is not None and self._watchdog.is_alive():
+            return
+        self._watchdog = threading.Thread(target=self._watch, name='stream-watchdog')
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def _watch(self):
+        """定期檢查執行中的串流：被淘汰或超過寬限期無人連線的串流即使上游停滯也會被中止"""
+        while True:
+            time.sleep(self.watchdog_seconds)
+            if self.spool is not None and time.time() - self._last_sweep > self.ttl_seconds / 4:
+                self._last_sweep = time.time()
+                self.spool.sweep(self.ttl_seconds + self.grace_seconds)
+            with self._lock:
+                running = list(self._running)
+            for stream in running:
+                if not stream.aborted and (stream.cancelled or stream.is_abandoned(self.grace_seconds)):
+                    try:
+                        self._abort(stream)
+                    except Exception as e:
+                        print(f"❌ 中止串流失敗: {e}")
+
+    def _abort(self, stream: StreamBuffer):
+        stream.cancelled = True
+        stream.aborted = True
+        metrics.incr('chat_stream_abandoned_total')
+        for release in stream.on_abort:
+            try:
+                release()
+            except Exception as e:
+                print(f"⚠️ 釋放串流資源失敗: {e}")
+        # gevent 下中斷阻塞在上游的背景 greenlet、asyncio 下取消 Task，source 的 finally 會關閉上游連線；
+        # 一般執行緒無法從外部中斷，名額已由 on_abort 歸還，上游在下一個分塊到達時由 _pump 關閉
+        interrupt(stream.runner)
+
+    def _evict_locked(self):
+        now = time.time()
+        expired = [
+            stream_id for stream_id, stream in self._streams.items()
+            if stream.done and stream.consumers == 0 and now - stream.finished_at > self.ttl_seconds
+        ]
+        for stream_id in expired:
+            self._discard_locked(stream_id)
+
+        # 超過上限時優先淘汰最早的已完成串流
+        while len(self._streams) >= self.max_streams:
+            victim = next((sid for sid, s in self._streams.items() if s.done), None)
+            if victim is None:
+                victim = next(iter(self._streams))
+                self._streams[victim].cancelled = True
+            self._discard_locked(victim)
+
+    def _discard_locked(self, stream_id: str):
+        del self._streams[stream_id]
+        if self.spool is not None:
+            self.spool.remove(stream_id)
@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Iterator, List, Optional
+
+from llama_index.core.schema import BaseNode
+from llama_index.core.utils import get_tokenizer
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from .admission import AdmissionController, AdmissionRejected
+from .metrics import metrics
+from .priority_scheduler import PriorityScheduler, INGESTION
+from .query_filters import DOC_ID_KEY, PAGE_NUMBER_KEY
+
+
+# 提示詞變更時遞增，使舊的中間摘要失效
+PROMPT_VERSION = 1
+
+MAP_PROMPT = (
+    "以下是一份文件第 {pages} 頁的內容。\n"
+    "請以與原文相同的語言寫出這一段的摘要，保留重要的事實、數據、步驟與專有名詞，不要加入原文沒有的資訊。\n"
+    "---------------------\n"
+    "{text}\n"
+    "---------------------\n"
+    "摘要："
+)
+
+REDUCE_PROMPT = (
+    "以下是同一份文件中連續數個段落的摘要（依頁碼順序）。\n"
+    "請將它們整合成一份連貫的摘要，保留重要的事實、數據、步驟與專有名詞，刪除重複的內容。\n"
+    "---------------------\n"
+    "{text}\n"
+    "---------------------\n"
+    "整合摘要："
+)
+
+FINAL_PROMPT = (
+    "以下是整份文件「{file_name}」各部分的摘要（依頁碼順序）。\n"
+    "---------------------\n"
+    "{text}\n"
+    "---------------------\n"
+    "{instruction}"
+)
+
+DEFAULT_INSTRUCTION = "請以與原文相同的語言寫出整份文件的摘要：先用一段話說明文件目的，再依章節列出重點。"
+
+
+class SummaryCache:
+    """中間摘要的檔案快取，鍵由段落內容雜湊與提示詞版本組成，web 行程之間共用"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)['summary']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def put(self, key: str, summary: str, **meta):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'summary': summary, 'created_at': time.time(), **meta}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+
+class Section:
+    """摘要樹中的一個節點：一段連續頁面的摘要（或尚未摘要的原文）"""
+
+    def __init__(self, key: str, text: str, first_page: Optional[int], last_page: Optional[int]):
+        self.key = key
+        self.text = text
+        self.first_page = first_page
+        self.last_page = last_page
+
+    @property
+    def pages(self) -> str:
+        if self.first_page is None:
+            return '?'
+        return str(self.first_page) if self.first_page == self.last_page else f"{self.first_page}-{self.last_page}"
+
+
+class DocumentSummarizer:
+    """整份文件的 map-reduce 摘要
+
+    - map：依頁序將段落分組（每組約 map_group_tokens），各組並行摘要
+    - reduce：將摘要依 reduce_group_tokens 分組再摘要，逐層合併直到一次放得下
+    - final：依使用者指示（或問題）產生最終回答，以串流輸出
+    map / reduce 的中間摘要與指示無關，依段落內容雜湊快取，重複摘要與之後的問題都能直接使用；
+    每次 LLM 呼叫都先以非互動類別取得排程名額（不佔用聊天的保留額度），再取得提供者並發名額。
+    """
+
+    def __init__(self, processor, admission: AdmissionController, cache: SummaryCache,
+                 config: Dict[str, Any], provider: str = 'gemini',
+                 scheduler: Optional[PriorityScheduler] = None):
+        self.processor = processor
+        self.admission = admission
+        self.scheduler = scheduler
+        self.cache = cache
+        self.map_group_tokens = max(config['map_group_tokens'], 256)
+        self.reduce_group_tokens = max(config['reduce_group_tokens'], 256)
+        self.concurrency = max(config['concurrency'], 1)
+        self.queue_timeout = config['queue_timeout']
+        self.provider = provider
+        self.model_name = processor.gemini_config['model_name']
+        self._tokenizer = get_tokenizer()
+
+    def load_chunks(self, doc_id: str) -> List[BaseNode]:
+        """從向量集合讀回文件的所有段落，依頁序排列"""
+        from qdrant_client import models
+
+        vector_store = self.processor.index.vector_store
+        doc_filter = models.Filter(must=[models.FieldCondition(key=DOC_ID_KEY, match=models.MatchValue(value=doc_id))])
+        nodes = []
+        offset = None
+        while True:
+            points, offset = vector_store.client.scroll(
+                collection_name=vector_store.collection_name,
+                scroll_filter=doc_filter,
+                limit=512,
+                offset=offset,
+                with_payload=True,
+                with_vectors=False
+            )
+            nodes.extend(metadata_dict_to_node(point.payload) for point in points)
+            if offset is None:
+                break
+        nodes.sort(key=lambda node: (node.metadata.get(PAGE_NUMBER_KEY) or 0, node.start_char_idx or 0))
+        return nodes
+
+    def summarize(self, doc_id: str, instruction: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """產生進度事件 {'stage': ...}，最終回答以 {'chunk': text} 逐塊輸出"""
+        start = time.perf_counter()
+        yield {'stage': 'loading'}
+        chunks = self.load_chunks(doc_id)
+        if not chunks:
+            raise ValueError('文件尚未索引或沒有可摘要的內容')
+        file_name = chunks[0].metadata.get('file_name', '')
+
+        sections = [self._chunk_section(node) for node in chunks]
+        stats = {'chunks': len(chunks), 'llm_calls': 0, 'cached': 0}
+
+        level = 0
+        prompt = MAP_PROMPT
+        budget = self.map_group_tokens
+        # 至少做一次 map，之後逐層 reduce 直到所有摘要能放進最終提示詞
+        while level == 0 or self._tokens(sections) > self.reduce_group_tokens:
+            groups = self._group(sections, budget)
+            if level > 0 and len(groups) == len(sections):
+                # 每個摘要都已超過分組預算，無法再合併，直接交給最終步驟
+                break
+            stage = 'map' if level == 0 else 'reduce'
+            results: List[Optional[Section]] = [None] * len(groups)
+            yield from self._run_level(stage, level, groups, prompt, stats, results)
+            sections = results
+            level += 1
+            prompt = REDUCE_PROMPT
+            budget = self.reduce_group_tokens
+
+        yield {'stage': 'final', 'sections': len(sections), **stats}
+        instruction = (instruction or '').strip() or DEFAULT_INSTRUCTION
+        final_prompt = FINAL_PROMPT.format(
+            file_name=file_name,
+            text=self._join(sections),
+            instruction=instruction
+        )
+        key = self._key('final', [section.key for section in sections] + [instruction])
+        cached = self.cache.get(key)
+        if cached is not None:
+            stats['cached'] += 1
+            yield {'chunk': cached}
+        else:
+            parts = []
+            with self._llm_slot() as priority_ticket:
+                stats['llm_calls'] += 1
+                for response in self.processor.llm.stream_complete(final_prompt):
+                    # 串流速度取決於客戶端讀取；收到第一個分塊後歸還排程名額，只保留提供者並發名額
+                    if priority_ticket is not None:
+                        priority_ticket.release()
+                    if response.delta:
+                        parts.append(response.delta)
+                        yield {'chunk': response.delta}
+            self.cache.put(key, ''.join(parts), doc_id=doc_id, stage='final', model=self.model_name)
+
+        took_ms = (time.perf_counter() - start) * 1000
+        metrics.incr('summarize_llm_calls_total', stats['llm_calls'])
+        metrics.incr('summarize_cache_hits_total', stats['cached'])
+        metrics.observe('summarize_latency_ms', took_ms)
+        yield {'stage': 'done', 'levels': level, 'took_ms': round(took_ms, 1), **stats}
+
+    def _run_level(self, stage: str, level: int, groups: List[List[Section]], prompt: str,
+                   stats: Dict[str, int], results: List[Optional[Section]]) -> Iterator[Dict[str, Any]]:
+        """並行摘要一層的所有分組，每完成一組回報一次進度；結果依原順序寫入 results"""
+        pending = []
+        for i, group in enumerate(groups):
+            key = self._key(stage, [section.key for section in group])
+            cached = self.cache.get(key)
+            if cached is not None:
+                results[i] = Section(key, cached, group[0].first_page, group[-1].last_page)
+            else:
+                pending.append((i, key, group))
+        stats['cached'] += len(groups) - len(pending)
+        done = len(groups) - len(pending)
+        yield {'stage': stage, 'level': level, 'done': done, 'total': len(groups), 'cached': done}
+
+        if pending:
+            executor = ThreadPoolExecutor(max_workers=min(self.concurrency, len(pending)),
+                                          thread_name_prefix='summarize')
+            try:
+                futures = {executor.submit(self._summarize_group, key, group, prompt): (i, key, group)
+                           for i, key, group in pending}
+                for future in as_completed(futures):
+                    i, key, group = futures[future]
+                    results[i] = Section(key, future.result(), group[0].first_page, group[-1].last_page)
+                    stats['llm_calls'] += 1
+                    done += 1
+                    yield {'stage': stage, 'level': level, 'done': done, 'total': len(groups),
+                           'cached': len(groups) - len(pending)}
+            finally:
+                # 客戶端斷線（GeneratorExit）或第一個分組失敗（例如 AdmissionRejected）時，
+                # 取消尚未開始的分組；進行中的呼叫完成後仍會寫入快取
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def _summarize_group(self, key: str, group: List[Section], prompt: str) -> str:
+        pages = Section('', '', group[0].first_page, group[-1].last_page).pages
+        text = prompt.format(pages=pages, text=self._join(group))
+        try:
+            with self._llm_slot():
+                summary = self.processor.llm.complete(text).text.strip()
+        except AdmissionRejected:
+            metrics.incr('summarize_rejected_total')
+            raise
+        self.cache.put(key, summary, pages=pages, model=self.model_name)
+        return summary
+
+    @contextmanager
+    def _llm_slot(self):
+        """先取得排程名額，再取得提供者並發名額；yield 排程名額（未設定排程器時為 None），可提早歸還
+
+        排隊等待排程時不佔用提供者名額，避免與其他等待者互相持有對方需要的名額。
+        """
+        with (self.scheduler.slot(INGESTION, timeout=self.queue_timeout) if self.scheduler is not None
+              else nullcontext()) as priority_ticket:
+            with self.admission.slot(self.provider, timeout=self.queue_timeout):
+                yield priority_ticket
+
+    def _chunk_section(self, node: BaseNode) -> Section:
+        text = node.get_content()
+        page = node.metadata.get(PAGE_NUMBER_KEY)
+        return Section(hashlib.sha256(text.encode('utf-8')).hexdigest(), text, page, page)
+
+    def _group(self, sections: List[Section], budget: int) -> List[List[Section]]:
+        """依頁序將連續的段落分組，每組不超過 budget 個 token（單一段落超過時自成一組）"""
+        groups, current, size = [], [], 0
+        for section in sections:
+            tokens = self._count(section.text)
+            if current and size + tokens > budget:
+                groups.append(current)
+                current, size = [], 0
+            current.append(section)
+            size += tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    def _key(self, stage: str, parts: List[str]) -> str:
+        digest = hashlib.sha256(f"v{PROMPT_VERSION}|{self.model_name}|{stage}|".encode('utf-8'))
+        for part in parts:
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _tokens(self, sections: List[Section]) -> int:
+        return sum(self._count(section.text) for section in sections)
+
+    def _count(self, text: str) -> int:
+        return len(self._tokenizer(text))
+
+    @staticmethod
+    def _join(sections: List[Section]) -> str:
+        return '\n\n'.join(f"[第 {section.pages} 頁]\n{section.text}" for section in sections)
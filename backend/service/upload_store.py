@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+
+CHUNK_SIZE = 1024 * 1024
+INDEXED_HASHES_FILE = 'indexed_hashes.json'
+
+
+class UploadError(Exception):
+    """上傳請求無法處理，status_code 對應 HTTP 狀態碼"""
+
+    def __init__(self, message: str, status_code: int = 400, offset: Optional[int] = None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.offset = offset
+
+
+def _write_json(path: str, data: Dict[str, Any]):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def copy_stream(source: BinaryIO, target: BinaryIO, hasher=None,
+                limit: Optional[int] = None, chunk_size: int = CHUNK_SIZE) -> int:
+    """以固定大小的區塊複製串流並同時計算雜湊，記憶體用量與檔案大小無關"""
+    written = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        written += len(chunk)
+        if limit is not None and written > limit:
+            raise UploadError('上傳內容超過宣告的檔案大小', 413)
+        target.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+    return written
+
+
+def sha256_file(path: str, chunk_size: int = CHUNK_SIZE) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class UploadStore:
+    """上傳檔案直接寫入上傳目錄下的 .incoming/，完成後再原子地移入上傳目錄
+
+    - save_stream()：單次請求的串流上傳，邊寫入邊計算 SHA-256
+    - create_session() / append() / complete()：以位移量續傳的分段上傳（PATCH）
+    .incoming 為隱藏目錄，SimpleDirectoryReader 預設不會讀到未完成的檔案。
+    """
+
+    def __init__(self, upload_folder: str, session_ttl_seconds: float = 24 * 3600):
+        self.upload_folder = upload_folder
+        self.incoming_dir = os.path.join(upload_folder, '.incoming')
+        self.session_ttl_seconds = session_ttl_seconds
+        os.makedirs(self.incoming_dir, exist_ok=True)
+
+    def save_stream(self, stream: BinaryIO) -> Tuple[str, str, int]:
+        """將請求串流寫入暫存檔，返回 (path, sha256, size)"""
+        path = os.path.join(self.incoming_dir, f"{uuid.uuid4().hex}.part")
+        hasher = hashlib.sha256()
+        try:
+            with open(path, 'wb') as f:
+                size = copy_stream(stream, f, hasher)
+        except BaseException:
+            self.discard(path)
+            raise
+        return path, hasher.hexdigest(), size
+
+    def create_session(self, filename: str, size: int) -> Dict[str, Any]:
+        if size <= 0:
+            raise UploadError('檔案大小必須大於 0')
+        self.cleanup_sessions()
+
+        upload_id = uuid.uuid4().hex
+        session = {
+            'upload_id': upload_id,
+            'filename': filename,
+            'size': size,
+            'created_at': time.time()
+        }
+        open(self._part_path(upload_id), 'wb').close()
+        _write_json(self._meta_path(upload_id), session)
+        return {**session, 'offset': 0}
+
+    def get_session(self, upload_id: str) -> Optional[Dict[str, Any]]:
+        session = _read_json(self._meta_path(upload_id))
+        if session is None:
+            return None
+        try:
+            offset = os.path.getsize(self._part_path(upload_id))
+        except FileNotFoundError:
+            return None
+        return {**session, 'offset': offset}
+
+    def append(self, upload_id: str, offset: int, stream: BinaryIO) -> Dict[str, Any]:
+        """從 offset 繼續寫入；offset 必須等於目前已寫入的位元組數"""
+        session = self.get_session(upload_id)
+        if session is None:
+            raise UploadError('上傳工作不存在或已過期', 404)
+
+        with open(self._part_path(upload_id), 'ab') as f:
+            # 同一工作的多個 PATCH 可能落在不同 worker，以檔案鎖確保位移一致
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                current = f.seek(0, os.SEEK_END)
+                if offset != current:
+                    raise UploadError('Upload-Offset 與伺服器端不一致', 409, current)
+                copy_stream(stream, f, limit=session['size'] - current)
+                f.flush()
+                offset = f.tell()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        # 過期清理依檔案修改時間判斷，工作紀錄也要隨每次寫入更新，進行中的長時間上傳才不會被清掉
+        try:
+            os.utime(self._meta_path(upload_id))
+        except FileNotFoundError:
+            pass
+        return {**session, 'offset': offset}
+
+    def complete(self, upload_id: str) -> Tuple[Dict[str, Any], str, str]:
+        """所有位元組到齊後返回 (session, path, sha256)，並移除工作紀錄"""
+        session = self.get_session(upload_id)
+        if session is None:
+            raise UploadError('上傳工作不存在或已過期', 404)
+        if session['offset'] != session['size']:
+            raise UploadError('上傳尚未完成', 409, session['offset'])
+
+        path = self._part_path(upload_id)
+        sha256 = sha256_file(path)
+        self.discard(self._meta_path(upload_id))
+        return session, path, sha256
+
+    def cancel(self, upload_id: str):
+        self.discard(self._meta_path(upload_id))
+        self.discard(self._part_path(upload_id))
+
+    def promote(self, path: str, filename: str) -> str:
+        """將暫存檔移入上傳目錄"""
+        target = os.path.join(self.upload_folder, filename)
+        os.replace(path, target)
+        return target
+
+    def cleanup_sessions(self):
+        """移除過期的續傳工作"""
+        now = time.time()
+        for name in os.listdir(self.incoming_dir):
+            path = os.path.join(self.incoming_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self.session_ttl_seconds:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def discard(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _meta_path(self, upload_id: str) -> str:
+        return os.path.join(self.incoming_dir, f"{self._check_id(upload_id)}.json")
+
+    def _part_path(self, upload_id: str) -> str:
+        return os.path.join(self.incoming_dir, f"{self._check_id(upload_id)}.part")
+
+    @staticmethod
+    def _check_id(upload_id: str) -> str:
+        # upload_id 來自 URL，只接受 uuid hex，避免路徑穿越
+        if not upload_id.isalnum():
+            raise UploadError('上傳工作不存在或已過期', 404)
+        return upload_id
+
+
+class IndexedHashRegistry:
+    """目前向量集合中已索引檔案的 SHA-256，web 行程與 ingestion worker 共用"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def get(self, sha256: str) -> Optional[Dict[str, Any]]:
+        return (_read_json(self.path) or {}).get(sha256)
+
+    def replace(self, files: Iterable[Dict[str, Any]]):
+        now = time.time()
+        _write_json(self.path, {
+            f['sha256']: {**f, 'indexed_at': now}
+            for f in files if f.get('sha256')
+        })
+
+    def clear(self):
+        _write_json(self.path, {})
+
+    def all(self) -> List[Dict[str, Any]]:
+        return list((_read_json(self.path) or {}).values())
@@ -2,6 +2,71 @@ import React, { useState, useRef, useEffect } from "react";
 import { getApiBaseUrl } from "../utils/constants";
 import { SiteIcon } from "./Icons";
 
+// 分段續傳上傳的每段大小
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024;
+const UPLOAD_MAX_RETRIES = 3;
+
+// 以 POST /api/uploads 建立上傳工作，再以 PATCH 依 Upload-Offset 分段送出；
+// 連線中斷時以 HEAD 查詢伺服器已接收的位移量後續傳。返回最後一個回應
+const uploadResumable = async (apiBaseUrl, file, signal) => {
+  const createResponse = await fetch(`${apiBaseUrl}/api/uploads`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ filename: file.name, size: file.size }),
+    signal,
+  });
+  if (!createResponse.ok) {
+    return createResponse;
+  }
+
+  const { upload_id: uploadId } = await createResponse.json();
+  const uploadUrl = `${apiBaseUrl}/api/uploads/${uploadId}`;
+  let offset = 0;
+  let retries = 0;
+
+  while (true) {
+    let response;
+    try {
+      response = await fetch(uploadUrl, {
+        method: "PATCH",
+        headers: {
+          "Content-Type": "application/offset+octet-stream",
+          "Upload-Offset": String(offset),
+        },
+        body: file.slice(offset, offset + UPLOAD_CHUNK_SIZE),
+        signal,
+      });
+    } catch (error) {
+      if (error.name === "AbortError" || retries >= UPLOAD_MAX_RETRIES) {
+        throw error;
+      }
+      retries++;
+      const headResponse = await fetch(uploadUrl, { method: "HEAD", signal });
+      if (!headResponse.ok) {
+        throw error;
+      }
+      offset = Number(headResponse.headers.get("Upload-Offset"));
+      continue;
+    }
+
+    if (response.status === 409 && retries < UPLOAD_MAX_RETRIES) {
+      // 位移量不一致（前一段其實已寫入），改用伺服器端的位移量
+      retries++;
+      offset = Number(response.headers.get("Upload-Offset"));
+      continue;
+    }
+    if (!response.ok) {
+      return response;
+    }
+
+    retries = 0;
+    offset = Number(response.headers.get("Upload-Offset"));
+    if (offset >= file.size) {
+      return response;
+    }
+  }
+};
+
 const ChatRoom = () => {
   const [messages, setMessages] = useState([
     {
@@ -34,6 +99,7 @@ const ChatRoom = () => {
   const messagesEndRef = useRef(null);
   const inputRef = useRef(null);
   const fileInputRef = useRef(null);
+  const statusSourceRef = useRef(null);
 
   const aiModels = [
     {
@@ -77,6 +143,15 @@ const ChatRoom = () => {
     }
   }, []);
 
+  // 組件卸載時關閉狀態推送連線
+  useEffect(() => {
+    return () => {
+      if (statusSourceRef.current) {
+        statusSourceRef.current.close();
+      }
+    };
+  }, []);
+
   // 組件載入時檢查是否已有上傳的檔案
   useEffect(() => {
     const checkUploadedFiles = async () => {
@@ -177,79 +252,148 @@ const ChatRoom = () => {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
 
-      const reader = response.body.getReader();
-      const decoder = new TextDecoder();
-
       // 用簡單變數儲存累積的文字和來源
       let currentText = "";
       let currentSources = [];
+      // 續傳用：事件 id 格式為 <stream_id>:<seq>
+      let lastEventId = "";
+      let streamId = response.headers.get("X-Stream-Id");
+      let activeResponse = response;
+      let resumeAttempts = 0;
+      const maxResumeAttempts = 3;
+
+      // 處理單一 SSE 事件，返回 true 表示串流已完成
+      const handleEvent = (jsonData) => {
+        if (jsonData.error) {
+          throw new Error(jsonData.error);
+        }
 
-      while (true) {
-        const { done, value } = await reader.read();
+        if (jsonData.chunk) {
+          currentText += jsonData.chunk;
 
-        if (done) {
-          break;
+          // 創建新的文字變數來避免閉包問題
+          const newText = currentText;
+          setMessages((prev) =>
+            prev.map((msg) =>
+              msg.id === aiMessageId ? { ...msg, text: newText } : msg
+            )
+          );
+        }
+
+        if (jsonData.sources) {
+          currentSources = jsonData.sources;
+        }
+
+        if (jsonData.status === "complete") {
+          // 流式完成，更新最終狀態
+          const finalText = currentText;
+          const finalSources = currentSources;
+          setMessages((prev) =>
+            prev.map((msg) =>
+              msg.id === aiMessageId
+                ? {
+                    ...msg,
+                    text: finalText,
+                    sources: finalSources,
+                    isStreaming: false,
+                  }
+                : msg
+            )
+          );
+          setIsTyping(false);
+          return true;
         }
 
-        const chunk = decoder.decode(value, { stream: true });
-        const lines = chunk.split("\n");
+        if (jsonData.status === "error") {
+          throw new Error(jsonData.error || "未知錯誤");
+        }
+        return false;
+      };
 
-        for (const line of lines) {
-          if (line.startsWith("data: ")) {
-            try {
-              const jsonData = JSON.parse(line.slice(6));
+      // 讀取 SSE 串流，返回 true 表示收到完成信號
+      const readStream = async (streamResponse) => {
+        const reader = streamResponse.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
 
-              if (jsonData.error) {
-                throw new Error(jsonData.error);
-              }
+        while (true) {
+          const { done, value } = await reader.read();
 
-              if (jsonData.chunk) {
-                currentText += jsonData.chunk;
+          if (done) {
+            return false;
+          }
 
-                // 創建新的文字變數來避免閉包問題
-                const newText = currentText;
-                setMessages((prev) =>
-                  prev.map((msg) =>
-                    msg.id === aiMessageId ? { ...msg, text: newText } : msg
-                  )
-                );
-              }
+          buffer += decoder.decode(value, { stream: true });
+          const lines = buffer.split("\n");
+          // 保留最後一行（可能是被切斷的半行）
+          buffer = lines.pop();
 
-              if (jsonData.sources) {
-                currentSources = jsonData.sources;
+          for (const line of lines) {
+            if (line.startsWith("id: ")) {
+              lastEventId = line.slice(4);
+              if (!streamId) {
+                streamId = lastEventId.split(":")[0];
               }
-
-              if (jsonData.status === "complete") {
-                // 流式完成，更新最終狀態
-                const finalText = currentText;
-                const finalSources = currentSources;
-                setMessages((prev) =>
-                  prev.map((msg) =>
-                    msg.id === aiMessageId
-                      ? {
-                          ...msg,
-                          text: finalText,
-                          sources: finalSources,
-                          isStreaming: false,
-                        }
-                      : msg
-                  )
-                );
-                setIsTyping(false);
-                return; // 結束處理
+            } else if (line.startsWith("data: ")) {
+              let jsonData;
+              try {
+                jsonData = JSON.parse(line.slice(6));
+              } catch (parseError) {
+                console.warn("解析 SSE 數據失敗:", parseError);
+                continue;
               }
-
-              if (jsonData.status === "error") {
-                throw new Error(jsonData.error || "未知錯誤");
+              if (handleEvent(jsonData)) {
+                return true;
               }
-            } catch (parseError) {
-              console.warn("解析 SSE 數據失敗:", parseError);
             }
           }
+
+          // 即時滾動到底部
+          scrollToBottom();
         }
+      };
 
-        // 即時滾動到底部
-        scrollToBottom();
+      while (true) {
+        let dropError = null;
+        try {
+          if (await readStream(activeResponse)) {
+            return; // 結束處理
+          }
+        } catch (readError) {
+          // 只有網路中斷才續傳，伺服器回報的錯誤直接顯示
+          const isNetworkError =
+            readError.name === "TypeError" || readError.name === "NetworkError";
+          if (!isNetworkError) {
+            throw readError;
+          }
+          dropError = readError;
+        }
+
+        // 網路中斷，或連線在收到完成信號前正常關閉（例如代理伺服器逾時），都嘗試續傳
+        if (!streamId || resumeAttempts >= maxResumeAttempts) {
+          if (dropError) {
+            throw dropError;
+          }
+          break;
+        }
+
+        resumeAttempts++;
+        console.warn(`串流中斷，嘗試續傳 (${resumeAttempts}/${maxResumeAttempts})`);
+        await new Promise((resolve) =>
+          setTimeout(resolve, 1000 * resumeAttempts)
+        );
+
+        const resumeResponse = await fetch(
+          `${apiBaseUrl}/api/chat/stream/${streamId}`,
+          {
+            headers: { "Last-Event-ID": lastEventId },
+            signal: controller.signal,
+          }
+        );
+        if (!resumeResponse.ok) {
+          throw new Error(`HTTP error! status: ${resumeResponse.status}`);
+        }
+        activeResponse = resumeResponse;
       }
 
       // 如果流式處理完成但沒有收到 complete 狀態，手動結束
@@ -358,9 +502,6 @@ const ChatRoom = () => {
     };
     setMessages((prev) => [...prev, uploadingMessage]);
 
-    const formData = new FormData();
-    formData.append("file", file);
-
     try {
       const apiBaseUrl = getApiBaseUrl();
 
@@ -368,11 +509,12 @@ const ChatRoom = () => {
       const controller = new AbortController();
       const timeoutId = setTimeout(() => controller.abort(), 600000); // 10分鐘超時
 
-      const response = await fetch(`${apiBaseUrl}/api/upload`, {
-        method: "POST",
-        body: formData,
-        signal: controller.signal,
-      });
+      // 分段上傳：伺服器邊接收邊寫入磁碟，大檔案不佔用記憶體且可續傳
+      const response = await uploadResumable(
+        apiBaseUrl,
+        file,
+        controller.signal
+      );
 
       clearTimeout(timeoutId);
 
@@ -393,14 +535,16 @@ const ChatRoom = () => {
           )
         );
 
-        // 如果是異步處理，開始輪詢狀態
+        // 如果是異步處理，訂閱狀態推送
         if (responseData.processing) {
-          await pollProcessingStatus(uploadingMessageId, file.name);
+          watchProcessingStatus(uploadingMessageId, file.name);
         } else {
           // 立即完成
           const finalMessage = {
             id: uploadingMessageId,
-            text: `✅ 文件 "${file.name}" 已完成處理！現在您可以開始與AI討論這個PDF的內容了。`,
+            text: responseData.deduplicated
+              ? `✅ 文件 "${file.name}" 與已索引的內容相同，無需重新處理！現在您可以開始與AI討論這個PDF的內容了。`
+              : `✅ 文件 "${file.name}" 已完成處理！現在您可以開始與AI討論這個PDF的內容了。`,
             sender: "assistant",
             timestamp: new Date(),
             model: "system",
@@ -455,131 +599,143 @@ const ChatRoom = () => {
     }
   };
 
-  // 輪詢處理狀態的函數
-  const pollProcessingStatus = async (messageId, fileName) => {
+  // 訂閱處理狀態推送（/api/status/stream），狀態有變化時才會收到事件
+  const watchProcessingStatus = (messageId, fileName) => {
     const apiBaseUrl = getApiBaseUrl();
-    const maxAttempts = 120; // 增加到 120 次（10分鐘）
-    let attempts = 0;
+    const maxWaitMs = 600000; // 10分鐘後提示處理時間較長
 
-    const poll = async () => {
-      try {
-        attempts++;
-        const response = await fetch(`${apiBaseUrl}/api/status`);
-
-        if (response.ok) {
-          const statusData = await response.json();
-          const currentFile = statusData.files_detail.find(
-            (f) => f.filename === fileName
-          );
+    if (statusSourceRef.current) {
+      statusSourceRef.current.close();
+    }
+    const source = new EventSource(`${apiBaseUrl}/api/status/stream`);
+    statusSourceRef.current = source;
+    let lastStatus = null;
 
-          if (currentFile) {
-            if (currentFile.status === "error") {
-              // 文件處理錯誤
-              const errorMessage = {
-                id: messageId,
-                text: `❌ 文件 "${fileName}" 處理失敗：${
-                  currentFile.error || "未知錯誤"
-                }`,
-                sender: "assistant",
-                timestamp: new Date(),
-                model: "system",
-                isError: true,
-              };
-              setMessages((prev) =>
-                prev.map((msg) => (msg.id === messageId ? errorMessage : msg))
-              );
-              return;
-            }
+    const updateMessage = (message) => {
+      setMessages((prev) =>
+        prev.map((msg) => (msg.id === messageId ? message : msg))
+      );
+    };
 
-            if (
-              currentFile.status === "completed" &&
-              statusData.query_engine_ready
-            ) {
-              // 處理完成
-              const successMessage = {
-                id: messageId,
-                text: `✅ 文件 "${fileName}" 已完成處理！現在您可以開始與AI討論這個PDF的內容了。`,
-                sender: "assistant",
-                timestamp: new Date(),
-                model: "system",
-              };
-              setMessages((prev) =>
-                prev.map((msg) => (msg.id === messageId ? successMessage : msg))
-              );
-              // 設置檔案已上傳標記
-              setHasUploadedFile(true);
-              return;
-            }
+    const stop = () => {
+      clearTimeout(timeoutId);
+      source.close();
+      if (statusSourceRef.current === source) {
+        statusSourceRef.current = null;
+      }
+    };
 
-            if (currentFile.status === "processing") {
-              // 更新處理進度消息
-              const processingTime = Math.floor(
-                (Date.now() / 1000 - currentFile.upload_time) / 60
-              );
-              const progressMessage = {
-                id: messageId,
-                text: `🔄 文件 "${fileName}" 正在處理中...\n\n⏱️ 已處理時間：${processingTime} 分鐘\n📊 處理狀態：${statusData.status}\n📝 總文件數：${statusData.total_files}\n✅ 已完成：${statusData.completed_files}\n⚠️ 錯誤：${statusData.error_files}`,
-                sender: "assistant",
-                timestamp: new Date(),
-                model: "system",
-              };
-              setMessages((prev) =>
-                prev.map((msg) =>
-                  msg.id === messageId ? progressMessage : msg
-                )
-              );
-            }
-          }
+    const timeoutId = setTimeout(() => {
+      // 超時，但提供更詳細的狀態資訊
+      const statusText = lastStatus ? lastStatus.status : "unknown";
+      const progressText = lastStatus
+        ? `${lastStatus.completed_files}/${lastStatus.total_files}`
+        : "-";
+      updateMessage({
+        id: messageId,
+        text: `⚠️ 文件 "${fileName}" 處理時間較長（超過 10 分鐘）\n\n📊 當前狀態：${statusText}\n📝 處理進度：${progressText}\n\n您可以：\n• 繼續等待處理完成\n• 重新上傳文件\n• 聯繫技術支援`,
+        sender: "assistant",
+        timestamp: new Date(),
+        model: "system",
+        isError: true,
+      });
+      stop();
+    }, maxWaitMs);
 
-          if (attempts < maxAttempts) {
-            // 繼續輪詢，處理時間較長時增加間隔
-            const pollInterval = attempts > 60 ? 10000 : 5000; // 5分鐘後改為每10秒檢查一次
-            setTimeout(poll, pollInterval);
-          } else {
-            // 超時，但提供更詳細的狀態資訊
-            const timeoutMessage = {
-              id: messageId,
-              text: `⚠️ 文件 "${fileName}" 處理時間較長（超過 10 分鐘）\n\n📊 當前狀態：${statusData.status}\n📝 處理進度：${statusData.completed_files}/${statusData.total_files}\n\n您可以：\n• 繼續等待處理完成\n• 重新上傳文件\n• 聯繫技術支援`,
-              sender: "assistant",
-              timestamp: new Date(),
-              model: "system",
-              isError: true,
-            };
-            setMessages((prev) =>
-              prev.map((msg) => (msg.id === messageId ? timeoutMessage : msg))
-            );
-          }
-        } else {
-          console.error("狀態檢查失敗:", response.status);
-          if (attempts < maxAttempts) {
-            setTimeout(poll, 5000);
-          }
-        }
+    source.onmessage = (event) => {
+      let statusData;
+      try {
+        statusData = JSON.parse(event.data);
       } catch (error) {
-        console.error("輪詢狀態錯誤:", error);
-        if (attempts < maxAttempts) {
-          setTimeout(poll, 5000);
-        } else {
-          // 網路錯誤的處理
-          const networkErrorMessage = {
-            id: messageId,
-            text: `❌ 無法檢查文件 "${fileName}" 的處理狀態\n\n網路連線錯誤，請檢查網路連線後重試。`,
-            sender: "assistant",
-            timestamp: new Date(),
-            model: "system",
-            isError: true,
-          };
-          setMessages((prev) =>
-            prev.map((msg) =>
-              msg.id === messageId ? networkErrorMessage : msg
-            )
-          );
+        console.error("解析狀態事件失敗:", error);
+        return;
+      }
+      lastStatus = statusData;
+
+      const currentFile = statusData.files_detail.find(
+        (f) => f.filename === fileName
+      );
+      if (!currentFile) {
+        return;
+      }
+
+      if (currentFile.status === "error") {
+        // 文件處理錯誤
+        updateMessage({
+          id: messageId,
+          text: `❌ 文件 "${fileName}" 處理失敗：${
+            currentFile.error || "未知錯誤"
+          }`,
+          sender: "assistant",
+          timestamp: new Date(),
+          model: "system",
+          isError: true,
+        });
+        stop();
+        return;
+      }
+
+      if (currentFile.status === "completed" && statusData.query_engine_ready) {
+        // 處理完成
+        updateMessage({
+          id: messageId,
+          text: `✅ 文件 "${fileName}" 已完成處理！現在您可以開始與AI討論這個PDF的內容了。`,
+          sender: "assistant",
+          timestamp: new Date(),
+          model: "system",
+        });
+        // 設置檔案已上傳標記
+        setHasUploadedFile(true);
+        stop();
+        return;
+      }
+
+      if (currentFile.status === "processing") {
+        // 更新處理進度消息
+        const processingTime = Math.floor(
+          (Date.now() / 1000 - currentFile.upload_time) / 60
+        );
+        const stageText = currentFile.stage
+          ? `\n🧩 處理階段：${currentFile.stage}`
+          : "";
+        const pagesText = currentFile.total_pages
+          ? `\n📑 已索引頁數：${currentFile.indexed_pages || 0}/${currentFile.total_pages}`
+          : "";
+        // 已提交的頁面即可查詢，不必等整份文件索引完成
+        const partiallyReady =
+          statusData.query_engine_ready && currentFile.indexed_pages > 0;
+        if (partiallyReady) {
+          setHasUploadedFile(true);
         }
+        const readyText = partiallyReady
+          ? `\n\n💬 已可針對前 ${currentFile.indexed_pages} 頁提問，其餘頁面仍在索引中`
+          : "";
+        updateMessage({
+          id: messageId,
+          text: `🔄 文件 "${fileName}" 正在處理中...\n\n⏱️ 已處理時間：${processingTime} 分鐘\n📊 處理狀態：${statusData.status}${stageText}${pagesText}\n📝 總文件數：${statusData.total_files}\n✅ 已完成：${statusData.completed_files}\n⚠️ 錯誤：${statusData.error_files}${readyText}`,
+          sender: "assistant",
+          timestamp: new Date(),
+          model: "system",
+        });
       }
     };
 
-    // 開始輪詢
-    setTimeout(poll, 3000); // 3秒後開始第一次檢查
+    source.onerror = () => {
+      // EventSource 會自動帶 Last-Event-ID 重連；只有連線被關閉時才放棄
+      if (source.readyState !== EventSource.CLOSED) {
+        return;
+      }
+      console.error("狀態推送連線已關閉");
+      updateMessage({
+        id: messageId,
+        text: `❌ 無法檢查文件 "${fileName}" 的處理狀態\n\n網路連線錯誤，請檢查網路連線後重試。`,
+        sender: "assistant",
+        timestamp: new Date(),
+        model: "system",
+        isError: true,
+      });
+      stop();
+    };
   };
 
   const handleUploadButtonClick = () => {